@@ -1,7 +1,6 @@
 # /usr/bin/env python
 
 from collections import OrderedDict
-from functools import reduce
 import argparse
 import tarfile
 import logging
@@ -21,7 +20,10 @@ from pbcoretools.file_utils import (add_mock_collection_metadata,
                                     force_set_all_well_sample_names,
                                     force_set_all_bio_sample_names,
                                     uniqueify_collections,
-                                    collect_all_dataset_paths)
+                                    collect_all_dataset_paths,
+                                    merge_datasets)
+from pbcoretools.chunking.chunk_utils import (split_zmws_with_index,
+                                              split_barcodes_with_index)
 import pbcoretools.utils
 
 log = logging.getLogger(__name__)
@@ -270,6 +272,23 @@ def _get_auto_split_mode(ds, args):
         return (args.zmws, args.barcodes)
 
 
+def _split_with_index(dataSet, args, chunks, split_zmws, split_barcodes):
+    """
+    Plan a ZMW or barcode split from the cached split index in
+    args.split_index_dir; returns None if the index can't be used, in which
+    case the dataset is split as usual.
+    """
+    if (args.split_index_dir is None or chunks <= 0 or args.subdatasets or
+            args.maxChunks or not args.breakReadGroups or
+            not (split_zmws or split_barcodes)):
+        return None
+    os.makedirs(args.split_index_dir, exist_ok=True)
+    if split_barcodes:
+        return split_barcodes_with_index(dataSet, chunks,
+                                         args.split_index_dir)
+    return split_zmws_with_index(dataSet, chunks, args.split_index_dir)
+
+
 def splitXml(args):
     log.debug("Starting split")
     dataSet = openDataSet(args.infile, strict=args.strict)
@@ -281,7 +300,13 @@ def splitXml(args):
     split_zmws, split_barcodes = _get_auto_split_mode(dataSet, args)
     if args.chunks:
         chunks = args.chunks
-    if isinstance(dataSet, ContigSet):
+    dss = None
+    if not isinstance(dataSet, ContigSet):
+        dss = _split_with_index(dataSet, args, chunks, split_zmws,
+                                split_barcodes)
+    if dss is not None:
+        log.info("Planned %d chunks from the split index", len(dss))
+    elif isinstance(dataSet, ContigSet):
         dss = dataSet.split(chunks)
     else:
         dss = dataSet.split(
@@ -350,6 +375,10 @@ def split_options(parser):
         help="Optional output file prefix")
     pad("--simple-chunk-ids", default=False, action="store_true",
         help="Don't include barcode IDs in output file names (only applies if --barcodes was used)")
+    pad("--split-index-dir", dest="split_index_dir", default=None,
+        help=("Plan --zmws/--barcodes splits with --chunks from a per-ZMW "
+              "index cached in this directory, which is reused by later "
+              "splits of the same dataset"))
     pad("--breakReadGroups", action="store_true", default=True,
         help="Split across read group boundaries (default behavior)")
     pad("--keepReadGroups", dest="breakReadGroups", action="store_false",
@@ -360,15 +389,15 @@ def split_options(parser):
 
 
 def mergeXml(args):
-    dss = [openDataSet(infn, strict=args.strict) for infn in args.infiles]
-    allds = reduce(lambda ds1, ds2: ds1 + ds2, dss)
+    allds = merge_datasets(args.infiles,
+                           strict=args.strict,
+                           skip_counts=args.skipCounts,
+                           nproc=args.nproc)
     if not allds is None:
         if args.remove_parentage:
             allds.metadata.provenance = None
         if args.name:
             allds.name = args.name
-        if not args.skipCounts:
-            allds.updateCounts()
         if args.no_sub_datasets:
             allds.subdatasets = []
         if args.unique_collections:
@@ -398,6 +427,8 @@ def merge_options(parser):
     parser.add_argument("--unique-collections", action="store_true",
                         default=False,
                         help="Make sure CollectionMetadata records are unique")
+    parser.add_argument("-j", "--nproc", action="store", type=int, default=1,
+                        help="Number of processes for reading input XML files")
     parser.set_defaults(func=mergeXml)
 
 
@@ -12,6 +12,7 @@ from pbcommand.pb_io.common import write_pipeline_chunks
 from pbcommand.pb_io.report import fofn_to_report
 from pbcommand.models import PipelineChunk
 from pbcoretools.datastore_utils import datastore_to_datastorefile_objs, dataset_to_datastore
+from pbcoretools.chunking.split_index import SplitIndex
 
 
 log = logging.getLogger(__name__)
@@ -292,6 +293,50 @@ def _add_chunked_tag_if_missing(dset):
         dset.tags = ",".join(dset.tags.split(",") + ["chunked"])
 
 
+def _make_index_chunk(dset, filters, nrecords, nbases):
+    chunk = dset.copy()
+    for f in filters:
+        chunk.filters.addFilter(**f)
+    chunk.metadata.numRecords = nrecords
+    chunk.metadata.totalLength = nbases
+    chunk.newUuid()
+    return chunk
+
+
+def split_zmws_with_index(dset, max_total_nchunks, split_index_dir):
+    """
+    Split a dataset by ZMW ranges using the cached split index, returning
+    None if the index is unavailable for this dataset.
+    """
+    idx = SplitIndex.from_dataset(dset, split_index_dir)
+    if idx is None:
+        return None
+    chunks = []
+    for segments, nrecords, nbases in idx.zmw_chunks(max_total_nchunks):
+        filters = [dict(movie=[('=', movie)],
+                        zm=[('>', first - 1), ('<', last + 1)])
+                   for movie, first, last in segments]
+        chunks.append(_make_index_chunk(dset, filters, nrecords, nbases))
+    return chunks
+
+
+def split_barcodes_with_index(dset, max_total_nchunks, split_index_dir):
+    """
+    Split a dataset by barcode pairs using the cached split index, returning
+    None if the index is unavailable for this dataset.
+    """
+    idx = SplitIndex.from_dataset(dset, split_index_dir)
+    if idx is None:
+        return None
+    chunks = []
+    for pairs, nrecords, nbases in idx.barcode_chunks(max_total_nchunks):
+        # same value format as the filters written by DataSet.split
+        filters = [dict(bc=[('=', str([int(f), int(r)]))])
+                   for f, r in pairs]
+        chunks.append(_make_index_chunk(dset, filters, nrecords, nbases))
+    return chunks
+
+
 def to_chunked_alignmentset_files(alignmentset_path, reference_path,
                                   max_total_nchunks, chunk_key, dir_name,
                                   base_name, ext, by_zmw):
@@ -374,12 +419,21 @@ to_chunked_ccsset_files = functools.partial(_to_chunked_dataset_files,
 
 def _to_barcode_chunked_dataset_files(dataset_type, dataset_path,
                                       max_total_nchunks, chunk_key, dir_name,
-                                      base_name, ext, extra_chunk_keys=None):
+                                      base_name, ext, extra_chunk_keys=None,
+                                      split_index_dir=None):
     """
     Similar to to_chunked_subreadset_files, but chunks reads by barcode lists.
+    If split_index_dir is specified, the chunks will be planned from a cached
+    per-ZMW index stored in that directory (see split_index.py).
     """
-    dset = dataset_type(dataset_path, strict=True)
-    dset_chunks = dset.split(chunks=max_total_nchunks, barcodes=True)
+    dset_chunks = None
+    if split_index_dir is not None:
+        dset = dataset_type(dataset_path, strict=True, skipCounts=True)
+        dset_chunks = split_barcodes_with_index(dset, max_total_nchunks,
+                                                 split_index_dir)
+    if dset_chunks is None:
+        dset = dataset_type(dataset_path, strict=True)
+        dset_chunks = dset.split(chunks=max_total_nchunks, barcodes=True)
     d = {}
     for i, dset in enumerate(dset_chunks):
         chunk_id = '_'.join([base_name, str(i)])
@@ -404,7 +458,8 @@ to_barcode_chunked_ccsset_files = functools.partial(
 def _write_dataset_barcode_chunks_to_file(chunk_func, chunk_key, chunk_file,
                                           dataset_path, max_total_chunks,
                                           dir_name, chunk_base_name,
-                                          chunk_ext, extra_chunk_keys=None):
+                                          chunk_ext, extra_chunk_keys=None,
+                                          split_index_dir=None):
     """
     Similar to write_subreadset_chunks_to_file, but chunks reads (subread or
     CCS) by barcodes for input to pblaa.
@@ -416,7 +471,8 @@ def _write_dataset_barcode_chunks_to_file(chunk_func, chunk_key, chunk_file,
         dir_name=dir_name,
         base_name=chunk_base_name,
         ext=chunk_ext,
-        extra_chunk_keys=extra_chunk_keys))
+        extra_chunk_keys=extra_chunk_keys,
+        split_index_dir=split_index_dir))
     write_chunks_to_json(chunks, chunk_file)
     return 0
 
@@ -432,16 +488,25 @@ write_ccsset_barcode_chunks_to_file = functools.partial(
 def _to_zmw_chunked_dataset_files(dataset_type, dataset_path,
                                   max_total_nchunks, chunk_key, dir_name,
                                   base_name, ext, extra_chunk_keys=None,
-                                  extra_split_args=None):
+                                  extra_split_args=None,
+                                  split_index_dir=None):
     """
     Similar to to_chunked_subreadset_files, but chunks reads by ZMW ranges
-    for input to pbccs or pbtranscript.
+    for input to pbccs or pbtranscript.  If split_index_dir is specified, the
+    chunks will be planned from a cached per-ZMW index stored in that
+    directory (see split_index.py).
     """
-    dset = dataset_type(dataset_path, strict=True)
-    kwargs = {"chunks": max_total_nchunks, "zmws": True}
-    if extra_split_args is not None:
-        kwargs.update(extra_split_args)
-    dset_chunks = dset.split(**kwargs)
+    dset_chunks = None
+    if split_index_dir is not None and extra_split_args is None:
+        dset = dataset_type(dataset_path, strict=True, skipCounts=True)
+        dset_chunks = split_zmws_with_index(dset, max_total_nchunks,
+                                             split_index_dir)
+    if dset_chunks is None:
+        dset = dataset_type(dataset_path, strict=True)
+        kwargs = {"chunks": max_total_nchunks, "zmws": True}
+        if extra_split_args is not None:
+            kwargs.update(extra_split_args)
+        dset_chunks = dset.split(**kwargs)
     d = {}
     for i, dset in enumerate(dset_chunks):
         chunk_id = '_'.join([base_name, str(i)])
@@ -552,7 +617,7 @@ to_bam_chunked_subreadset_files = functools.partial(
 def _write_dataset_chunks_to_file(chunk_func, chunk_key, chunk_file,
                                   dataset_path, max_total_chunks,
                                   dir_name, chunk_base_name, chunk_ext,
-                                  extra_chunk_keys=None):
+                                  extra_chunk_keys=None, **kwds):
     """
     Similar to write_subreadset_chunks_to_file, but chunks reads (subread or
     CCS) by ZMW ranges for input to pbccs.
@@ -564,7 +629,8 @@ def _write_dataset_chunks_to_file(chunk_func, chunk_key, chunk_file,
         dir_name=dir_name,
         base_name=chunk_base_name,
         ext=chunk_ext,
-        extra_chunk_keys=extra_chunk_keys))
+        extra_chunk_keys=extra_chunk_keys,
+        **kwds))
     write_chunks_to_json(chunks, chunk_file)
     return 0
 
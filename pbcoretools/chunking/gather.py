@@ -1,15 +1,25 @@
 
 from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial as P
 from zipfile import ZipFile
+from xml.etree import ElementTree
+import collections
 import itertools
+import heapq
 import argparse
+import subprocess
 import tarfile
 import logging
 import shutil
+import errno
+import hashlib
 import json
+import gzip
 import math
+import re
 import os.path as op
+import os
 import sys
 
 from pbcommand.pb_io.common import load_pipeline_chunks_from_json
@@ -24,18 +34,31 @@ from pbcommand.utils import get_dataset_metadata
 
 from pbcore.io import (SubreadSet, ContigSet, AlignmentSet, ConsensusReadSet,
                        ConsensusAlignmentSet, TranscriptSet, TranscriptAlignmentSet)
+from pbcore.io.align.PacBioBamIndex import PbiHeaderOnly
+from pbcore.io.dataset.DataSetMembers import ExternalResources
 from pbcore.io.FastaIO import FastaReader, FastaWriter
 from pbcore.io.FastqIO import FastqReader, FastqWriter
 from pbcore.io.GffIO import merge_gffs_sorted
 from pbcore.io.VcfIO import merge_vcfs_sorted
 
-from pbcoretools.file_utils import sanitize_dataset_tags
+from pbcoretools.file_utils import sanitize_dataset_tags, merge_datasets
+from pbcoretools.pbi_utils import concatenate_bams, PbiError
+from pbcoretools.utils import JsonStreamReader
 
 log = logging.getLogger(__name__)
 
 __version__ = '1.1'
 
 
+class Constants:
+    COPY_BUFSIZE = 1024 * 1024
+    GZIP_MEMBER_SIZE = 4 * 1024 * 1024
+    GZIP_LEVEL = 6
+    # contig names as written for windows of a split contig, with a
+    # <start>_<end> suffix or a |quiver/|arrow style suffix
+    SPLIT_CONTIG_NAME = re.compile(r"(_\d+_\d+|\|.*)$")
+
+
 def _validate_chunk_json_file(path):
     chunks = load_pipeline_chunks_from_json(path)
     return path
@@ -55,29 +78,273 @@ def __gather_fastx(fastx_reader, fastx_writer, fastx_files, output_file):
         n=len(fastx_files), f=output_file, x=n))
 
 
-gather_fasta = P(__gather_fastx, FastaReader, FastaWriter)
-gather_fastq = P(__gather_fastx, FastqReader, FastqWriter)
+def _check_fastx_chunk(file_name, record_start):
+    """
+    Check that a FASTA/FASTQ chunk starts with a record, returning a tuple
+    (size, ends_with_newline).
+    """
+    size = os.path.getsize(file_name)
+    if size == 0:
+        return 0, True
+    with open(file_name, "rb") as f:
+        first = f.read(1)
+        if first != record_start:
+            raise ValueError(
+                "{f} does not start with '{c}'".format(
+                    f=file_name, c=record_start.decode("ascii")))
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+    return size, last == b"\n"
+
+
+def _copy_file_range(reader, writer):
+    """
+    Copy the remainder of reader to writer in the kernel where possible;
+    returns False if this is not supported for these files.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    writer.flush()
+    n_copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(reader.fileno(), writer.fileno(),
+                                   Constants.COPY_BUFSIZE * 64)
+        except OSError as e:
+            if n_copied == 0 and e.errno in (errno.EXDEV, errno.ENOSYS,
+                                             errno.EINVAL, errno.EOPNOTSUPP):
+                return False
+            raise
+        if n == 0:
+            return True
+        n_copied += n
+
+
+def _copy_counting_lines(reader, writer, record_start):
+    """
+    Copy reader to writer, returning (nlines, nstarts), where nstarts is the
+    number of lines starting with record_start.
+    """
+    nlines = nstarts = 0
+    prev = b"\n"
+    while True:
+        buf = reader.read(Constants.COPY_BUFSIZE)
+        if not buf:
+            break
+        writer.write(buf)
+        nlines += buf.count(b"\n")
+        nstarts += buf.count(b"\n" + record_start)
+        if prev == b"\n" and buf[0:1] == record_start:
+            nstarts += 1
+        prev = buf[-1:]
+    return nlines, nstarts
+
+
+def __gather_fastx_raw(fastx_reader, fastx_writer, record_start, fastx_files,
+                       output_file, count_records=False):
+    """
+    Concatenate FASTA/FASTQ chunks without parsing the records.  Each chunk
+    is only checked to start with a record and end with a newline (which is
+    added if missing).  If count_records is True, the number of records is
+    counted with a scan of the copied bytes (FASTQ is assumed to have four
+    lines per record).  Compressed inputs fall back on record-level gather.
+    """
+    if any(fn.endswith(".gz") for fn in fastx_files + [output_file]):
+        return __gather_fastx(fastx_reader, fastx_writer, fastx_files,
+                              output_file)
+    nbytes = n = 0
+    with open(output_file, "wb") as writer:
+        for fastx_file in fastx_files:
+            size, ends_with_newline = _check_fastx_chunk(fastx_file,
+                                                         record_start)
+            if size == 0:
+                continue
+            with open(fastx_file, "rb") as reader:
+                if count_records:
+                    nlines, nstarts = _copy_counting_lines(reader, writer,
+                                                           record_start)
+                    if record_start == b"@":
+                        n += (nlines + (0 if ends_with_newline else 1)) // 4
+                    else:
+                        n += nstarts
+                elif not _copy_file_range(reader, writer):
+                    shutil.copyfileobj(reader, writer, Constants.COPY_BUFSIZE)
+            if not ends_with_newline:
+                writer.write(b"\n")
+            nbytes += size
+
+    if count_records:
+        log.info("Completed gathering {n} files (with {x} records) to {f}".format(
+            n=len(fastx_files), f=output_file, x=n))
+    else:
+        log.info("Completed gathering {n} files ({b} bytes) to {f}".format(
+            n=len(fastx_files), f=output_file, b=nbytes))
+
+
+gather_fasta = P(__gather_fastx_raw, FastaReader, FastaWriter, b">")
+gather_fastq = P(__gather_fastx_raw, FastqReader, FastqWriter, b"@")
+gather_fasta_records = P(__gather_fastx, FastaReader, FastaWriter)
+gather_fastq_records = P(__gather_fastx, FastqReader, FastqWriter)
 gather_gff = merge_gffs_sorted
 gather_vcf = merge_vcfs_sorted
 
 
+def _copy_body(reader, writer):
+    """
+    Copy the remainder of a binary file handle to the output verbatim,
+    making sure that the output ends with a newline.  Returns False if
+    nothing was copied.
+    """
+    start = reader.tell()
+    shutil.copyfileobj(reader, writer, Constants.COPY_BUFSIZE)
+    end = reader.tell()
+    if end == start:
+        return False
+    reader.seek(end - 1)
+    if reader.read(1) != b"\n":
+        writer.write(b"\n")
+    return True
+
+
+def _read_txt_header(reader):
+    """
+    Consume the leading '#' header lines (and blank lines) of a binary
+    text file handle, returning (header_lines, first_body_line).
+    """
+    header = []
+    for l in iter(reader.readline, b""):
+        if len(l.strip()) == 0:
+            continue
+        elif l.startswith(b"#"):
+            header.append(l)
+        else:
+            return header, l
+    return header, None
+
+
+def _ensure_newline(l):
+    return l if l.endswith(b"\n") else l + b"\n"
+
+
 def cat_txt_with_header(input_files, output_file):
     """ Concatenate input files i_fns, to output file.
     Only copy header lines from the very first input file, and skip others.
+    The leading header lines are parsed; the rest of each file is copied
+    verbatim.
     """
-    with open(output_file, 'w') as writer:
+    with open(output_file, 'wb') as writer:
         for i, input_file in enumerate(input_files):
-            with open(input_file, 'r') as reader:
-                for l in reader:
-                    if len(l.strip()) == 0:
-                        continue
-                    if (i == 0 or not l.startswith('#')):
-                        writer.write(l.strip()+"\n")
+            with open(input_file, 'rb') as reader:
+                header, first = _read_txt_header(reader)
+                if i == 0:
+                    writer.writelines(_ensure_newline(l) for l in header)
+                if first is not None:
+                    writer.write(_ensure_newline(first))
+                    _copy_body(reader, writer)
 
 
 gather_bed = cat_txt_with_header
 
 
+def _iter_txt_records(input_file):
+    with open(input_file, 'rb') as reader:
+        header, first = _read_txt_header(reader)
+        if first is not None:
+            yield _ensure_newline(first)
+            for l in reader:
+                if len(l.strip()) > 0 and not l.startswith(b"#"):
+                    yield _ensure_newline(l)
+
+
+def _iter_sorted_records(records, key, i, input_file):
+    last = None
+    for line in records:
+        k = key(line)
+        if last is not None and k < last:
+            raise ValueError("{f} is not sorted: {l}".format(
+                f=input_file, l=line.decode("utf-8", "replace").rstrip()))
+        last = k
+        yield k, i, line
+
+
+def _chrom_sort_key(chrom):
+    # natural order, i.e. chr2 < chr10
+    return [int(t) if t.isdigit() else t for t in re.split(rb"(\d+)", chrom)]
+
+
+def _iter_bed_blocks(input_file, i):
+    """
+    Yield (chrom, records) for each block of consecutive records on the
+    same chromosome, with records as (start, end, i, line) tuples that are
+    checked to be sorted.
+    """
+    def _parse(line):
+        fields = line.split(b"\t", 3)
+        return fields[0].strip(), int(fields[1]), int(fields[2]), i, line
+
+    def _check_sorted(block):
+        last = None
+        for record in block:
+            k = record[1:3]
+            if last is not None and k < last:
+                raise ValueError("{f} is not sorted: {l}".format(
+                    f=input_file,
+                    l=record[4].decode("utf-8", "replace").rstrip()))
+            last = k
+            yield record[1:]
+    records = (_parse(line) for line in _iter_txt_records(input_file))
+    for chrom, block in itertools.groupby(records, key=lambda r: r[0]):
+        yield chrom, _check_sorted(block)
+
+
+def gather_bed_sorted(input_files, output_file):
+    """
+    Merge BED files that are each sorted by chromosome, start and end, in a
+    single pass over the inputs.  Chromosomes are in reference order, not
+    lexicographic, so their order is learned during the merge: the next
+    chromosome is the one at the head of an input that was seen first,
+    with chromosomes first seen at the same time taken in natural order
+    (chr2 before chr10).  This is the BED equivalent of
+    merge_gffs_sorted/merge_vcfs_sorted.  Raises ValueError if an input is
+    not sorted, or lists a chromosome that was already merged (i.e. the
+    inputs do not agree on the chromosome order).
+    """
+    with open(input_files[0], 'rb') as reader:
+        header, _ = _read_txt_header(reader)
+    blocks = [_iter_bed_blocks(fn, i) for i, fn in enumerate(input_files)]
+    heads = [next(b, None) for b in blocks]
+    ranks = {}
+    done = set()
+    n_merged = 0
+
+    def _add_ranks(chroms):
+        for chrom in sorted(set(chroms) - set(ranks), key=_chrom_sort_key):
+            ranks[chrom] = (n_merged, _chrom_sort_key(chrom))
+
+    _add_ranks(h[0] for h in heads if h is not None)
+    with open(output_file, 'wb') as writer:
+        writer.writelines(_ensure_newline(l) for l in header)
+        while any(h is not None for h in heads):
+            chrom = min((h[0] for h in heads if h is not None),
+                        key=lambda c: ranks[c])
+            active = [i for i, h in enumerate(heads)
+                      if h is not None and h[0] == chrom]
+            # records with equal keys are kept in input order
+            merged = heapq.merge(*[heads[i][1] for i in active])
+            writer.writelines(r[3] for r in merged)
+            done.add(chrom)
+            n_merged += 1
+            for i in active:
+                heads[i] = next(blocks[i], None)
+                if heads[i] is not None and heads[i][0] in done:
+                    raise ValueError(
+                        "{f} lists chromosome {c} out of order".format(
+                            f=input_files[i],
+                            c=heads[i][0].decode("utf-8", "replace")))
+            _add_ranks(heads[i][0] for i in active if heads[i] is not None)
+    return output_file
+
+
 def _read_header(csv_file):
     with open(csv_file, 'r') as f:
         header = f.readline()
@@ -144,19 +411,18 @@ def gather_csv(csv_files, output_file, skip_empty=True):
     header = _read_header(csv_files[0])
     #nfields = 0 if header is None else len(header)
 
-    with open(output_file, 'w') as writer:
+    with open(output_file, 'wb') as writer:
         if header is not None:
-            writer.write(",".join(header) + "\n")
+            writer.write(",".join(header).encode("utf-8") + b"\n")
         for csv_file in csv_files:
-            if not _csv_is_empty(csv_file):
-                header = _read_header(csv_file)
+            if skip_empty and _csv_is_empty(csv_file):
+                continue
+            with open(csv_file, 'rb') as f:
+                # skip header
+                _ = f.readline()
                 # should do a comparison of the headers to make sure they
                 # have the same number of fields
-                with open(csv_file, 'r') as f:
-                    # skip header
-                    _ = f.readline()
-                    for record in f:
-                        writer.write(record)
+                _copy_body(f, writer)
 
     log.info("successfully merged {n} files to {f}".format(
         n=len(csv_files), f=output_file))
@@ -164,6 +430,57 @@ def gather_csv(csv_files, output_file, skip_empty=True):
     return output_file
 
 
+def _maybe_number(value):
+    try:
+        return (0, float(value), "")
+    except ValueError:
+        return (1, 0, value)
+
+
+def csv_sort_key(header, columns):
+    """
+    Return a sort key function for raw CSV lines, ordering records by the
+    named columns.  Numeric values are compared as numbers.  This does not
+    handle quoted fields containing commas.
+    """
+    indices = [header.index(c) for c in columns]
+
+    def _key(line):
+        fields = line.rstrip(b"\r\n").split(b",")
+        return tuple(_maybe_number(fields[i].decode("utf-8")) for i in indices)
+    return _key
+
+
+def gather_csv_sorted(csv_files, output_file, sort_columns):
+    """
+    Streaming k-way merge of CSV files which are already sorted by the
+    specified columns.  Empty files are skipped.  Raises ValueError if an
+    input is not sorted.
+    """
+    header = _read_header(csv_files[0])
+    if header is None:
+        raise ValueError("Can't sort CSV files without a header")
+    key = csv_sort_key(header, sort_columns)
+
+    def _iter_records(csv_file):
+        with open(csv_file, 'rb') as f:
+            _ = f.readline()
+            for l in f:
+                if len(l.strip()) > 0:
+                    yield _ensure_newline(l)
+
+    with open(output_file, 'wb') as writer:
+        writer.write(",".join(header).encode("utf-8") + b"\n")
+        # records with equal keys are kept in input order
+        merged = heapq.merge(*[
+            _iter_sorted_records(_iter_records(fn), key, i, fn)
+            for i, fn in enumerate(csv_files)])
+        writer.writelines(line for _, _, line in merged)
+    log.info("successfully merged {n} files to {f}".format(
+        n=len(csv_files), f=output_file))
+    return output_file
+
+
 def gather_report(json_files, output_file, dataset_xml=None):
     """
     Combines statistics (usually raw counts) stored as JSON files.
@@ -225,32 +542,133 @@ def gather_datastore(input_files, output_file, skip_empty=True):
     ds.write_json(output_file)
 
 
+def _get_dataset_resource_files(file_name):
+    """
+    Return the paths of the ExternalResource files in a dataset XML, parsing
+    only those elements (without instantiating a pbcore dataset).
+    """
+    base_dir = op.dirname(op.abspath(file_name))
+    resources = []
+    for _, elem in ElementTree.iterparse(file_name):
+        if elem.tag.split("}")[-1] == "ExternalResource":
+            resource_id = elem.get("ResourceId")
+            if resource_id is not None:
+                if resource_id.startswith("file://"):
+                    resource_id = resource_id[7:]
+                resource = op.join(base_dir, resource_id)
+                # subdatasets repeat the resources of the parent
+                if not resource in resources:
+                    resources.append(resource)
+    return resources
+
+
+def _contigset_is_empty(file_name):
+    """
+    Check whether a ContigSet XML has no resources, or only empty ones.
+    Non-XML inputs (i.e. FASTA files) are never considered empty.
+    """
+    if not file_name.endswith(".xml"):
+        return False
+    for resource in _get_dataset_resource_files(file_name):
+        if not op.isfile(resource) or op.getsize(resource) > 0:
+            return False
+    return True
+
+
+def _concatenate_fasta_with_fai(fasta_files, output_file):
+    """
+    Concatenate FASTA files by raw copy, and write the .fai for the result by
+    shifting the offsets in each input's .fai (running samtools faidx only
+    if an input index is missing).
+    """
+    gather_fasta(fasta_files, output_file)
+    fai_files = [fn + ".fai" for fn in fasta_files]
+    if not all(op.isfile(fn) for fn in fai_files):
+        subprocess.check_call(["samtools", "faidx", output_file])
+        return output_file
+    offset = 0
+    with open(output_file + ".fai", "w") as fai_out:
+        for fasta_file, fai_file in zip(fasta_files, fai_files):
+            with open(fai_file) as fai_in:
+                for line in fai_in:
+                    fields = line.rstrip("\n").split("\t")
+                    fields[2] = str(int(fields[2]) + offset)
+                    fai_out.write("\t".join(fields) + "\n")
+            size, ends_with_newline = _check_fastx_chunk(fasta_file, b">")
+            offset += size + (0 if ends_with_newline else 1)
+    return output_file
+
+
+def _iter_fasta_names(fasta_file):
+    """
+    Yield the contig names of a FASTA file, from its .fai if present and
+    otherwise from the header lines.
+    """
+    if op.isfile(fasta_file + ".fai"):
+        with open(fasta_file + ".fai") as fai_in:
+            for line in fai_in:
+                yield line.split("\t")[0]
+    else:
+        with open(fasta_file, "rb") as fasta_in:
+            for line in fasta_in:
+                if line.startswith(b">"):
+                    yield line[1:].split()[0].decode("utf-8")
+
+
+def _has_split_contigs(fasta_files):
+    """
+    Check whether any contig name looks like a window of a split contig,
+    which ContigSet.consolidate would need to join.
+    """
+    for fasta_file in fasta_files:
+        for name in _iter_fasta_names(fasta_file):
+            if Constants.SPLIT_CONTIG_NAME.search(name):
+                return True
+    return False
+
+
 def __gather_contigset(resource_file_extension, input_files, output_file,
                        new_resource_file=None,
-                       skip_empty=True):
+                       skip_empty=True,
+                       join_contigs=True):
     """
     :param input_files: List of file paths
     :param output_file: File Path
     :param new_resource_file: the path of the file to which the other contig
                               files are consolidated
-    :param skip_empty: Ignore empty files (doesn't do much yet)
+    :param skip_empty: Ignore inputs without non-empty resources (checked
+                       by reading only the ExternalResource elements)
+    :param join_contigs: Use ContigSet.consolidate, which joins contigs that
+                         were split into windows; if False, or if no contig
+                         name looks like a window, the FASTA files are simply
+                         concatenated
 
     :return: Output file
 
     :rtype: str
     """
     if skip_empty:
-        _input_files = []
-        for file_name in input_files:
-            cs = ContigSet(file_name)
-            if len(cs.toExternalFiles()) > 0:
-                _input_files.append(file_name)
-        input_files = _input_files
-    tbr = ContigSet(*input_files)
+        input_files = [file_name for file_name in input_files
+                       if not _contigset_is_empty(file_name)]
     if not new_resource_file:
         if output_file.endswith('xml'):
             new_resource_file = output_file[:-3] + resource_file_extension
-    tbr.consolidate(new_resource_file)
+    fasta_files = [fn for file_name in input_files
+                   for fn in (_get_dataset_resource_files(file_name)
+                              if file_name.endswith(".xml")
+                              else [file_name])]
+    if resource_file_extension != "fasta" or (
+            join_contigs and _has_split_contigs(fasta_files)):
+        tbr = ContigSet(*input_files)
+        tbr.consolidate(new_resource_file)
+    else:
+        tbr = merge_datasets(input_files, dataset_type=ContigSet,
+                             skip_counts=True)
+        _concatenate_fasta_with_fai(fasta_files, new_resource_file)
+        tbr.close()
+        tbr.externalResources = ExternalResources()
+        tbr.addExternalResources([new_resource_file])
+        tbr.induceIndices()
     tbr.newUuid()
     sanitize_dataset_tags(tbr)
     tbr.write(output_file)
@@ -260,13 +678,17 @@ def __gather_contigset(resource_file_extension, input_files, output_file,
 gather_contigset = P(__gather_contigset, "fasta")
 
 
-def __gather_fastx_contigset(format_type, input_files, output_file):
-    if len(input_files) == 1:
+def __gather_fastx_contigset(format_type, input_files, output_file,
+                             join_contigs=True):
+    # without joining, a single input still goes through the contigset
+    # gather so that the .fai and XML are written as for several inputs
+    if len(input_files) == 1 and join_contigs:
         shutil.copyfile(input_files[0], output_file)
     else:
         contigset_name = op.splitext(output_file)[0] + ".contigset.xml"
         __gather_contigset(format_type, input_files, contigset_name,
-                           new_resource_file=output_file)
+                           new_resource_file=output_file,
+                           join_contigs=join_contigs)
         assert op.isfile(output_file)
         return output_file
 
@@ -287,6 +709,35 @@ def _uniqueify_metadata(ds):
                 k += 1
 
 
+def _concatenate_readset_bams(ds, new_resource_file):
+    """
+    Fast path for consolidating unaligned, unfiltered chunk datasets whose
+    BAM files share the same header: the BGZF record blocks are concatenated
+    and the .pbi files merged, without decoding any records.  Returns False
+    if the dataset does not qualify.
+    """
+    if len(ds.filters) > 0:
+        return False
+    ext_resources = list(ds.externalResources)
+    if any(not ext_res.bam or not ext_res.pbi for ext_res in ext_resources):
+        return False
+    if any(PbiHeaderOnly(ext_res.pbi).hasMappingInfo for ext_res in ext_resources):
+        return False
+    try:
+        concatenate_bams([ext_res.bam for ext_res in ext_resources],
+                         new_resource_file)
+    except PbiError as e:
+        log.warning("Can't concatenate BAM files directly: %s", e)
+        return False
+    barcode_sets = {ext_res.barcodes for ext_res in ext_resources}
+    ds.close()
+    ds.externalResources = ExternalResources()
+    ds.addExternalResources([new_resource_file])
+    if len(barcode_sets) == 1:
+        ds.externalResources[0].barcodes = barcode_sets.pop()
+    return True
+
+
 def __gather_readset(dataset_type, input_files, output_file, skip_empty=True,
                      consolidate=False, consolidate_n_files=1):
     """
@@ -298,11 +749,15 @@ def __gather_readset(dataset_type, input_files, output_file, skip_empty=True,
 
     :rtype: str
     """
-    tbr = dataset_type(*input_files)
+    tbr = merge_datasets(input_files, dataset_type=dataset_type)
+    if tbr is None:
+        raise ValueError("Can't merge datasets with conflicting filters")
     _uniqueify_metadata(tbr)
     if consolidate:
         new_resource_file = output_file[:-4] + ".bam"
-        tbr.consolidate(new_resource_file, numFiles=consolidate_n_files)
+        if not (consolidate_n_files == 1 and
+                _concatenate_readset_bams(tbr, new_resource_file)):
+            tbr.consolidate(new_resource_file, numFiles=consolidate_n_files)
         tbr.induceIndices()
     tbr.newUuid()
     sanitize_dataset_tags(tbr)
@@ -318,15 +773,104 @@ gather_transcripts = P(__gather_readset, TranscriptSet)
 gather_transcript_alignmentset = P(__gather_readset, TranscriptAlignmentSet)
 
 
-def gather_tgz(input_files, output_file):
+def _get_tar_member_size(header):
+    field = header[124:136]
+    if field[0] & 0x80:
+        # GNU base-256 encoding for large files
+        return int.from_bytes(field[1:], "big")
+    return int(field.strip(b"\0 ") or b"0", 8)
+
+
+def _iter_tar_blocks(tar_in):
+    """
+    Iterate over the raw bytes (headers and padded data) of every member in
+    an uncompressed tar stream, stopping at the end-of-archive marker.
+    """
+    while True:
+        header = tar_in.read(tarfile.BLOCKSIZE)
+        if len(header) < tarfile.BLOCKSIZE or header == tarfile.NUL * tarfile.BLOCKSIZE:
+            return
+        yield header
+        size = _get_tar_member_size(header)
+        remaining = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        while remaining > 0:
+            buf = tar_in.read(min(remaining, Constants.COPY_BUFSIZE))
+            if not buf:
+                raise IOError("Unexpected end of tar archive")
+            yield buf
+            remaining -= len(buf)
+
+
+class _GzipMemberWriter:
+    """
+    Writes data as a series of independently compressed gzip members (which
+    together form a valid gzip file), optionally compressing several members
+    at once in a thread pool.  At most 2 * nproc members are held in memory.
+    """
+
+    def __init__(self, file_obj, nproc=1, member_size=None):
+        self._file_obj = file_obj
+        self._member_size = member_size
+        if member_size is None:
+            self._member_size = Constants.GZIP_MEMBER_SIZE
+        self._buffer = []
+        self._n_buffered = 0
+        self._pending = collections.deque()
+        self._nproc = nproc
+        self._executor = None
+        if nproc > 1:
+            self._executor = ThreadPoolExecutor(max_workers=nproc)
+
+    def _flush_member(self):
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._n_buffered = 0
+        if self._executor is None:
+            self._file_obj.write(gzip.compress(data, Constants.GZIP_LEVEL))
+            return
+        self._pending.append(self._executor.submit(gzip.compress, data,
+                                                   Constants.GZIP_LEVEL))
+        while len(self._pending) > 2 * self._nproc:
+            self._file_obj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._n_buffered += len(data)
+        if self._n_buffered >= self._member_size:
+            self._flush_member()
+
+    def close(self):
+        if self._n_buffered > 0:
+            self._flush_member()
+        while self._pending:
+            self._file_obj.write(self._pending.popleft().result())
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+def gather_tgz(input_files, output_file, nproc=1):
     """
     Deprecated, use ZIP files instead where possible.
+
+    Each input is decompressed once as a stream, and the raw tar blocks of
+    its members are copied to the output without parsing or re-serializing
+    them; the end-of-archive marker is written once at the end.  The output
+    is compressed as a multi-member gzip file, using nproc threads.
     """
-    with tarfile.open(output_file, mode="w:gz") as tgz_out:
+    with open(output_file, "wb") as raw_out:
+        writer = _GzipMemberWriter(raw_out, nproc=nproc)
+        n_bytes = 0
         for tgz_file in input_files:
-            with tarfile.open(tgz_file, mode="r:gz") as tgz_in:
-                for member in tgz_in.getmembers():
-                    tgz_out.addfile(member, tgz_in.extractfile(member.name))
+            with gzip.open(tgz_file, "rb") as tar_in:
+                for block in _iter_tar_blocks(tar_in):
+                    writer.write(block)
+                    n_bytes += len(block)
+        # end-of-archive marker, padded to a full record
+        eof = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        n_bytes += len(eof)
+        writer.write(eof)
+        writer.write(tarfile.NUL * (-n_bytes % tarfile.RECORDSIZE))
+        writer.close()
     return output_file
 
 
@@ -343,19 +887,34 @@ def gather_zip(input_files, output_file):
     return output_file
 
 
+def _key_digest(key):
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+
+
 def gather_json(input_files, output_file):
     """
     Gather chunked JSON dictionaries, which must have mutually non-overlapping
-    keys.  Used in minor variants analysis.
-    """
-    gathered = {}
-    for chunk_file in input_files:
-        with open(chunk_file) as json_in:
-            d = json.loads(json_in.read())
-            assert len(set(d.keys()).intersection(gathered)) == 0
-            gathered.update(d)
+    keys.  Used in minor variants analysis.  The chunks are streamed one
+    member at a time; overlapping keys are detected using 64-bit digests.
+    """
+    seen_keys = set()
     with open(output_file, "w") as json_out:
-        json_out.write(json.dumps(gathered))
+        json_out.write("{")
+        sep = ""
+        for chunk_file in input_files:
+            chunk_keys = set()
+            with open(chunk_file) as json_in:
+                reader = JsonStreamReader(json_in)
+                for key in reader.iter_object():
+                    digest = _key_digest(key)
+                    assert not digest in seen_keys, key
+                    chunk_keys.add(digest)
+                    value = reader.read_value()
+                    json_out.write(sep + json.dumps(key) + ": " +
+                                   json.dumps(value))
+                    sep = ", "
+            seen_keys.update(chunk_keys)
+        json_out.write("}")
     return output_file
 
 
@@ -0,0 +1,257 @@
+"""
+On-disk cache of the per-ZMW layout of a read dataset (SubreadSet,
+ConsensusReadSet), used to plan repeated chunking of the same dataset without
+reloading the .pbi files of every resource.
+
+The cache is a single NumPy .npy table with one row per ZMW, plus a small JSON
+sidecar listing the movie names.  It is keyed by the dataset UUID and the
+size and modification time of every BAM and .pbi resource, and is
+memory-mapped when it is reused.
+"""
+
+import hashlib
+import logging
+import json
+import os.path as op
+import os
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+ZMW_DTYPE = [
+    ("movie", "i4"),
+    ("holeNumber", "i4"),
+    ("resource", "u2"),
+    ("nrecords", "u4"),
+    ("nbases", "u8"),
+    ("bcForward", "i2"),
+    ("bcReverse", "i2"),
+    ("cumRecords", "u8"),
+    ("cumBases", "u8"),
+]
+
+
+class Constants:
+    CACHE_EXT = ".splitidx.npy"
+    MOVIES_EXT = ".splitidx.json"
+    VERSION = "1"
+
+
+def _file_signature(file_name):
+    st = os.stat(file_name)
+    return "{f}:{s}:{m}".format(f=op.abspath(file_name), s=st.st_size,
+                                m=st.st_mtime_ns)
+
+
+def get_split_index_key(ds):
+    """
+    Compute the cache key for a dataset: its UUID plus the path, size and
+    modification time of every BAM resource and its .pbi.
+    """
+    h = hashlib.sha1()
+    h.update(Constants.VERSION.encode("utf-8"))
+    h.update(ds.uuid.encode("utf-8"))
+    for ext_res in ds.externalResources:
+        for file_name in [ext_res.bam, ext_res.pbi]:
+            h.update(_file_signature(file_name).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _build_zmw_table(ds):
+    """
+    Build the per-ZMW table from the .pbi of every resource.  Returns a tuple
+    (table, movie_names), or None if the reads in a ZMW disagree about their
+    barcodes.
+    """
+    movie_names = []
+    movie_idx = {}
+    columns = {k: [] for k in ["movie", "holeNumber", "resource", "nbases",
+                               "bcForward", "bcReverse"]}
+    for i_res, rr in enumerate(ds.resourceReaders()):
+        pbi = rr.pbi
+        rg_movies = {rg.ID: rg.MovieName for rg in rr.readGroupTable}
+        qid_to_movie = {}
+        for qid in np.unique(pbi.qId):
+            movie = rg_movies[qid]
+            if not movie in movie_idx:
+                movie_idx[movie] = len(movie_names)
+                movie_names.append(movie)
+            qid_to_movie[qid] = movie_idx[movie]
+        movies = np.array([qid_to_movie[q] for q in pbi.qId], dtype=np.int32)
+        columns["movie"].append(movies)
+        columns["holeNumber"].append(np.asarray(pbi.holeNumber, dtype=np.int32))
+        columns["resource"].append(np.full(len(movies), i_res, dtype=np.uint16))
+        columns["nbases"].append(
+            np.asarray(pbi.qEnd, dtype=np.int64) - np.asarray(pbi.qStart, dtype=np.int64))
+        if pbi.hasBarcodeInfo:
+            columns["bcForward"].append(np.asarray(pbi.bcForward, dtype=np.int16))
+            columns["bcReverse"].append(np.asarray(pbi.bcReverse, dtype=np.int16))
+        else:
+            columns["bcForward"].append(np.full(len(movies), -1, dtype=np.int16))
+            columns["bcReverse"].append(np.full(len(movies), -1, dtype=np.int16))
+    rows = {k: np.concatenate(v) if len(v) > 0 else np.array([], dtype=np.int64)
+            for k, v in columns.items()}
+    n_rows = len(rows["movie"])
+    order = np.lexsort((rows["holeNumber"], rows["movie"]))
+    movies = rows["movie"][order]
+    holes = rows["holeNumber"][order]
+    is_start = np.ones(n_rows, dtype=bool)
+    is_start[1:] = (movies[1:] != movies[:-1]) | (holes[1:] != holes[:-1])
+    starts = np.flatnonzero(is_start)
+    # barcode chunking assumes every read in a ZMW has the same barcodes
+    for k in ["bcForward", "bcReverse"]:
+        col = rows[k][order]
+        if np.any(col[~is_start] != col[np.flatnonzero(~is_start) - 1]):
+            log.warning("Reads for a single ZMW have inconsistent %s", k)
+            return None
+    table = np.zeros(len(starts), dtype=ZMW_DTYPE)
+    if n_rows > 0:
+        table["movie"] = movies[starts]
+        table["holeNumber"] = holes[starts]
+        table["resource"] = rows["resource"][order][starts]
+        table["bcForward"] = rows["bcForward"][order][starts]
+        table["bcReverse"] = rows["bcReverse"][order][starts]
+        table["nrecords"] = np.diff(np.append(starts, n_rows))
+        table["nbases"] = np.add.reduceat(rows["nbases"][order], starts)
+        table["cumRecords"] = np.cumsum(table["nrecords"])
+        table["cumBases"] = np.cumsum(table["nbases"])
+    return table, movie_names
+
+
+class SplitIndex:
+    """
+    Per-ZMW table for a dataset, with methods for computing ZMW, barcode and
+    size-balanced chunk plans.
+    """
+
+    def __init__(self, table, movie_names):
+        self.table = table
+        self.movie_names = movie_names
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def nrecords(self):
+        return int(self.table["cumRecords"][-1]) if len(self) > 0 else 0
+
+    @property
+    def nbases(self):
+        return int(self.table["cumBases"][-1]) if len(self) > 0 else 0
+
+    @staticmethod
+    def from_dataset(ds, cache_dir):
+        """
+        Load the split index for ds from cache_dir, building and saving it
+        first if no current entry exists.  Returns None if the dataset can't
+        be described this way (filtered or unindexed resources, or ZMWs
+        whose reads have inconsistent barcodes).
+        """
+        if len(ds.filters) > 0:
+            log.info("Dataset is filtered, not using split index")
+            return None
+        if any(not ext_res.pbi for ext_res in ds.externalResources):
+            log.info("Dataset has unindexed resources, not using split index")
+            return None
+        key = get_split_index_key(ds)
+        table_file = op.join(cache_dir, key + Constants.CACHE_EXT)
+        movies_file = op.join(cache_dir, key + Constants.MOVIES_EXT)
+        if op.isfile(table_file) and op.isfile(movies_file):
+            log.info("Loading cached split index %s", table_file)
+            with open(movies_file) as json_in:
+                movie_names = json.load(json_in)
+            return SplitIndex(np.load(table_file, mmap_mode="r"), movie_names)
+        log.info("Building split index for %s", ds.uuid)
+        result = _build_zmw_table(ds)
+        if result is None:
+            return None
+        table, movie_names = result
+        try:
+            tmp_file = table_file + ".tmp.{p}.npy".format(p=os.getpid())
+            np.save(tmp_file, table)
+            with open(movies_file, "w") as json_out:
+                json.dump(movie_names, json_out)
+            os.replace(tmp_file, table_file)
+        except (IOError, OSError) as e:
+            log.warning("Can't write split index to %s: %s", cache_dir, e)
+        return SplitIndex(table, movie_names)
+
+    def _balanced_starts(self, nchunks, weight):
+        """
+        Return the first table row of each chunk, choosing boundaries so
+        that the named cumulative column is split as evenly as possible.
+        """
+        nchunks = max(1, min(nchunks, len(self)))
+        if weight is None:
+            bounds = np.linspace(0, len(self), nchunks + 1)[:-1]
+            return np.unique(bounds.astype(np.int64))
+        cumulative = self.table[weight]
+        preceding = np.append(0, cumulative[:-1])
+        targets = np.arange(nchunks) * (cumulative[-1] / nchunks)
+        starts = np.searchsorted(preceding, targets, side="left")
+        return np.unique(starts[starts < len(self)])
+
+    def zmw_chunks(self, nchunks, balance="zmws"):
+        """
+        Split the ZMWs into up to nchunks contiguous ranges.  Each chunk is
+        returned as a list of (movie_name, first_hole, last_hole) segments,
+        together with the number of records and bases in the chunk.
+
+        :param balance: one of 'zmws', 'records', or 'bases'
+        """
+        weight = {
+            "zmws": None,
+            "records": "cumRecords",
+            "bases": "cumBases"
+        }[balance]
+        if len(self) == 0:
+            return []
+        starts = self._balanced_starts(nchunks, weight)
+        ends = np.append(starts[1:], len(self))
+        chunks = []
+        for start, end in zip(starts, ends):
+            rows = self.table[start:end]
+            segments = []
+            movie_starts = np.flatnonzero(
+                np.append(True, rows["movie"][1:] != rows["movie"][:-1]))
+            movie_ends = np.append(movie_starts[1:], len(rows))
+            for i, j in zip(movie_starts, movie_ends):
+                segments.append((self.movie_names[rows["movie"][i]],
+                                 int(rows["holeNumber"][i]),
+                                 int(rows["holeNumber"][j - 1])))
+            chunks.append((segments,
+                           int(rows["nrecords"].sum()),
+                           int(rows["nbases"].sum())))
+        return chunks
+
+    def barcode_groups(self):
+        """
+        Return a dict of (bcForward, bcReverse) => (nrecords, nbases).
+        """
+        pairs = np.stack([self.table["bcForward"].astype(np.int32),
+                          self.table["bcReverse"].astype(np.int32)], axis=1)
+        keys, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        nrecords = np.bincount(inverse, weights=self.table["nrecords"],
+                               minlength=len(keys))
+        nbases = np.bincount(inverse, weights=self.table["nbases"],
+                             minlength=len(keys))
+        return {(int(f), int(r)): (int(n), int(b))
+                for (f, r), n, b in zip(keys, nrecords, nbases)}
+
+    def barcode_chunks(self, nchunks):
+        """
+        Group barcode pairs into up to nchunks lists, balanced by number of
+        records (largest groups are assigned first).  Each chunk is returned
+        as (list of (bcForward, bcReverse), nrecords, nbases).
+        """
+        groups = self.barcode_groups()
+        nchunks = max(1, min(nchunks, len(groups)))
+        chunks = [([], 0, 0) for _ in range(nchunks)]
+        for pair, (n, b) in sorted(groups.items(),
+                                   key=lambda kv: (-kv[1][0], kv[0])):
+            i = min(range(nchunks), key=lambda k: chunks[k][1])
+            pairs, n_, b_ = chunks[i]
+            chunks[i] = (pairs + [pair], n_ + n, b_ + b)
+        return [(sorted(pairs), n, b) for pairs, n, b in chunks if pairs]
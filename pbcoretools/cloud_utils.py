@@ -1,89 +1,202 @@
 """
 Utilities for use in running PacBio workflows on cloud services.  Currently
 this mostly deals with storage mechanisms, in particular optimizing downloads
-to local disk.
+to local disk, either by splitting BAM files at BGZF block boundaries or by
+fetching only the blocks that contain a selection of ZMWs.
 """
 
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request
 import logging
+import threading
 import math
+import io
 import os.path as op
+import os
 
-from pbcore.io import PacBioBamIndex
+import numpy as np
+
+from pbcore.io import PacBioBamIndex, openDataSet
+from pbcore.io.dataset.DataSetMembers import ExternalResources
+from pysam.libcbgzf import BGZFile  # pylint: disable=no-name-in-module
+
+from pbcoretools.pbi_utils import (BGZF_TERM, PbiError, copy_range,
+                                   get_bam_header_length, get_records_end,
+                                   read_bgzf_block, read_pbi,
+                                   write_pbi)
 
 log = logging.getLogger(__name__)
 
-# https://sourceforge.net/p/samtools/mailman/message/28413844/
-BGZF_TERM = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+class Constants:
+    HEADER_CACHE_SIZE = 16
+
+
+# shared by the threads writing chunks, see _get_header_bytes
+_header_cache = OrderedDict()
+_header_cache_lock = threading.Lock()
 
 
 def _write_bam_chunk(bam_in, bam_out, header_bytes, offset, record_n_bytes):
     bam_out.write(header_bytes)
-    bam_in.seek(offset)
-    bam_out.write(bam_in.read(record_n_bytes))
+    copy_range(bam_in, bam_out, offset, record_n_bytes)
     bam_out.write(BGZF_TERM)
 
 
+def _get_header_bytes(bam_in, header_n_bytes=None):
+    """
+    Return the first header_n_bytes (or all) bytes of an open file, reusing
+    the copy read by a previous call for the same unmodified file.
+    """
+    try:
+        st = os.fstat(bam_in.fileno())
+        key = (op.abspath(bam_in.name), st.st_size, st.st_mtime_ns,
+               header_n_bytes)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        key = None
+    if key is not None:
+        with _header_cache_lock:
+            if key in _header_cache:
+                _header_cache.move_to_end(key)
+                return _header_cache[key]
+    bam_in.seek(0)
+    if header_n_bytes is None:
+        header_bytes = bam_in.read()
+    else:
+        header_bytes = bam_in.read(header_n_bytes)
+    if key is not None:
+        with _header_cache_lock:
+            _header_cache[key] = header_bytes
+            while len(_header_cache) > Constants.HEADER_CACHE_SIZE:
+                _header_cache.popitem(last=False)
+    return header_bytes
+
+
 def extract_bam_chunk(bam_in,
                       output_file_name,
                       header_n_bytes,
                       offset,
                       record_n_bytes):
     with open(output_file_name, "wb") as bam_out:
-        bam_in.seek(0)
-        header_bytes = bam_in.read(header_n_bytes)
+        header_bytes = _get_header_bytes(bam_in, header_n_bytes)
         _write_bam_chunk(bam_in, bam_out, header_bytes, offset, record_n_bytes)
 
 
 def combine_with_header(bam_header_file, bam_chunk_file, output_file_name):
     """
     Given a header-only file and a records-only file, both extracted from a
-    complete BAM, combine them into a single file.
+    complete BAM, combine them into a single file.  The header is read once
+    and cached for subsequent chunks.
     """
     with open(output_file_name, "wb") as bam_out:
         with open(bam_header_file, "rb") as header_in:
-            bam_out.write(header_in.read())
+            bam_out.write(_get_header_bytes(header_in))
         with open(bam_chunk_file, "rb") as chunk_in:
-            def _fread():
-                return chunk_in.read(1024)
-            for chunk in iter(_fread, b''):
-                bam_out.write(chunk)
-            bam_out.write(BGZF_TERM)
+            copy_range(chunk_in, bam_out, 0, os.fstat(chunk_in.fileno()).st_size)
+        bam_out.write(BGZF_TERM)
+
+
+ZmwBorders = namedtuple("ZmwBorders", ["rows", "holeNumbers", "offsets",
+                                       "nrecords", "nzmws"])
+
+
+def get_zmw_bgzf_border_arrays(pbi):
+    """
+    Find the records that start both a new ZMW and a new BGZF block, i.e.
+    the places where a BAM file can be split by byte offset.  Returns a
+    ZmwBorders tuple of NumPy arrays: the row, hole number and compressed
+    byte offset of each border, and the number of records and ZMWs between
+    it and the next border.
+    """
+    holes = np.asarray(pbi.holeNumber)
+    byte_offsets = np.asarray(pbi.virtualFileOffset) >> 16
+    if len(holes) == 0:
+        empty = np.array([], dtype=np.int64)
+        return ZmwBorders(empty, empty, empty, empty, empty)
+    new_zmw = np.ones(len(holes), dtype=bool)
+    new_zmw[1:] = holes[1:] != holes[:-1]
+    is_border = new_zmw.copy()
+    is_border[1:] &= byte_offsets[1:] != byte_offsets[:-1]
+    rows = np.flatnonzero(is_border)
+    bounds = np.append(rows, len(holes))
+    zmw_counts = np.concatenate([[0], np.cumsum(new_zmw)])
+    return ZmwBorders(
+        rows=rows,
+        holeNumbers=holes[rows],
+        offsets=byte_offsets[rows],
+        nrecords=np.diff(bounds),
+        nzmws=np.diff(zmw_counts[bounds]))
 
 
 def get_zmw_bgzf_borders(pbi):
-    offsets = []
-    byteOffsets = pbi.virtualFileOffset >> 16
-    for i, (zmw, offset) in enumerate(zip(pbi.holeNumber, byteOffsets)):
-        if i == 0 or (zmw != pbi.holeNumber[i-1] and offset != byteOffsets[i-1]):
-            offsets.append((i, zmw, offset))
-    return offsets
+    borders = get_zmw_bgzf_border_arrays(pbi)
+    return [(int(i), int(zmw), int(offset)) for i, zmw, offset in
+            zip(borders.rows, borders.holeNumbers, borders.offsets)]
+
+
+def _group_borders(borders, starts):
+    """
+    Merge consecutive borders into chunks beginning at the given border
+    indices, summing their record and ZMW counts.
+    """
+    return ZmwBorders(
+        rows=borders.rows[starts],
+        holeNumbers=borders.holeNumbers[starts],
+        offsets=borders.offsets[starts],
+        nrecords=np.add.reduceat(borders.nrecords, starts),
+        nzmws=np.add.reduceat(borders.nzmws, starts))
+
+
+def _get_bytes_balanced_starts(offsets, records_end, nchunks):
+    """
+    Choose the borders nearest to each k/nchunks quantile of the compressed
+    record bytes.
+    """
+    targets = offsets[0] + (np.arange(nchunks) *
+                            ((records_end - offsets[0]) / nchunks))
+    right = np.clip(np.searchsorted(offsets, targets), 0, len(offsets) - 1)
+    left = np.clip(right - 1, 0, len(offsets) - 1)
+    nearest = np.where(np.abs(offsets[left] - targets) <=
+                       np.abs(offsets[right] - targets), left, right)
+    return np.unique(np.append(0, nearest))
+
 
+def get_bam_chunks(file_name, nchunks, balance="zmws"):
+    """
+    Plan the split of an indexed BAM file into up to nchunks pieces.  Returns
+    a ZmwBorders tuple with one entry per chunk.
 
-def get_bam_offsets(file_name, nchunks):
+    :param balance: 'zmws' to give each chunk roughly equal numbers of ZMW
+                    borders, or 'bytes' to balance the compressed size
+    """
     assert nchunks >= 1
+    assert balance in {"zmws", "bytes"}
     pbi_file = file_name + ".pbi"
     if not op.exists(pbi_file):
         raise IOError("BAM input must be accompanied by PacBio index (.pbi)")
     pbi = PacBioBamIndex(pbi_file)
-    header_n_bytes = pbi.virtualFileOffset[0] >> 16
-    offsets = get_zmw_bgzf_borders(pbi)
-    nchunks = min(nchunks, len(offsets))
-    per_chunk = math.ceil(len(offsets) / nchunks)
-    chunk_offsets = []
-    i = 0
-    while i < nchunks:
-        k = i * per_chunk
-        if k >= len(offsets):
-            break
-        (i_zmw, zmw, offset) = offsets[k]
-        chunk_offsets.append(offset)
-        i += 1
-    return chunk_offsets
+    borders = get_zmw_bgzf_border_arrays(pbi)
+    nchunks = min(nchunks, len(borders.rows))
+    if balance == "bytes":
+        starts = _get_bytes_balanced_starts(borders.offsets,
+                                            get_records_end(file_name),
+                                            nchunks)
+    else:
+        per_chunk = math.ceil(len(borders.rows) / nchunks)
+        starts = np.arange(0, len(borders.rows), per_chunk)[:nchunks]
+    return _group_borders(borders, starts)
 
 
-def write_bam_byte_ranges(file_name, nchunks, tsv_file="chunks.tsv"):
+def get_bam_offsets(file_name, nchunks, balance="zmws"):
+    chunks = get_bam_chunks(file_name, nchunks, balance=balance)
+    return [int(x) for x in chunks.offsets]
+
+
+def write_bam_byte_ranges(file_name, nchunks, tsv_file="chunks.tsv",
+                          balance="zmws"):
     bam_size = op.getsize(file_name)
-    offsets = get_bam_offsets(file_name, nchunks)
+    offsets = get_bam_offsets(file_name, nchunks, balance=balance)
     b_ends = [x - 1 for x in offsets[1:]] + [bam_size]
     with open(tsv_file, "wt") as tsv_out:
         tsv_out.write("start\tend\n")
@@ -91,23 +204,278 @@ def write_bam_byte_ranges(file_name, nchunks, tsv_file="chunks.tsv"):
         tsv_out.write("\n".join(ranges))
 
 
-def split_bam(file_name, nchunks, prefix="reads"):
+def _write_bam_chunk_file(file_name, output_file_name, header_bytes, offset,
+                          record_n_bytes, pbi=None):
+    with open(file_name, "rb") as bam_in:
+        with open(output_file_name, "wb") as bam_out:
+            _write_bam_chunk(bam_in, bam_out, header_bytes, offset,
+                             record_n_bytes)
+    if pbi is not None:
+        write_pbi(pbi, output_file_name + ".pbi")
+    return output_file_name
+
+
+def split_bam(file_name, nchunks, prefix="reads", nproc=1, write_pbis=True,
+              balance="zmws"):
     """
     Given a BAM file name and target number of chunks, write out up to nchunks
-    BAM files, each split at a ZMW boundary.
+    BAM files, each split at a ZMW boundary.  Chunks are copied in bounded
+    blocks and written concurrently by nproc threads; if write_pbis is True,
+    each chunk is accompanied by the corresponding slice of the input .pbi.
+    The balance argument is passed to get_bam_chunks.
     """
-    bam_size = op.getsize(file_name)
-    offsets = get_bam_offsets(file_name, nchunks)
+    records_end = get_records_end(file_name)
+    chunks = get_bam_chunks(file_name, nchunks, balance=balance)
+    offsets = [int(x) for x in chunks.offsets]
     header_n_bytes = offsets[0]
+    ends = offsets[1:] + [records_end]
     log.info("Output will be split into {n} chunks".format(n=len(offsets)))
     with open(file_name, "rb") as bam_in:
+        header_bytes = bam_in.read(header_n_bytes)
+    pbis = [None] * len(offsets)
+    if write_pbis:
+        pbi = read_pbi(file_name + ".pbi")
+        rows = np.append(chunks.rows, len(pbi))
         for i, offset in enumerate(offsets):
-            if i < len(offsets) - 1:
-                record_n_bytes = offsets[i+1] - offset
-            else:
-                record_n_bytes = bam_size - offset
+            pbis[i] = pbi.slice(rows[i], rows[i+1])
+            pbis[i].shift_offsets(header_n_bytes - offset)
+    with ThreadPoolExecutor(max_workers=max(1, nproc)) as executor:
+        futures = []
+        for i, (offset, end) in enumerate(zip(offsets, ends)):
             bam_out = "{p}.chunk{i}.bam".format(p=prefix, i=i)
             log.info("Writing chunk {i} to {f}".format(i=i, f=bam_out))
-            extract_bam_chunk(bam_in, bam_out, header_n_bytes,
-                              offset, record_n_bytes)
+            futures.append(executor.submit(_write_bam_chunk_file, file_name,
+                                           bam_out, header_bytes, offset,
+                                           end - offset, pbis[i]))
+        for future in futures:
+            future.result()
     return len(offsets)
+
+
+class LocalFileTransport:
+    """
+    Byte-range access to a local file.  Any object with the same read_range
+    and get_size methods (e.g. a wrapper around an object store client) can
+    be used as a transport by fetch_ranged_reads.
+    """
+
+    def __init__(self, file_name):
+        self.uri = file_name
+
+    def read_range(self, start, end):
+        with open(self.uri, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def get_size(self):
+        return op.getsize(self.uri)
+
+
+class HttpRangeTransport:
+    """
+    Byte-range access to a file served over HTTP(S), using Range requests.
+    """
+
+    def __init__(self, url, timeout=60):
+        self.uri = url
+        self.timeout = timeout
+
+    def read_range(self, start, end):
+        req = urllib.request.Request(
+            self.uri, headers={"Range": "bytes={s}-{e}".format(s=start, e=end - 1)})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            # a server that ignores the Range header sends the entire object,
+            # so give up before reading the body unless that is all we want
+            if resp.status != 206:
+                length = resp.headers.get("Content-Length")
+                if start > 0 or length is None or int(length) != end - start:
+                    raise IOError("Server does not support range requests for {u}".format(
+                        u=self.uri))
+            data = resp.read()
+        if len(data) != end - start:
+            raise IOError("Short read from {u}".format(u=self.uri))
+        return data
+
+    def get_size(self):
+        req = urllib.request.Request(self.uri, method="HEAD")
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return int(resp.headers["Content-Length"])
+
+
+def get_transport(uri):
+    if uri.startswith("http://") or uri.startswith("https://"):
+        return HttpRangeTransport(uri)
+    if uri.startswith("file://"):
+        uri = uri[7:]
+    return LocalFileTransport(uri)
+
+
+def select_pbi_rows(pbi, zmws=None, barcodes=None):
+    """
+    Return the indices of records whose hole number is in zmws and whose
+    (bcForward, bcReverse) pair is in barcodes (either may be None to
+    select everything).
+    """
+    keep = np.ones(len(pbi), dtype=bool)
+    if zmws is not None:
+        keep &= np.isin(pbi.holeNumber, np.asarray(list(zmws)))
+    if barcodes is not None:
+        if not pbi.hasBarcodeInfo:
+            raise PbiError("Index has no barcode information")
+        pairs = set((int(f), int(r)) for f, r in barcodes)
+        keep &= np.array([(int(f), int(r)) in pairs for f, r in
+                          zip(pbi.bcForward, pbi.bcReverse)], dtype=bool)
+    return np.flatnonzero(keep)
+
+
+def plan_byte_ranges(pbi, rows, records_end, max_gap=0):
+    """
+    Compute the minimal list of (start, end) compressed byte ranges of a
+    BAM file that contain the records at the given index rows.  A record
+    ends where the next record in the file starts, so its range extends to
+    the end of the BGZF block holding that position; ranges separated by
+    at most max_gap bytes are merged.
+    """
+    if len(rows) == 0:
+        return []
+    block_offsets = np.asarray(pbi.virtualFileOffset) >> 16
+    blocks = np.unique(np.append(block_offsets, records_end))
+    rows = np.asarray(rows)
+    starts = block_offsets[rows]
+    next_rows = rows + 1
+    has_next = next_rows < len(pbi)
+    next_blocks = block_offsets[np.minimum(next_rows, len(pbi) - 1)]
+    # the block after the one where the next record starts
+    after = np.searchsorted(blocks, next_blocks, side="right")
+    ends = np.where(has_next, blocks[np.minimum(after, len(blocks) - 1)],
+                    records_end)
+    ranges = []
+    for start, end in zip(starts, ends):
+        if ranges and start - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = max(ranges[-1][1], int(end))
+        else:
+            ranges.append([int(start), int(end)])
+    return [tuple(r) for r in ranges]
+
+
+def _get_remote_records_end(transport):
+    size = transport.get_size()
+    if size >= len(BGZF_TERM):
+        if transport.read_range(size - len(BGZF_TERM), size) == BGZF_TERM:
+            return size - len(BGZF_TERM)
+    return size
+
+
+def _decompress_range(data, start):
+    """
+    Decompress the BGZF blocks in data (which starts at compressed offset
+    start), returning (uncompressed_bytes, {block offset: position}).
+    """
+    f = io.BytesIO(data)
+    positions = {}
+    chunks = []
+    n_bytes = 0
+    offset = start
+    while True:
+        positions[offset] = n_bytes
+        block = read_bgzf_block(f)
+        if block is None:
+            break
+        offset += block[0]
+        chunks.append(block[1])
+        n_bytes += len(block[1])
+    return b"".join(chunks), positions
+
+
+def fetch_ranged_reads(bam_uri, output_file, zmws=None, barcodes=None,
+                       max_gap=65536, nproc=4, transport=None):
+    """
+    Write a local BAM file (and .pbi) containing only the records of a
+    possibly remote indexed BAM file that match the ZMW and/or barcode
+    selection, fetching only the BGZF blocks that hold them.  Up to nproc
+    byte ranges are requested concurrently.  Returns the number of records
+    written.
+    """
+    if transport is None:
+        transport = get_transport(bam_uri)
+    pbi_transport = get_transport(transport.uri + ".pbi")
+    pbi = read_pbi(io.BytesIO(
+        pbi_transport.read_range(0, pbi_transport.get_size())))
+    records_end = _get_remote_records_end(transport)
+    rows = select_pbi_rows(pbi, zmws=zmws, barcodes=barcodes)
+    ranges = plan_byte_ranges(pbi, rows, records_end, max_gap=max_gap)
+    log.info("Fetching {n} records in {r} byte ranges ({b} bytes) from {u}".format(
+        n=len(rows), r=len(ranges), b=sum(e - s for s, e in ranges),
+        u=transport.uri))
+    vfo = np.asarray(pbi.virtualFileOffset)
+    header_end = int(vfo[0] >> 16) if len(pbi) > 0 else records_end
+    header_data, _ = _decompress_range(transport.read_range(0, header_end), 0)
+    if get_bam_header_length(header_data) != len(header_data):
+        raise PbiError("BAM header of {u} does not end on a BGZF block boundary".format(
+            u=transport.uri))
+    new_offsets = np.zeros(len(rows), dtype=np.int64)
+    # index of the first selected row in each range
+    range_rows = np.searchsorted(vfo[rows] >> 16,
+                                 [start for start, _ in ranges])
+    range_rows = np.append(range_rows, len(rows))
+    with BGZFile(output_file, "wb") as bam_out:
+        bam_out.write(header_data)
+        bam_out.flush()
+        with ThreadPoolExecutor(max_workers=max(1, nproc)) as executor:
+            pending = deque()
+            def _write_range(i_range):
+                start, end = ranges[i_range]
+                data, positions = _decompress_range(pending.popleft().result(),
+                                                    start)
+                for k in range(range_rows[i_range], range_rows[i_range + 1]):
+                    row = rows[k]
+                    rec_start = positions[int(vfo[row] >> 16)] + int(vfo[row] & 0xffff)
+                    if row + 1 < len(pbi):
+                        rec_end = positions[int(vfo[row + 1] >> 16)] + \
+                            int(vfo[row + 1] & 0xffff)
+                    else:
+                        rec_end = len(data)
+                    new_offsets[k] = bam_out.tell()
+                    bam_out.write(data[rec_start:rec_end])
+            n_written = 0
+            for i_range, (start, end) in enumerate(ranges):
+                pending.append(executor.submit(transport.read_range, start, end))
+                if len(pending) > 2 * nproc:
+                    _write_range(n_written)
+                    n_written += 1
+            while n_written < len(ranges):
+                _write_range(n_written)
+                n_written += 1
+    new_pbi = pbi.take(rows)
+    new_pbi.columns["virtualFileOffset"] = new_offsets
+    write_pbi(new_pbi, output_file + ".pbi")
+    return len(rows)
+
+
+def fetch_dataset_reads(dataset_file, output_file, zmws=None, barcodes=None,
+                        max_gap=65536, nproc=4):
+    """
+    Apply fetch_ranged_reads to every BAM resource of a dataset, and write a
+    copy of the dataset XML (keeping its metadata and filters) whose
+    resources are the local BAM files, with the record counts updated.
+    """
+    ds = openDataSet(dataset_file, strict=False, skipCounts=True)
+    prefix = op.splitext(output_file)[0]
+    if prefix.endswith("set"):
+        prefix = op.splitext(prefix)[0]
+    bam_files = []
+    for i, ext_res in enumerate(ds.externalResources):
+        bam_file = "{p}.{i}.bam".format(p=prefix, i=i)
+        fetch_ranged_reads(ext_res.resourceId, bam_file, zmws=zmws,
+                           barcodes=barcodes, max_gap=max_gap, nproc=nproc)
+        bam_files.append(bam_file)
+    ds.close()
+    ds.externalResources = ExternalResources()
+    ds.addExternalResources(bam_files)
+    ds.induceIndices()
+    ds.subdatasets = []
+    ds.newUuid()
+    ds.updateCounts()
+    ds.write(output_file)
+    return output_file
+
@@ -22,6 +22,9 @@ from pbcore.io import (SubreadSet, FastqReader, FastqWriter, BarcodeSet,
 from pbcore.io.dataset.DataSetUtils import loadMockCollectionMetadata
 from pbcommand.models import FileTypes, DataStore
 
+from pbcoretools.pbi_utils import (read_pbi_header, get_pbi_total_length,
+                                   Constants as PbiConstants)
+
 log = logging.getLogger(__name__)
 
 
@@ -361,6 +364,163 @@ def uniqueify_collections(metadata):
         metadata.collections.pop(k)
 
 
+def _merge_datasets_pairwise(datasets):
+    """
+    Merge a list of datasets as a balanced binary tree, so that each level
+    only copies the combined metadata once.  Returns None if any merge fails
+    (usually due to conflicting filters).
+
+    DataSet.__add__ is the only merge pbcore provides (it checks filter
+    compatibility and merges resources, collections and subdatasets), and it
+    always copies its left operand, so a linear fold would copy the growing
+    result once per input; the tree bounds this at log2(n) copies per input.
+    A single pass would mean re-implementing those merge rules here on the
+    XML elements, outside of pbcore.
+    """
+    while len(datasets) > 1:
+        merged = []
+        for i in range(0, len(datasets) - 1, 2):
+            ds = datasets[i] + datasets[i + 1]
+            if ds is None:
+                return None
+            merged.append(ds)
+        if len(datasets) % 2 == 1:
+            merged.append(datasets[-1])
+        datasets = merged
+    return datasets[0]
+
+
+def _get_pbi_counts(pbi_file):
+    """
+    Return (n_reads, total bases) from an unmapped .pbi, or None if the
+    index has mapping information (whose lengths are counted from the
+    alignments instead).
+    """
+    _, flags, _ = read_pbi_header(pbi_file)
+    if flags & PbiConstants.PBI_FLAG_MAPPED:
+        return None
+    return get_pbi_total_length(pbi_file)
+
+
+def _get_fai_counts(fai_file):
+    """
+    Return (n_records, total bases) from a FASTA .fai index.
+    """
+    n_records = total_length = 0
+    with open(fai_file) as f:
+        for line in f:
+            n_records += 1
+            total_length += int(line.split("\t")[1])
+    return n_records, total_length
+
+
+def _get_index_counts(ds):
+    """
+    Return {resource path: (numRecords, totalLength)} read from the .pbi or
+    .fai index of each external resource, with None for any resource that
+    has no usable index.
+    """
+    counts = {}
+    for ext_res in ds.externalResources:
+        resource = ext_res.resourceId
+        if resource.endswith(".bam"):
+            pbi_file = ext_res.pbi
+            if pbi_file is not None and op.exists(pbi_file):
+                counts[resource] = _get_pbi_counts(pbi_file)
+            else:
+                counts[resource] = None
+        elif op.exists(resource + ".fai"):
+            counts[resource] = _get_fai_counts(resource + ".fai")
+        else:
+            counts[resource] = None
+    return counts
+
+
+def _get_cached_counts(ds):
+    """
+    Return (resource counts, is_filtered) for a dataset, with the counts
+    taken from the resource indices (see _get_index_counts).
+    """
+    return _get_index_counts(ds), len(ds.filters) > 0
+
+
+def _merge_dataset_group(file_names, strict, dataset_type, skip_counts=False,
+                         tmp_dir=None):
+    datasets = [dataset_type(fn, strict=strict, skipCounts=True)
+                for fn in file_names]
+    counts = [] if skip_counts else [_get_cached_counts(ds) for ds in datasets]
+    merged = _merge_datasets_pairwise(datasets)
+    if merged is None or tmp_dir is None:
+        return merged, counts
+    xml_file = tempfile.NamedTemporaryFile(suffix=".xml", dir=tmp_dir,
+                                           delete=False).name
+    merged.write(xml_file, validate=False, relPaths=False)
+    return xml_file, counts
+
+
+def merge_datasets(file_names,
+                   dataset_type=openDataSet,
+                   strict=False,
+                   skip_counts=False,
+                   nproc=1):
+    """
+    Merge dataset XML files without reloading any indices during the merge.
+    With nproc > 1 the inputs are split into groups which are merged in
+    parallel and written to temporary XML files, which are then merged in
+    turn.  If no input is filtered, the record counts are summed over the
+    distinct resources from the .pbi headers (or .fai indices); they are only
+    recomputed with updateCounts when a resource has no usable index.
+
+    :return: the merged dataset, or None if the merge failed due to
+             conflicting filters
+    """
+    nproc = max(1, min(nproc, len(file_names) // 2))
+    if nproc == 1:
+        merged, counts = _merge_dataset_group(file_names, strict, dataset_type,
+                                              skip_counts)
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        pool = multiprocessing.Pool(nproc)
+        try:
+            _results = []
+            group_size = -(-len(file_names) // nproc)
+            for i in range(0, len(file_names), group_size):
+                _results.append(
+                    pool.apply_async(_merge_dataset_group,
+                                     (file_names[i:i + group_size],
+                                      strict,
+                                      dataset_type,
+                                      skip_counts,
+                                      tmp_dir)))
+            pool.close()
+            results = [r.get() for r in _results]
+            counts = [c for _, group_counts in results for c in group_counts]
+            if any(xml_file is None for xml_file, _ in results):
+                merged = None
+            else:
+                merged = _merge_datasets_pairwise(
+                    [dataset_type(xml_file, strict=strict, skipCounts=True)
+                     for xml_file, _ in results])
+        finally:
+            pool.terminate()
+            shutil.rmtree(tmp_dir)
+    if merged is None or skip_counts:
+        return merged
+    resource_counts = {}
+    for group_counts, _ in counts:
+        resource_counts.update(group_counts)
+    if (any(is_filtered for _, is_filtered in counts) or
+            len(merged.filters) > 0 or
+            any(c is None for c in resource_counts.values())):
+        merged.updateCounts()
+    else:
+        merged.metadata.numRecords = sum(
+            c[0] for c in resource_counts.values())
+        merged.metadata.totalLength = sum(
+            c[1] for c in resource_counts.values())
+    return merged
+
+
 # XXX this is a separate function to enable mocking using non-barcoded BAMs
 def _update_barcoded_dataset(
         dataset,
@@ -0,0 +1,490 @@
+"""
+Utilities for manipulating BAM files and their PacBio indices (.pbi) without
+decoding the records.  BAM files written by htslib or pbbam end the header on
+a BGZF block boundary, so the record blocks of several files with the same
+header can be concatenated directly, or given a new header, and the .pbi of
+the result can be built from the input indices by shifting each
+virtualFileOffset by the new position of the records in the output file.
+"""
+
+import logging
+import struct
+import errno
+import zlib
+import tempfile
+import gzip
+import os.path as op
+import os
+
+import numpy as np
+import pysam
+from pysam.libcbgzf import BGZFile  # pylint: disable=no-name-in-module
+
+log = logging.getLogger(__name__)
+
+# https://sourceforge.net/p/samtools/mailman/message/28413844/
+BGZF_TERM = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+class Constants:
+    PBI_MAGIC = b"PBI\x01"
+    PBI_HEADER_SIZE = 32
+    PBI_VERSION_30001 = 0x030001
+    PBI_VERSION_40000 = 0x040000
+    PBI_FLAG_MAPPED = 0x1
+    PBI_FLAG_COORDSORTED = 0x2
+    PBI_FLAG_BARCODE = 0x4
+    COPY_BUFSIZE = 1024 * 1024
+
+
+BASIC_COLUMNS = [
+    ("qId", "<i4"),
+    ("qStart", "<i4"),
+    ("qEnd", "<i4"),
+    ("holeNumber", "<i4"),
+    ("readQual", "<f4"),
+    ("contextFlag", "u1"),
+    ("virtualFileOffset", "<i8"),
+]
+MAPPED_COLUMNS = [
+    ("tId", "<i4"),
+    ("tStart", "<u4"),
+    ("tEnd", "<u4"),
+    ("aStart", "<u4"),
+    ("aEnd", "<u4"),
+    ("isReverseStrand", "u1"),
+    ("nM", "<u4"),
+    ("nMM", "<u4"),
+    ("mapQV", "u1"),
+]
+MAPPED_COLUMNS_V4 = [
+    ("nInsOps", "<u4"),
+    ("nDelOps", "<u4"),
+]
+BARCODE_COLUMNS = [
+    ("bcForward", "<i2"),
+    ("bcReverse", "<i2"),
+    ("bcQual", "i1"),
+]
+
+
+class PbiError(ValueError):
+    pass
+
+
+def _get_sections(version, flags):
+    columns = list(BASIC_COLUMNS)
+    if version < Constants.PBI_VERSION_30001:
+        columns.remove(("contextFlag", "u1"))
+    sections = [("basic", columns)]
+    if flags & Constants.PBI_FLAG_MAPPED:
+        mapped = list(MAPPED_COLUMNS)
+        if version >= Constants.PBI_VERSION_40000:
+            mapped.extend(MAPPED_COLUMNS_V4)
+        sections.append(("mapped", mapped))
+    if flags & Constants.PBI_FLAG_COORDSORTED:
+        sections.append(("coordsorted", None))
+    if flags & Constants.PBI_FLAG_BARCODE:
+        sections.append(("barcode", list(BARCODE_COLUMNS)))
+    return sections
+
+
+class PbiTable:
+    """
+    In-memory copy of a PacBio BAM index: the header fields plus a dict of
+    NumPy arrays, one per column.  The coordinate-sorted section (if any) is
+    kept as raw bytes, since it only refers to row numbers.
+    """
+
+    def __init__(self, version, flags, columns, coord_sorted=None):
+        self.version = version
+        self.flags = flags
+        self.columns = columns
+        self.coord_sorted = coord_sorted
+        if coord_sorted is None:
+            self.flags &= ~Constants.PBI_FLAG_COORDSORTED
+
+    def __len__(self):
+        return len(self.columns["holeNumber"])
+
+    @property
+    def hasMappingInfo(self):
+        return bool(self.flags & Constants.PBI_FLAG_MAPPED)
+
+    @property
+    def hasBarcodeInfo(self):
+        return bool(self.flags & Constants.PBI_FLAG_BARCODE)
+
+    def __getattr__(self, key):
+        columns = self.__dict__.get("columns", {})
+        if key in columns:
+            return columns[key]
+        raise AttributeError(key)
+
+    def shift_offsets(self, delta):
+        """
+        Move all records by delta compressed bytes (i.e. add delta << 16 to
+        each virtualFileOffset).
+        """
+        self.columns["virtualFileOffset"] = (
+            self.columns["virtualFileOffset"] + (np.int64(delta) << 16))
+
+    def take(self, rows):
+        """
+        Return a new PbiTable for the given array of row indices; the result
+        is never marked as coordinate-sorted.
+        """
+        columns = {k: v[rows] for k, v in self.columns.items()}
+        return PbiTable(self.version, self.flags, columns)
+
+    def slice(self, start, end):
+        """
+        Return a new PbiTable for rows start to end (exclusive); the result
+        is never marked as coordinate-sorted.
+        """
+        columns = {k: v[start:end] for k, v in self.columns.items()}
+        return PbiTable(self.version, self.flags, columns)
+
+
+def read_pbi(file_name):
+    """
+    Load a .pbi file into a PbiTable.
+    """
+    with gzip.open(file_name, "rb") as pbi_in:
+        data = pbi_in.read()
+    if data[0:4] != Constants.PBI_MAGIC:
+        raise PbiError("{f} is not a PacBio BAM index".format(f=file_name))
+    version, flags, n_reads = struct.unpack_from("<IHI", data, 4)
+    offset = Constants.PBI_HEADER_SIZE
+    columns = {}
+    coord_sorted = None
+    for section, section_columns in _get_sections(version, flags):
+        if section == "coordsorted":
+            n_tids = struct.unpack_from("<I", data, offset)[0]
+            coord_sorted = data[offset:offset + 4 + n_tids * 12]
+            offset += len(coord_sorted)
+            continue
+        for name, dtype in section_columns:
+            dtype = np.dtype(dtype)
+            columns[name] = np.frombuffer(data, dtype=dtype, count=n_reads,
+                                          offset=offset)
+            offset += dtype.itemsize * n_reads
+    if "contextFlag" not in columns:
+        columns["contextFlag"] = np.zeros(n_reads, dtype=np.uint8)
+        version = Constants.PBI_VERSION_30001
+    return PbiTable(version, flags, columns, coord_sorted)
+
+
+def read_pbi_header(file_name):
+    """
+    Return (version, flags, n_reads) from the header of a .pbi file, without
+    reading any of the columns.
+    """
+    with gzip.open(file_name, "rb") as pbi_in:
+        data = pbi_in.read(Constants.PBI_HEADER_SIZE)
+    if data[0:4] != Constants.PBI_MAGIC:
+        raise PbiError("{f} is not a PacBio BAM index".format(f=file_name))
+    return struct.unpack_from("<IHI", data, 4)
+
+
+def get_pbi_total_length(file_name):
+    """
+    Return (n_reads, sum of qEnd - qStart) from a .pbi file, reading only the
+    header and the qStart and qEnd columns.
+    """
+    with gzip.open(file_name, "rb") as pbi_in:
+        data = pbi_in.read(Constants.PBI_HEADER_SIZE)
+        if data[0:4] != Constants.PBI_MAGIC:
+            raise PbiError("{f} is not a PacBio BAM index".format(f=file_name))
+        n_reads = struct.unpack_from("<I", data, 10)[0]
+        pbi_in.seek(4 * n_reads, os.SEEK_CUR)  # qId
+        q_start = np.frombuffer(pbi_in.read(4 * n_reads), dtype="<i4")
+        q_end = np.frombuffer(pbi_in.read(4 * n_reads), dtype="<i4")
+    return n_reads, int(np.sum(q_end - q_start, dtype=np.int64))
+
+
+def write_pbi(pbi, file_name):
+    """
+    Write a PbiTable to a BGZF-compressed .pbi file.
+    """
+    n_reads = len(pbi)
+    with BGZFile(file_name, "wb") as pbi_out:
+        pbi_out.write(Constants.PBI_MAGIC)
+        pbi_out.write(struct.pack("<IHI", pbi.version, pbi.flags, n_reads))
+        pbi_out.write(b"\x00" * 18)
+        for section, section_columns in _get_sections(pbi.version, pbi.flags):
+            if section == "coordsorted":
+                pbi_out.write(pbi.coord_sorted)
+                continue
+            for name, dtype in section_columns:
+                column = np.ascontiguousarray(pbi.columns[name], dtype=dtype)
+                pbi_out.write(column.tobytes())
+    return file_name
+
+
+def merge_pbis(pbis, offsets):
+    """
+    Concatenate several PbiTables into one, shifting the records of each by
+    the corresponding compressed byte offset.  Mapping and barcode columns
+    are retained only if all inputs have them, and the header flags and
+    read count are recomputed accordingly; the result is never marked as
+    coordinate-sorted.
+    """
+    assert len(pbis) == len(offsets)
+    if len(pbis) == 0:
+        raise PbiError("No indices to merge")
+    version = max(pbi.version for pbi in pbis)
+    flags = Constants.PBI_FLAG_MAPPED | Constants.PBI_FLAG_BARCODE
+    for pbi in pbis:
+        flags &= pbi.flags
+    if version >= Constants.PBI_VERSION_40000 and flags & Constants.PBI_FLAG_MAPPED:
+        if any(pbi.version < Constants.PBI_VERSION_40000 for pbi in pbis):
+            raise PbiError("Can't merge mapped indices of different versions")
+    columns = {}
+    for section, section_columns in _get_sections(version, flags):
+        for name, dtype in section_columns:
+            if name == "virtualFileOffset":
+                arrays = [pbi.columns[name] + (np.int64(delta) << 16)
+                          for pbi, delta in zip(pbis, offsets)]
+            else:
+                arrays = [pbi.columns[name] for pbi in pbis]
+            columns[name] = np.concatenate(arrays).astype(dtype, copy=False)
+    return PbiTable(version, flags, columns)
+
+
+def read_bgzf_block(f):
+    """
+    Read one BGZF block, returning (compressed_size, uncompressed_bytes), or
+    None at the end of the file.
+    """
+    header = f.read(18)
+    if len(header) == 0:
+        return None
+    if len(header) < 18 or header[0:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+        raise PbiError("Not a BGZF block")
+    block_size = struct.unpack_from("<H", header, 16)[0] + 1
+    rest = f.read(block_size - 18)
+    data = zlib.decompress(rest[:-8], -15)
+    return block_size, data
+
+
+def get_bam_header_size(file_name):
+    """
+    Return a tuple (n_bytes, header_data), where n_bytes is the compressed
+    size of the BAM header and header_data the uncompressed header.  Raises
+    PbiError if the header does not end on a BGZF block boundary.
+    """
+    data = b""
+    n_bytes = 0
+    with open(file_name, "rb") as bam_in:
+        while True:
+            block = read_bgzf_block(bam_in)
+            if block is None:
+                raise PbiError("Incomplete BAM header in {f}".format(f=file_name))
+            n_bytes += block[0]
+            data += block[1]
+            size = get_bam_header_length(data)
+            if size is not None:
+                if size != len(data):
+                    raise PbiError(
+                        "BAM header of {f} does not end on a BGZF block boundary".format(f=file_name))
+                return n_bytes, data
+
+
+def get_bam_header_length(data):
+    """
+    Return the length of the BAM header at the start of data, or None if
+    the header is incomplete.
+    """
+    if len(data) < 12:
+        return None
+    if data[0:4] != b"BAM\x01":
+        raise PbiError("Not a BAM file")
+    l_text = struct.unpack_from("<i", data, 4)[0]
+    offset = 8 + l_text
+    if len(data) < offset + 4:
+        return None
+    n_ref = struct.unpack_from("<i", data, offset)[0]
+    offset += 4
+    for _ in range(n_ref):
+        if len(data) < offset + 4:
+            return None
+        l_name = struct.unpack_from("<i", data, offset)[0]
+        offset += 4 + l_name + 4
+    if len(data) < offset:
+        return None
+    return offset
+
+
+def get_records_end(file_name):
+    """
+    Return the end of the record blocks of a BAM file, i.e. its size minus
+    the BGZF EOF marker (if present).
+    """
+    size = op.getsize(file_name)
+    with open(file_name, "rb") as bam_in:
+        bam_in.seek(max(0, size - len(BGZF_TERM)))
+        if bam_in.read() == BGZF_TERM:
+            return size - len(BGZF_TERM)
+    return size
+
+
+def _copy_file_range(bam_in, bam_out, start, n_bytes):
+    """
+    Copy n_bytes starting at start in the kernel, returning the number of
+    bytes that could not be copied this way.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return n_bytes
+    bam_out.flush()
+    while n_bytes > 0:
+        try:
+            n = os.copy_file_range(bam_in.fileno(), bam_out.fileno(),
+                                   min(n_bytes, Constants.COPY_BUFSIZE * 64),
+                                   start)
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP):
+                break
+            raise
+        if n == 0:
+            raise IOError("Unexpected end of file")
+        start += n
+        n_bytes -= n
+    return n_bytes
+
+
+def copy_range(bam_in, bam_out, start, n_bytes):
+    """
+    Copy n_bytes starting at offset start of bam_in to the current position
+    of bam_out, in bounded blocks (using os.copy_file_range where the
+    platform and filesystems support it).
+    """
+    n_left = _copy_file_range(bam_in, bam_out, start, n_bytes)
+    start += n_bytes - n_left
+    n_bytes = n_left
+    bam_in.seek(start)
+    while n_bytes > 0:
+        buf = bam_in.read(min(n_bytes, Constants.COPY_BUFSIZE))
+        if not buf:
+            raise IOError("Unexpected end of file")
+        bam_out.write(buf)
+        n_bytes -= len(buf)
+
+
+def concatenate_bams(bam_files, output_file):
+    """
+    Concatenate indexed BAM files that share an identical header by copying
+    their compressed record blocks, and write the merged .pbi.  Raises
+    PbiError if the inputs can't be combined this way, in which case the
+    caller should fall back on record-level merging.
+    """
+    headers = [get_bam_header_size(fn) for fn in bam_files]
+    if len(set(h[1] for h in headers)) != 1:
+        raise PbiError("BAM headers are not identical")
+    pbis = [read_pbi(fn + ".pbi") for fn in bam_files]
+    ranges = [(header_size, get_records_end(fn) - header_size)
+              for fn, (header_size, _) in zip(bam_files, headers)]
+    offsets = []
+    position = headers[0][0]
+    for start, n_bytes in ranges:
+        offsets.append(position - start)
+        position += n_bytes
+    merged_pbi = merge_pbis(pbis, offsets)
+    with open(output_file, "wb") as bam_out:
+        with open(bam_files[0], "rb") as bam_in:
+            copy_range(bam_in, bam_out, 0, headers[0][0])
+        for bam_file, (start, n_bytes) in zip(bam_files, ranges):
+            with open(bam_file, "rb") as bam_in:
+                copy_range(bam_in, bam_out, start, n_bytes)
+        bam_out.write(BGZF_TERM)
+    write_pbi(merged_pbi, output_file + ".pbi")
+    log.info("Concatenated {n} BAM files to {f}".format(
+        n=len(bam_files), f=output_file))
+    return output_file
+
+
+def get_record_offsets(bam_file):
+    """
+    Return the virtual file offsets of the records in a BAM file, as seen by
+    a reader (and by pbindex).  The writer's tell() is not usable for this,
+    since htslib may flush the current block before writing a record that
+    does not fit, and a record starting at the end of a block is located at
+    the start of the next one.
+    """
+    offsets = []
+    with pysam.AlignmentFile(bam_file, "rb", check_sq=False) as bam_in:  # pylint: disable=no-member
+        while True:
+            offset = bam_in.tell()
+            try:
+                next(bam_in)
+            except StopIteration:
+                break
+            offsets.append(offset)
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def reindex_pbis(pbi_files, bam_file, output_file):
+    """
+    Write a .pbi for a BAM file whose records are exactly those indexed by
+    pbi_files (in order), but re-encoded, e.g. with different read names.
+    Only the virtual file offsets are read from the new BAM file.  Returns
+    False if an input index is missing or does not match the records.
+    """
+    if any(not op.isfile(fn) for fn in pbi_files):
+        return False
+    merged = merge_pbis([read_pbi(fn) for fn in pbi_files],
+                        [0] * len(pbi_files))
+    virtual_offsets = get_record_offsets(bam_file)
+    if len(merged) != len(virtual_offsets):
+        log.warning("Index does not match the records written")
+        return False
+    merged.columns["virtualFileOffset"] = virtual_offsets
+    write_pbi(merged, output_file)
+    return True
+
+
+def _encode_bam_header(header):
+    """
+    Return the compressed BGZF blocks of a BAM header, given as a dict or
+    pysam.AlignmentHeader.
+    """
+    fd, tmp_file = tempfile.mkstemp(suffix=".bam")
+    os.close(fd)
+    try:
+        with pysam.AlignmentFile(tmp_file, "wb", header=header):  # pylint: disable=no-member
+            pass
+        with open(tmp_file, "rb") as bam_in:
+            data = bam_in.read()
+    finally:
+        os.remove(tmp_file)
+    if data.endswith(BGZF_TERM):
+        data = data[:-len(BGZF_TERM)]
+    return data
+
+
+def replace_bam_header(bam_file_in, bam_file_out, header):
+    """
+    Write a copy of bam_file_in with a different header (which must have the
+    same reference sequences), copying the compressed record blocks as-is.
+    If the input has a .pbi, the output index is written by shifting the
+    input's virtual file offsets.  Raises PbiError if the input header does
+    not end on a BGZF block boundary.
+
+    :return: True if the .pbi was written
+    """
+    old_size, _ = get_bam_header_size(bam_file_in)
+    header_bytes = _encode_bam_header(header)
+    pbi_file_in = bam_file_in + ".pbi"
+    pbi = read_pbi(pbi_file_in) if op.isfile(pbi_file_in) else None
+    with open(bam_file_out, "wb") as bam_out:
+        bam_out.write(header_bytes)
+        with open(bam_file_in, "rb") as bam_in:
+            copy_range(bam_in, bam_out, old_size,
+                        op.getsize(bam_file_in) - old_size)
+    if pbi is None:
+        return False
+    pbi.shift_offsets(len(header_bytes) - old_size)
+    write_pbi(pbi, bam_file_out + ".pbi")
+    return True
+
@@ -6,7 +6,7 @@ implicitly.
 """
 
 from collections import defaultdict
-from functools import wraps
+from functools import wraps, partial
 import warnings
 import argparse
 import hashlib
@@ -17,6 +17,7 @@ import sys
 
 import pysam
 from numpy import array
+import numpy as np
 
 import pbcore.chemistry.chemistry
 from pbcore.io.align._BamSupport import IncompatibleFile
@@ -24,7 +25,7 @@ import pbcore.io
 
 from pbcoretools.pbvalidate.core import (
     ValidateBase, ValidateRecord, ValidatorError, RecordValidatorError, ValidateFileObject,
-    ValidateRandomAccessBase, ValidateFileObject,
+    ValidateRandomAccessBase, ValidateFileObject, ValidateRecordAcrossFile,
     apply_validator_with_ctx, run_validators, get_context_class,
 )
 #log = logging.getLogger()
@@ -331,6 +332,16 @@ def _get_key_value_pairs_dict(field):
     return {k: v for (k, v) in pairs}
 
 
+def _get_pbi(reader):
+    """
+    Return the .pbi of an indexed BAM reader (whose records are iterated in
+    index order), or None.
+    """
+    if isinstance(reader, pbcore.io.IndexedBamReader):
+        return reader.pbi
+    return None
+
+
 class ValidateFileName (ValidateFileObject):
 
     """
@@ -621,24 +632,92 @@ class ValidateReadBase (ValidateRecord):
         return self.to_errors(aln)[0]
 
 
-class ValidateReadUnique (ValidateReadBase):
+class ValidateReadUnique (ValidateRecordAcrossFile, ValidateReadBase):
 
     """
-    Make sure there are no duplicate subread alignments
+    Make sure there are no duplicate subread alignments.  Only the aligned
+    ranges of reads that may still recur are kept: with a .pbi, the ranges
+    of a (qId, holeNumber, qStart, qEnd) group are dropped after its last
+    record, and in a queryname-sorted file only the current QNAME is kept.
     """
 
     def __init__(self):
         self._aRanges = {}
-
-    def _get_errors(self, aln):
-        if aln.qName in self._aRanges:
-            for (aStart, aEnd) in self._aRanges[aln.qName]:
-                if aStart <= aln.aStart < aEnd or aStart < aln.aEnd <= aEnd:
-                    return [AlignmentNotUniqueError.from_args(aln, aln.qName, aStart, aEnd, aln.aStart, aln.aEnd)]
-            self._aRanges[aln.qName].append((aln.aStart, aln.aEnd))
+        # records left to see per group, from the .pbi
+        self._n_remaining = None
+        self._queryname_sorted = False
+        self._last_qName = None
+        self._last_overlap = None
+
+    def get_record_summary(self, aln):
+        key = None
+        if self._n_remaining is not None:
+            # only used to release memory, so this must not fail validation
+            try:
+                key = (int(aln.qId), int(aln.HoleNumber), int(aln.qStart),
+                       int(aln.qEnd))
+            except Exception:
+                pass
+        return (aln.qName, aln.aStart, aln.aEnd, key)
+
+    def get_prescreen_mask(self, reader):
+        # Records are grouped by (qId, holeNumber, qStart, qEnd), which
+        # ValidateReadQname requires to agree with the QNAME; only records
+        # sharing a group with another record can be duplicates.
+        pbi = _get_pbi(reader)
+        if pbi is None:
+            try:
+                sort_order = reader.peer.header["HD"]["SO"]
+            except Exception:
+                sort_order = Constants.SORT_ORDER_UNKNOWN
+            self._queryname_sorted = sort_order == "queryname"
+            return None
+        keys = np.rec.fromarrays([np.asarray(pbi.qId), np.asarray(pbi.holeNumber),
+                                  np.asarray(pbi.qStart), np.asarray(pbi.qEnd)])
+        unique_keys, inverse, counts = np.unique(keys, return_inverse=True,
+                                                 return_counts=True)
+        self._n_remaining = {tuple(int(x) for x in k): int(n)
+                             for k, n in zip(unique_keys[counts > 1],
+                                             counts[counts > 1])}
+        return counts[inverse.reshape(-1)] > 1
+
+    def _find_overlap(self, summary):
+        qName, aln_start, aln_end = summary[:3]
+        for (aStart, aEnd) in self._aRanges.get(qName, []):
+            if aStart <= aln_start < aEnd or aStart < aln_end <= aEnd:
+                return (aStart, aEnd)
+        return None
+
+    def _release(self, qName, key):
+        if self._queryname_sorted:
+            if qName != self._last_qName:
+                self._aRanges.pop(self._last_qName, None)
+                self._last_qName = qName
+        elif key is not None:
+            n_remaining = self._n_remaining.get(key)
+            if n_remaining is not None:
+                if n_remaining > 1:
+                    self._n_remaining[key] = n_remaining - 1
+                else:
+                    del self._n_remaining[key]
+                    self._aRanges.pop(qName, None)
+
+    def validate_summary(self, summary):
+        qName, aStart, aEnd, key = summary
+        overlap = self._find_overlap(summary)
+        self._last_overlap = (summary, overlap)
+        if overlap is None:
+            self._aRanges.setdefault(qName, []).append((aStart, aEnd))
+        self._release(qName, key)
+        return overlap is None
+
+    def summary_to_errors(self, summary, aln):
+        qName, aln_start, aln_end = summary[:3]
+        if self._last_overlap is not None and self._last_overlap[0] == summary:
+            aStart, aEnd = self._last_overlap[1]
         else:
-            self._aRanges[aln.qName] = [(aln.aStart, aln.aEnd)]
-        return []
+            aStart, aEnd = self._find_overlap(summary)
+        return [AlignmentNotUniqueError.from_args(aln, qName, aStart, aEnd, aln_start, aln_end)]
 
 
 class ValidateReadMapped (ValidateReadBase):
@@ -646,6 +725,15 @@ class ValidateReadMapped (ValidateReadBase):
     """Confirm that an alignment is actually mapped to the reference (only
     suitable for some BAM files)"""
 
+    def get_prescreen_mask(self, reader):
+        # the .pbi has no FLAG column, and a record flagged as unmapped may
+        # still have a valid tId and tStart, so in mapped files every record
+        # must be checked
+        pbi = _get_pbi(reader)
+        if pbi is None or (reader.isMapped and self._aligned != False):
+            return None
+        return np.zeros(len(pbi), dtype=bool)
+
     def _get_errors(self, aln):
         # XXX only need to do validation if the file is mapped AND aligned
         # isn't explicitly set to False
@@ -666,6 +754,14 @@ class ValidateReadUnmapped (ValidateReadBase):
     POS=0, RNAME=*, FLAG&4
     """
 
+    def get_prescreen_mask(self, reader):
+        pbi = _get_pbi(reader)
+        if pbi is None:
+            return None
+        if not (not reader.isMapped and not self._aligned):
+            return np.zeros(len(pbi), dtype=bool)
+        return None
+
     def _get_errors(self, aln):
         # XXX like the mapped case, only need to check if the file and the
         # aligned parameter both say it's unmapped
@@ -774,6 +870,25 @@ class ValidateReadQname (ValidateReadBase):
 
 class ValidateReadLength (ValidateReadBase):
 
+    def get_prescreen_mask(self, reader):
+        # The sequence length is not in the .pbi, so qEnd - qStart can only
+        # be compared with it after decoding.  Records of CCS and transcript
+        # read groups (qId in the .pbi) are not checked at all, unless the
+        # query range in the index is itself invalid (qStart < 0 or
+        # qEnd < qStart).
+        pbi = _get_pbi(reader)
+        if pbi is None:
+            return None
+        rg_table = reader.readGroupTable
+        skipped_types = np.isin(np.asarray(rg_table.ReadType, dtype=object),
+                                [Constants.READ_TYPE_CCS,
+                                 Constants.READ_TYPE_TRANSCRIPT])
+        q_start = np.asarray(pbi.qStart)
+        q_end = np.asarray(pbi.qEnd)
+        bad_range = (q_start < 0) | (q_end < q_start)
+        return ~np.isin(np.asarray(pbi.qId),
+                        np.asarray(rg_table.ID)[skipped_types]) | bad_range
+
     def _get_errors(self, aln):
         rg = aln.readGroupInfo
         if not rg.ReadType in [Constants.READ_TYPE_CCS, Constants.READ_TYPE_TRANSCRIPT]:
@@ -1152,10 +1267,8 @@ def _get_reader(file_name, reference=None):
         reader_class = pbcore.io.IndexedBamReader
     else:
         reader_class = pbcore.io.BamReader
-
-    def _reader(bam_file):
-        return reader_class(bam_file, referenceFastaFname=reference)
-    return _reader
+    # a partial (unlike a closure) can be sent to worker processes
+    return partial(reader_class, referenceFastaFname=reference)
 
 
 def validate_bam(file_name,
@@ -1165,9 +1278,19 @@ def validate_bam(file_name,
                  quick=False,
                  max_errors=None,
                  max_records=None,
-                 validate_index=False):
+                 validate_index=False,
+                 nproc=1,
+                 sample_size=None,
+                 sample_fraction=None,
+                 sample_seed=None,
+                 profile=False):
     """
-    Main API entry point for running BAM validation.
+    Main API entry point for running BAM validation.  With nproc > 1 and a
+    .pbi index, the records are validated in parallel worker processes; with
+    sample_size or sample_fraction, only a random sample of the records is
+    validated (this requires a .pbi index).  With profile=True, the time
+    spent in each validator is reported in the metrics (see
+    core.get_profile).
 
     Example:
 
@@ -1201,5 +1324,10 @@ def validate_bam(file_name,
         path=file_name,
         reader_class=_get_reader(file_name, reference),
         validators=validators,
-        additional_validation_function=validate_read_groups)
+        additional_validation_function=validate_read_groups,
+        nproc=nproc,
+        sample_size=sample_size,
+        sample_fraction=sample_fraction,
+        sample_seed=sample_seed,
+        profile=profile)
     return e, m
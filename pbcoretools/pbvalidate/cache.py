@@ -0,0 +1,220 @@
+
+"""
+On-disk cache of pbvalidate results.  Each entry holds the pickled results
+of one validation run (or of one resource of a dataset), and is keyed by
+the identity of the input files (path, size, mtime and a hash of their
+first and last blocks), the validation options and the pbvalidate code
+itself, so any change to the inputs, the options or the validators results
+in a new entry.  The cache is only used if a cache directory is given
+explicitly or in the environment, and since unpickling can run arbitrary
+code, only if that directory belongs to the current user and is not
+writable by anyone else.
+"""
+
+import hashlib
+import logging
+import os.path as op
+import os
+import pickle
+import stat
+import tempfile
+import copy
+
+from pbcore.io import openDataSet
+
+log = logging.getLogger(__name__)
+
+
+class Constants:
+    CACHE_DIR_ENV = "PBVALIDATE_CACHE_DIR"
+    MAX_SIZE = 256 * 1024 * 1024
+    HASH_BLOCK_SIZE = 1024 * 1024
+    # options that do not change the results
+    IGNORED_OPTIONS = {"nproc", "out", "result_cache"}
+    EXT = ".pkl"
+
+
+def get_file_fingerprint(file_name):
+    """
+    Identify the contents of a file by path, size, mtime and a hash of the
+    first and last HASH_BLOCK_SIZE bytes.  Missing files are fingerprinted
+    too, since the presence of an index changes the validation results.
+    """
+    file_name = op.abspath(file_name)
+    if not op.isfile(file_name):
+        return (file_name, None)
+    st = os.stat(file_name)
+    block_size = Constants.HASH_BLOCK_SIZE
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_name, "rb") as f:
+        h.update(f.read(block_size))
+        if st.st_size > block_size:
+            f.seek(max(block_size, st.st_size - block_size))
+            h.update(f.read(block_size))
+    return (file_name, st.st_size, st.st_mtime_ns, h.hexdigest())
+
+
+def _get_code_fingerprint():
+    code_dir = op.dirname(op.abspath(__file__))
+    return [get_file_fingerprint(op.join(code_dir, file_name))[1:]
+            for file_name in sorted(os.listdir(code_dir))
+            if file_name.endswith(".py")]
+
+
+def get_cache_key(validate_func, input_files, options):
+    options = {k: v for k, v in options.items()
+               if k not in Constants.IGNORED_OPTIONS}
+    key = (validate_func.__module__, validate_func.__name__,
+           sorted((k, repr(v)) for k, v in options.items()),
+           [get_file_fingerprint(f) for f in input_files],
+           _get_code_fingerprint())
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+
+def get_cache_dir(cache_dir=None):
+    """
+    Return the cache directory given on the command line or in the
+    environment, or None if caching is disabled.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(Constants.CACHE_DIR_ENV) or None
+    return cache_dir
+
+
+def get_resource_files(resource):
+    """
+    Return a dataset resource with all index files it may have.
+    """
+    return [resource, resource + ".pbi", resource + ".fai", resource + ".bai"]
+
+
+def get_dataset_files(file_name, reference=None):
+    """
+    Return the dataset XML, the files of its external resources with their
+    index files, and the reference FASTA (if any) with its .fai, or None if
+    the dataset can't be opened (in which case the result is not cached).
+    """
+    try:
+        ds = openDataSet(file_name, strict=False, skipCounts=True)
+        resources = ds.toExternalFiles()
+    except Exception as e:
+        log.warning("Can't list the resources of %s: %s", file_name, e)
+        return None
+    file_names = [file_name]
+    for resource in resources:
+        file_names.extend(get_resource_files(resource))
+    if reference is not None:
+        file_names.extend([reference, reference + ".fai"])
+    return file_names
+
+
+def to_cached_errors(errors):
+    """
+    Copy errors for storing them in the cache: the records they refer to
+    are not necessarily picklable, and are only displayed anyway.
+    """
+    cached_errors = []
+    for error in errors:
+        error = copy.copy(error)
+        if error.object_ref is not None:
+            error.object_ref = str(error.object_ref)
+        cached_errors.append(error)
+    return cached_errors
+
+
+def _is_private(st):
+    return (st.st_uid == os.getuid() and
+            not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+class ValidationCache:
+
+    """
+    Directory of cache entries, with least-recently-used entries removed
+    once the total size exceeds max_size bytes.  The directory is created
+    readable only by the current user; an existing directory (or entry)
+    that is owned by another user or writable by others is not used.
+    """
+
+    def __init__(self, cache_dir, max_size=Constants.MAX_SIZE):
+        self.cache_dir = op.abspath(op.expanduser(cache_dir))
+        self.max_size = max_size
+
+    def _get_path(self, key):
+        return op.join(self.cache_dir, key + Constants.EXT)
+
+    def _check_dir(self):
+        if not _is_private(os.stat(self.cache_dir)):
+            raise IOError(
+                "Cache directory {d} must belong to the current user and "
+                "must not be writable by others".format(d=self.cache_dir))
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            self._check_dir()
+            with open(path, "rb") as f:
+                if not _is_private(os.fstat(f.fileno())):
+                    raise IOError("not owned by the current user")
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning("Ignoring unreadable cache entry %s: %s", path, e)
+            return None
+        os.utime(path)  # mark as recently used
+        return value
+
+    def put(self, key, value):
+        """
+        Store a picklable value; errors should be passed through
+        to_cached_errors first.
+        """
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        self._check_dir()
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._get_path(key))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(Constants.EXT):
+                path = op.join(self.cache_dir, file_name)
+                st = os.stat(path)
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        total_size = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            log.debug("Evicting cache entry %s", path)
+            os.remove(path)
+            total_size -= size
+
+
+def run_cached(validate_func, input_files, options, cache=None):
+    """
+    Run validate_func(**options) and cache its (errors, metrics) result,
+    or return the cached result of an identical earlier run.  input_files
+    are all files the result depends on; if None, or if no cache is given,
+    no caching is done.
+    """
+    if input_files is None or cache is None:
+        return validate_func(**options)
+    key = get_cache_key(validate_func, input_files, options)
+    result = cache.get(key)
+    if result is not None:
+        log.info("Using cached validation results for %s", input_files[0])
+        return result
+    errors, metrics = validate_func(**options)
+    try:
+        cache.put(key, (to_cached_errors(errors), metrics))
+    except Exception as e:
+        log.warning("Can't write validation results to cache: %s", e)
+    return errors, metrics
@@ -1,8 +1,13 @@
+import multiprocessing
+import math
 import sys
+import time
 import traceback
 from collections import namedtuple
 import logging
 
+import numpy as np
+
 _log = logging.getLogger(__name__)
 
 
@@ -47,6 +52,18 @@ class ValidatorError(AssertionError):
     def __eq__(self, other):
         return self.__hash__() == other.__hash__()
 
+    def __reduce__(self):
+        # errors found by worker processes are pickled; this bypasses the
+        # constructors of subclasses that take extra arguments
+        return (_unpickle_error, (self.__class__, self.args, self.__dict__))
+
+
+def _unpickle_error(cls, args, state):
+    error = cls.__new__(cls)
+    error.args = args
+    error.__dict__.update(state)
+    return error
+
 
 class RecordValidatorError (ValidatorError):
 
@@ -87,12 +104,47 @@ class ValidateRecord(ValidateBase):
     def validate(self, record):
         return True
 
+    def get_prescreen_mask(self, reader):
+        """
+        Optional fast path: return a boolean array with one entry per record
+        in the file, which is False for records that are known to pass this
+        validator without decoding them (for example from the .pbi index),
+        or None if every record must be checked.
+        """
+        return None
+
     def to_error(self, record):
         # override if you want a custom error
         m = "Record {r} failed".format(r=record)
         return ValidatorError(m)
 
 
+class ValidateRecordAcrossFile(ValidateRecord):
+
+    """
+    Base class for record validators that keep state across the whole file,
+    such as uniqueness checks.  When records are validated in parallel, the
+    worker processes only extract a small picklable summary of each record,
+    and the checks are applied to the summaries in file order by the parent
+    process.
+    """
+
+    def get_record_summary(self, record):
+        raise NotImplementedError
+
+    def validate_summary(self, summary):
+        raise NotImplementedError
+
+    def summary_to_errors(self, summary, object_ref):
+        raise NotImplementedError
+
+    def validate(self, record):
+        return self.validate_summary(self.get_record_summary(record))
+
+    def to_errors(self, record):
+        return self.summary_to_errors(self.get_record_summary(record), record)
+
+
 class ValidateFile(ValidateBase):
 
     """Base class for validating external file properties (name, etc.)"""
@@ -244,6 +296,10 @@ class ValidatorContextMaxRecords(ValidatorErrorContext):
         self.max_records = max_records
         self._records = set([])
 
+    @property
+    def n_records_left(self):
+        return self.max_records - len(self._records)
+
     def _save_record(self, object_ref):
         self._records.add(str(object_ref))
         if len(self._records) >= self.max_records:
@@ -306,12 +362,16 @@ def apply_validator(v, item):
         else:
             return v.to_errors(item)
     except Exception as e:
-        msg = "Unexpected {t} error validating {i}: {e}".format(i=item, e=e,
-                                                                t=type(e).__name__)
-        _log.error(msg)
-        _, _, ex_traceback = sys.exc_info()
-        _log_traceback(e, ex_traceback)
-        return ValidatorError(msg)
+        return _to_unexpected_error(e, item)
+
+
+def _to_unexpected_error(e, item):
+    msg = "Unexpected {t} error validating {i}: {e}".format(i=item, e=e,
+                                                            t=type(e).__name__)
+    _log.error(msg)
+    _, _, ex_traceback = sys.exc_info()
+    _log_traceback(e, ex_traceback)
+    return ValidatorError(msg)
 
 
 def apply_validator_with_ctx(ctx, v, item):
@@ -356,8 +416,481 @@ def get_context_class(quick=False, max_errors=None, max_records=None):
     return ValidatorErrorContext
 
 
+# metrics keys used to report the coverage in sampling mode
+SAMPLED_RECORDS = "SampledRecords"
+TOTAL_RECORDS = "TotalRecords"
+# metrics key for the timings of a run with profile=True
+PROFILE = "Profile"
+
+
+def new_profile():
+    return {"FileTime": 0.0, "RecordTime": 0.0, "Records": 0,
+            "ValidatorTimes": {}}
+
+
+def add_profile(metrics, profile):
+    """
+    Add the timings of one run (e.g. of a worker process) to the profile in
+    metrics[PROFILE], which holds the seconds spent in the file-level and
+    record-level phases, the number of records, and the seconds spent in
+    each validator class.
+    """
+    total = metrics.setdefault(PROFILE, new_profile())
+    for key in ["FileTime", "RecordTime", "Records"]:
+        total[key] += profile[key]
+    times = total["ValidatorTimes"]
+    for name, seconds in profile["ValidatorTimes"].items():
+        times[name] = times.get(name, 0.0) + seconds
+
+
+def get_profile(metrics):
+    """Return the profile of a run with profile=True, or None"""
+    return metrics.get(PROFILE)
+
+
+class RecordRef:
+
+    """
+    Picklable stand-in for a record, used as the object_ref of errors and
+    metrics from records validated in a worker process.
+    """
+
+    def __init__(self, index, label=None):
+        self.index = index
+        self.label = label
+
+    def __str__(self):
+        if self.label is not None:
+            return self.label
+        return "record {i}".format(i=self.index)
+
+    def __repr__(self):
+        return "<RecordRef {i} >".format(i=self.index)
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __eq__(self, other):
+        return isinstance(other, RecordRef) and other.index == self.index
+
+
+class RecordReaderError(Exception):
+    """
+    Raised in the parent process when a worker failed to read a record.
+    """
+    pass
+
+
+def _supports_parallel_records(reader):
+    return hasattr(reader, "__getitem__") and hasattr(reader, "__len__")
+
+
+def get_record_ranges(reader, n_chunks):
+    """
+    Split the records of a random-access reader into up to n_chunks
+    contiguous (start, end) index ranges.  For BAM files with a .pbi, the
+    boundaries are moved forward to the next change of ZMW.
+    """
+    n_records = len(reader)
+    if n_records == 0:
+        return []
+    bounds = np.linspace(0, n_records, max(1, n_chunks) + 1).astype(np.int64)
+    pbi = getattr(reader, "pbi", None)
+    if pbi is not None:
+        holes = np.asarray(pbi.holeNumber)
+        changes = np.flatnonzero(holes[1:] != holes[:-1]) + 1
+        changes = np.append(changes, n_records)
+        bounds[1:-1] = changes[np.searchsorted(changes, bounds[1:-1])]
+    bounds = np.unique(bounds)
+    return [(int(s), int(e)) for s, e in zip(bounds[:-1], bounds[1:])]
+
+
+def get_prescreen_masks(reader, validators):
+    """
+    Collect the prescreen masks of the record validators, as a dict of
+    index in validators => boolean array.
+    """
+    masks = {}
+    for j, v in enumerate(validators):
+        if isinstance(v, ValidateRecord):
+            mask = v.get_prescreen_mask(reader)
+            if mask is not None:
+                _log.info("{v}: {n} of {m} records need to be checked".format(
+                    v=v.__class__.__name__, n=np.count_nonzero(mask),
+                    m=len(mask)))
+                masks[j] = mask
+    return masks
+
+
+def get_sample_indices(n_records, sample_size=None, sample_fraction=None,
+                       seed=None):
+    """
+    Pick the indices of records to validate in sampling mode.  The records
+    are split into equally sized runs of consecutive records and one record
+    is drawn at random from each, so the sample is spread evenly over the
+    file (and over the resources of a dataset).
+    """
+    if sample_fraction is not None:
+        sample_size = int(math.ceil(n_records * sample_fraction))
+    n_sample = max(0, min(sample_size, n_records))
+    if n_sample == n_records:
+        return np.arange(n_records)
+    rng = np.random.default_rng(seed)
+    bounds = np.linspace(0, n_records, n_sample + 1).astype(np.int64)
+    widths = bounds[1:] - bounds[:-1]
+    return bounds[:-1] + (rng.random(n_sample) * widths).astype(np.int64)
+
+
+def get_sample_coverage(metrics):
+    """
+    Return (records validated, total records) for a run in sampling mode,
+    or None if all records were validated.
+    """
+    if SAMPLED_RECORDS in metrics:
+        return metrics[SAMPLED_RECORDS], metrics[TOTAL_RECORDS]
+    return None
+
+
+_worker_state = {}
+
+
+def _init_record_worker(path, reader_class, validators, masks, profile):
+    _worker_state["reader"] = reader_class(path)
+    _worker_state["validators"] = validators
+    _worker_state["masks"] = masks
+    _worker_state["profile"] = profile
+
+
+def _to_record_ref(result, record, ref):
+    if not isinstance(result, list):
+        result = [result]
+    for error in result:
+        if error.object_ref is record:
+            if ref.label is None:
+                ref.label = str(record)
+            error.object_ref = ref
+    return result
+
+
+def _validate_record_range(start, end):
+    """
+    Worker function: validate records start to end (exclusive).  Returns
+    (failures, summaries, reader_error, times), where failures is a list of
+    (record_index, validator_index, errors), summaries a dict of
+    validator_index => list of per-record summaries for validators derived
+    from ValidateRecordAcrossFile, reader_error (index, message) if a
+    record could not be read, and times the seconds spent in each validator
+    if profiling (otherwise None).
+    """
+    reader = _worker_state["reader"]
+    validators = _worker_state["validators"]
+    masks = _worker_state["masks"]
+    times = [0.0] * len(validators) if _worker_state["profile"] else None
+    failures = []
+    summaries = {j: [] for j, v in enumerate(validators)
+                 if isinstance(v, ValidateRecordAcrossFile)}
+    for i in range(start, end):
+        try:
+            record = reader[i]
+        except Exception as e:
+            return failures, summaries, (i, str(e)), times
+        ref = RecordRef(i)
+        for j, v in enumerate(validators):
+            if j in masks and not masks[j][i]:
+                if j in summaries:
+                    summaries[j].append(None)
+                continue
+            if times is not None:
+                t_start = time.perf_counter()
+            if j in summaries:
+                try:
+                    summaries[j].append(v.get_record_summary(record))
+                except Exception as e:
+                    summaries[j].append(e)
+            else:
+                result = apply_validator(v, record)
+                if not isinstance(result, ValidMetric):
+                    failures.append((i, j, _to_record_ref(result, record,
+                                                          ref)))
+            if times is not None:
+                times[j] += time.perf_counter() - t_start
+    return failures, summaries, None, times
+
+
+def _apply_summary_validator(v, summary, ref):
+    """
+    Equivalent of apply_validator for the file-level state of a
+    ValidateRecordAcrossFile.
+    """
+    try:
+        if isinstance(summary, Exception):
+            raise summary
+        if v.validate_summary(summary):
+            return ValidMetric(v.__class__, object_ref=ref)
+        return v.summary_to_errors(summary, ref)
+    except Exception as e:
+        msg = "Unexpected {t} error validating {i}: {e}".format(
+            i=ref, e=e, t=type(e).__name__)
+        _log.error(msg)
+        return ValidatorError(msg)
+
+
+def _push_result(ctx, result):
+    if isinstance(result, ValidMetric):
+        ctx.add_validate_metric(result)
+    elif isinstance(result, list):
+        for result_ in result:
+            ctx.add_validation_error(result_)
+    else:
+        ctx.add_validation_error(result)
+
+
+class ValidationPlan:
+
+    """
+    The validators of one run, split by type once.  Passing records are
+    tallied in integer counters per record validator and added to the
+    context metrics by flush(), instead of pushing a ValidMetric for every
+    record and validator.  Contexts that override add_validate_metric (e.g.
+    ValidatorContextMaxRecords) still get one ValidMetric per pass.  With
+    profile=True, the time spent in each validator is accumulated in times
+    (record validators) and profile (all validators).  Records are read in
+    batches of BATCH_SIZE, or fewer if the context can stop early (see
+    get_batch_size).
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, validators, profile=False):
+        self.file_validators = [v for v in validators
+                                if isinstance(v, ValidateFile)]
+        self.file_object_validators = [v for v in validators
+                                       if isinstance(v, ValidateFileObject)]
+        self.record_validators = [v for v in validators
+                                  if isinstance(v, ValidateRecord)]
+        self.counts = [0] * len(self.record_validators)
+        self.n_records = 0
+        self.profile = self.times = None
+        if profile:
+            self.profile = new_profile()
+            self.times = [0.0] * len(self.record_validators)
+
+    def add_time(self, v, seconds):
+        times = self.profile["ValidatorTimes"]
+        key = v.__class__.__name__
+        times[key] = times.get(key, 0.0) + seconds
+
+    @staticmethod
+    def counts_passes(ctx):
+        return (type(ctx).add_validate_metric is
+                ValidatorErrorContext.add_validate_metric)
+
+    def get_batch_size(self, ctx):
+        """
+        Don't read (and decode) more records ahead than the context may
+        need: at most the number of records left with a record limit, and
+        one at a time when any error may stop the validation.
+        """
+        if isinstance(ctx, ValidatorContextMaxRecords):
+            return max(1, min(self.BATCH_SIZE, ctx.n_records_left))
+        if isinstance(ctx, (ValidatorContextMaxErrors,
+                            ValidatorContextFirstError,
+                            ValidatorContextFirstBadRecord)):
+            return 1
+        return self.BATCH_SIZE
+
+    def flush(self, ctx):
+        for k, v in enumerate(self.record_validators):
+            if self.counts[k] > 0:
+                key = v.__class__.__name__
+                ctx.metrics[key] = ctx.metrics.get(key, 0) + self.counts[k]
+                self.counts[k] = 0
+        if self.times is not None:
+            for k, v in enumerate(self.record_validators):
+                if self.times[k] > 0:
+                    self.add_time(v, self.times[k])
+                    self.times[k] = 0.0
+
+
+def _timed(validate, times, k):
+    """Wrap a validate method to add the time spent in it to times[k]"""
+    perf_counter = time.perf_counter
+
+    def _validate(record):
+        t_start = perf_counter()
+        try:
+            return validate(record)
+        finally:
+            times[k] += perf_counter() - t_start
+    return _validate
+
+
+def _apply_validator_timed(ctx, plan, v, item):
+    if plan.profile is None:
+        return apply_validator_with_ctx(ctx, v, item)
+    t_start = time.perf_counter()
+    try:
+        apply_validator_with_ctx(ctx, v, item)
+    finally:
+        plan.add_time(v, time.perf_counter() - t_start)
+
+
+def _iter_batches(records, get_batch_size):
+    """
+    Group records into lists of get_batch_size() records, which is called
+    again after each batch has been processed; if the reader fails, the
+    records read so far are yielded before the exception is raised.
+    """
+    batch = []
+    batch_size = get_batch_size()
+    try:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+                batch_size = get_batch_size()
+    except Exception:
+        if batch:
+            yield batch
+        raise
+    if batch:
+        yield batch
+
+
+def _run_record_validators(ctx, plan, records, masks, indices=None):
+    """
+    Serial record loop: apply the record validators of the plan to each
+    record in turn, with the prescreen masks (index in
+    plan.record_validators => boolean array) sliced per batch.  If the
+    records are a sample, indices are their positions in the file.
+    """
+    count_passes = plan.counts_passes(ctx)
+    counts = plan.counts
+    times = plan.times
+    start = n_done = 0
+    try:
+        for batch in _iter_batches(records,
+                                   lambda: plan.get_batch_size(ctx)):
+            end = start + len(batch)
+            checks = []
+            for k, v in enumerate(plan.record_validators):
+                mask = masks.get(k)
+                if mask is not None:
+                    if indices is not None:
+                        mask = np.asarray(mask)[indices[start:end]].tolist()
+                    else:
+                        mask = np.asarray(mask[start:end]).tolist()
+                validate = v.validate
+                if times is not None:
+                    validate = _timed(validate, times, k)
+                checks.append((k, v, validate, mask))
+            for i, record in enumerate(batch):
+                for k, v, validate, mask in checks:
+                    if mask is not None and not mask[i]:
+                        passed = True
+                    else:
+                        try:
+                            passed = validate(record)
+                            if not passed:
+                                result = v.to_errors(record)
+                        except Exception as e:
+                            passed = False
+                            result = _to_unexpected_error(e, record)
+                    if not passed:
+                        _push_result(ctx, result)
+                    elif count_passes:
+                        counts[k] += 1
+                    else:
+                        ctx.add_validate_metric(
+                            ValidMetric(v.__class__, object_ref=record))
+                n_done += 1
+            start = end
+    finally:
+        plan.n_records += n_done
+        plan.flush(ctx)
+
+
+def _run_record_validators_sample(ctx, plan, reader, indices):
+    """
+    Validate the records at the given indices of a random-access reader,
+    and record the achieved coverage in the context metrics.
+    """
+    masks = get_prescreen_masks(reader, plan.record_validators)
+    _log.info("Validating a sample of {n} of {m} records".format(
+        n=len(indices), m=len(reader)))
+    try:
+        _run_record_validators(ctx, plan, (reader[int(i)] for i in indices),
+                               masks, indices)
+    finally:
+        ctx.metrics[SAMPLED_RECORDS] = plan.n_records
+        ctx.metrics[TOTAL_RECORDS] = len(reader)
+
+
+def _run_record_validators_parallel(ctx, path, reader_class, reader, plan,
+                                    nproc):
+    """
+    Validate the records of a random-access file in nproc worker processes,
+    replaying the results into the context in the same order as the serial
+    loop so that early-stop conditions are unchanged.
+    """
+    record_validators = plan.record_validators
+    masks = get_prescreen_masks(reader, record_validators)
+    ranges = get_record_ranges(reader, nproc * 4)
+    _log.info("Validating {n} records of {p} in {c} chunks with {x} processes".format(
+        n=len(reader), p=path, c=len(ranges), x=nproc))
+    count_passes = plan.counts_passes(ctx)
+    counts = plan.counts
+    times = plan.times
+    pool = multiprocessing.Pool(nproc, _init_record_worker,
+                                (path, reader_class, record_validators, masks,
+                                 times is not None))
+    try:
+        _results = [pool.apply_async(_validate_record_range, r) for r in ranges]
+        pool.close()
+        for (start, end), _result in zip(ranges, _results):
+            failures, summaries, reader_error, times_ = _result.get()
+            failures = {(i, j): errors for i, j, errors in failures}
+            if times is not None:
+                for j, seconds in enumerate(times_):
+                    times[j] += seconds
+            if reader_error is not None:
+                end = reader_error[0]
+            plan.n_records += end - start
+            for i in range(start, end):
+                ref = RecordRef(i)
+                for j, v in enumerate(record_validators):
+                    if j in masks and not masks[j][i]:
+                        result = None
+                    elif j in summaries:
+                        if times is not None:
+                            t_start = time.perf_counter()
+                        result = _apply_summary_validator(
+                            v, summaries[j][i - start], ref)
+                        if times is not None:
+                            times[j] += time.perf_counter() - t_start
+                    else:
+                        result = failures.get((i, j))
+                    if isinstance(result, ValidMetric):
+                        result = None
+                    if result is not None:
+                        _push_result(ctx, result)
+                    elif count_passes:
+                        counts[j] += 1
+                    else:
+                        ctx.add_validate_metric(
+                            ValidMetric(v.__class__, object_ref=ref))
+            if reader_error is not None:
+                raise RecordReaderError(reader_error[1])
+    finally:
+        plan.flush(ctx)
+        pool.terminate()
+        pool.join()
+
+
 def run_validators(context_class, path, reader_class, validators,
-                   additional_validation_function=None):
+                   additional_validation_function=None, nproc=1,
+                   sample_size=None, sample_fraction=None, sample_seed=None,
+                   profile=False):
     """Runs a validations in a context and returns a tuple of errors, metrics
 
     Errors are a list of Error instances
@@ -370,30 +903,57 @@ def run_validators(context_class, path, reader_class, validators,
     :param reader_class: ReaderBase
     :param validators: list of validators
     :param additional_validation_function:
+    :param nproc: number of worker processes for record validation; this
+                  requires a picklable reader_class that supports random
+                  access, and is ignored when the number of records is
+                  limited by the context (e.g. quick mode)
+    :param sample_size: validate only this many records, picked at random
+                        across the file; this requires a reader that
+                        supports random access
+    :param sample_fraction: alternative to sample_size, as a fraction of
+                            the records
+    :param sample_seed: seed for picking the sample
+    :param profile: record the time spent in the file-level and record-level
+                    phases and in each validator class, in metrics[PROFILE]
     :return:
     """
 
     errors = []
     # Metric -> Int
     metrics = {}
+    plan = ValidationPlan(validators, profile=profile)
+    t_start = time.perf_counter()
+    t_records = None
     try:
         with context_class(errors, metrics) as ctx:
-            for v in validators:
-                if isinstance(v, ValidateFile):
-                    apply_validator_with_ctx(ctx, v, path)
+            for v in plan.file_validators:
+                _apply_validator_timed(ctx, plan, v, path)
 
             # FIXME this should probably be refactored to catch reader errors
             # separately from logic errors elsewhere
             with reader_class(path) as reader:
-                for v in validators:
-                    if isinstance(v, ValidateFileObject):
-                        apply_validator_with_ctx(ctx, v, reader)
+                for v in plan.file_object_validators:
+                    _apply_validator_timed(ctx, plan, v, reader)
                 if additional_validation_function is not None:
                     additional_validation_function(ctx, validators, reader)
-                for record in reader:
-                    for v in validators:
-                        if isinstance(v, ValidateRecord):
-                            apply_validator_with_ctx(ctx, v, record)
+                t_records = time.perf_counter()
+                sampling = (sample_size is not None or
+                            sample_fraction is not None)
+                if sampling and not _supports_parallel_records(reader):
+                    _log.warning("{p} does not support random access, "
+                                 "validating all records".format(p=path))
+                    sampling = False
+                if sampling:
+                    indices = get_sample_indices(len(reader), sample_size,
+                                                 sample_fraction, sample_seed)
+                    _run_record_validators_sample(ctx, plan, reader, indices)
+                elif (nproc > 1 and _supports_parallel_records(reader) and
+                        not isinstance(ctx, ValidatorContextMaxRecords)):
+                    _run_record_validators_parallel(ctx, path, reader_class,
+                                                    reader, plan, nproc)
+                else:
+                    masks = get_prescreen_masks(reader, plan.record_validators)
+                    _run_record_validators(ctx, plan, reader, masks)
     except ValidationStopException as e:
         # This doesn't necessarily mean the validation failed. This determined
         # from errors list
@@ -407,6 +967,15 @@ def run_validators(context_class, path, reader_class, validators,
         _, _, ex_traceback = sys.exc_info()
         _log_traceback(e, ex_traceback)
         errors.append(ValidatorError(msg))
+    finally:
+        if plan.profile is not None:
+            t_end = time.perf_counter()
+            if t_records is None:
+                t_records = t_end
+            plan.profile["FileTime"] = t_records - t_start
+            plan.profile["RecordTime"] = t_end - t_records
+            plan.profile["Records"] = plan.n_records
+            add_profile(metrics, plan.profile)
 
     return errors, metrics
 
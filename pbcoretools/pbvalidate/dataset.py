@@ -6,11 +6,14 @@ Validation of PacBio dataset XML (and referenced files)
 import xml.etree.ElementTree as ET
 from io import StringIO
 import xml.parsers.expat
+from collections import namedtuple
+import multiprocessing
 import traceback
 import itertools
 import argparse
 import logging
 import os.path
+import time
 import sys
 
 from urllib.parse import urlparse
@@ -22,15 +25,23 @@ from pbcore.io import IndexedBamReader, IndexedFastaReader
 import pbcore.io
 
 from pbcoretools.pbvalidate.core import (get_context_class, run_validators,
-                                         ValidatorError, ValidateFile, ValidateFileObject)
+                                         apply_validator, RecordRef,
+                                         add_profile, get_profile,
+                                         new_profile, PROFILE,
+                                         ValidatorError, ValidatorErrorContext,
+                                         ValidateFile, ValidateFileObject,
+                                         ValidateRecord, ValidateRecordAcrossFile)
 from pbcoretools.pbvalidate import fasta
 from pbcoretools.pbvalidate import bam
+from pbcoretools.pbvalidate import cache
 
 log = logging.getLogger(__name__)
 
 
 class Constants:
     XML_NAMESPACE = "http://pacificbiosciences.com/PacBioBaseDataModel.xsd"
+    # metrics key for the per-resource results of parallel validation
+    RESOURCE_TIMES = "ResourceTimes"
 
 
 class DatasetTypes:
@@ -546,6 +557,12 @@ class DatasetReader:
     def __getattr__(self, name):
         return getattr(self._reader, name)
 
+    def __len__(self):
+        return len(self._reader)
+
+    def __getitem__(self, index):
+        return self._reader[index]
+
     def __iter__(self):
         try:
             for rec in self._reader:
@@ -578,6 +595,289 @@ class DatasetReader:
         return file_obj
 
 
+class _DatasetMetadataReader(DatasetReader):
+
+    """
+    DatasetReader without records, used for the dataset-level validators when
+    the resources are validated separately.
+    """
+
+    def __iter__(self):
+        return iter(())
+
+
+class _SummaryCollector(ValidateRecord):
+
+    """
+    Stand-in for a ValidateRecordAcrossFile in a resource worker: collects the
+    record summaries, which are checked across all resources by the parent.
+    """
+
+    def __init__(self, validator):
+        self.validator = validator
+        self.summaries = []
+        self.time = 0.0
+
+    def validate(self, record):
+        t_start = time.perf_counter()
+        try:
+            self.summaries.append(self.validator.get_record_summary(record))
+        except Exception as e:
+            self.summaries.append(e)
+        self.time += time.perf_counter() - t_start
+        return True
+
+
+class _RecordCounter(ValidateRecord):
+
+    def validate(self, record):
+        return True
+
+
+ResourceResult = namedtuple("ResourceResult", ["path", "file_errors",
+                                               "file_passes", "errors",
+                                               "metrics", "n_records",
+                                               "summaries", "time"])
+
+
+def _can_validate_resources_separately(ds):
+    if ds.__class__.__name__ not in DatasetTypes.ALL:
+        return False
+    try:
+        # filtered records can't be selected from the files alone
+        if len(ds.filters) > 0:
+            return False
+        return len(ds.toExternalFiles()) > 1
+    except Exception as e:
+        log.warning("Can't list the resources of %s: %s", ds, e)
+        return False
+
+
+def _validate_resource(path, is_bam, aligned, contents, profile=False):
+    """
+    Worker function: run the file-level and record-level validators of a
+    dataset on one of its resources.
+    """
+    t_start = time.time()
+    if not os.path.isfile(path):
+        # handled separately by ValidateResources
+        return ResourceResult(path, [], [], [], {}, 0, {}, 0)
+    if is_bam:
+        file_validators = [bam.ValidateContents(aligned=aligned,
+                                                content_type=contents),
+                           bam.ValidateSorting()]
+        validators = bam.get_validators(aligned=aligned, contents=contents,
+                                        include_file_validators=False)
+        reader_class = bam._get_reader(path)
+        additional_validation_function = bam.validate_read_groups
+    else:
+        file_validators = [fasta.ValidateFastaRaw()]
+        validators = fasta.get_validators(validate_raw_format=False)
+        reader_class = fasta._fasta_reader
+        additional_validation_function = None
+    file_errors, file_passes = [], []
+    file_profile = new_profile()
+    file_times = file_profile["ValidatorTimes"]
+
+    def _apply(v, item):
+        t_apply = time.perf_counter()
+        result = apply_validator(v, item)
+        key = v.__class__.__name__
+        file_times[key] = (file_times.get(key, 0.0) +
+                           time.perf_counter() - t_apply)
+        if isinstance(result, list):
+            file_errors.extend(result)
+        elif isinstance(result, ValidatorError):
+            file_errors.append(result)
+        else:
+            file_passes.append(v.__class__.__name__)
+    for v in file_validators:
+        if isinstance(v, ValidateFile):
+            _apply(v, path)
+    try:
+        with reader_class(path) as reader:
+            for v in file_validators:
+                if isinstance(v, ValidateFileObject):
+                    _apply(v, reader)
+    except IOError as e:
+        # handled separately by ValidateResourcesOpen
+        log.warning("Can't open %s: %s", path, e)
+        file_passes.extend(v.__class__.__name__ for v in file_validators
+                           if isinstance(v, ValidateFileObject))
+    collectors = {j: _SummaryCollector(v) for j, v in enumerate(validators)
+                  if isinstance(v, ValidateRecordAcrossFile)}
+    counter = _RecordCounter()
+    validators = [collectors.get(j, v) for j, v in enumerate(validators)]
+    errors, metrics = run_validators(
+        context_class=ValidatorErrorContext,
+        path=path,
+        reader_class=reader_class,
+        validators=validators + [counter],
+        additional_validation_function=additional_validation_function,
+        profile=profile)
+    metrics.pop(_SummaryCollector.__name__, None)
+    n_records = metrics.pop(_RecordCounter.__name__, 0)
+    summaries = {j: c.summaries for j, c in collectors.items()}
+    if profile:
+        times = get_profile(metrics)["ValidatorTimes"]
+        times.pop(_RecordCounter.__name__, None)
+        # the collectors stand in for the validators checked across files
+        times.pop(_SummaryCollector.__name__, None)
+        for c in collectors.values():
+            key = c.validator.__class__.__name__
+            times[key] = times.get(key, 0.0) + c.time
+        file_profile["FileTime"] = sum(file_times.values())
+        add_profile(metrics, file_profile)
+    return ResourceResult(path, file_errors, file_passes, errors, metrics,
+                          n_records, summaries, time.time() - t_start)
+
+
+def _get_cached_resource_result(result_cache, path, is_bam, aligned, contents):
+    """
+    Return (cache key, cached ResourceResult or None) for a resource.
+    """
+    key = cache.get_cache_key(_validate_resource,
+                              cache.get_resource_files(path),
+                              dict(path=path, is_bam=is_bam, aligned=aligned,
+                                   contents=contents))
+    return key, result_cache.get(key)
+
+
+def _merge_summaries(results, errors, metrics, is_bam, aligned, contents):
+    """
+    Replay the summaries of the ValidateRecordAcrossFile validators across
+    all resources, in file order.
+    """
+    if is_bam:
+        validators = bam.get_validators(aligned=aligned, contents=contents,
+                                        include_file_validators=False)
+    else:
+        validators = fasta.get_validators(validate_raw_format=False)
+    profile = get_profile(metrics)
+    for j, v in enumerate(validators):
+        if not isinstance(v, ValidateRecordAcrossFile):
+            continue
+        n_passed = 0
+        t_start = time.perf_counter()
+        for result in results:
+            for i, summary in enumerate(result.summaries.get(j, [])):
+                ref = RecordRef(i, "{p} record {i}".format(p=result.path, i=i))
+                try:
+                    if isinstance(summary, Exception):
+                        raise summary
+                    if v.validate_summary(summary):
+                        n_passed += 1
+                        continue
+                    errors.extend(v.summary_to_errors(summary, ref))
+                except Exception as e:
+                    msg = "Unexpected {t} error validating {i}: {e}".format(
+                        i=ref, e=e, t=type(e).__name__)
+                    log.error(msg)
+                    errors.append(ValidatorError(msg))
+        key = v.__class__.__name__
+        if n_passed > 0:
+            metrics[key] = metrics.get(key, 0) + n_passed
+        if profile is not None:
+            times = profile["ValidatorTimes"]
+            times[key] = (times.get(key, 0.0) +
+                          time.perf_counter() - t_start)
+
+
+def _validate_resources_parallel(ds, file_name, reader_class, validators,
+                                 aligned, contents, nproc, profile=False,
+                                 result_cache=None):
+    """
+    Validate the dataset XML in this process and its resources in nproc
+    worker processes, and merge the results.  With a result_cache (see
+    cache.ValidationCache), the result for each resource is cached by the
+    fingerprints of the resource and its index files, so that only the
+    resources that changed are validated again.
+    """
+    is_bam = ds.__class__.__name__ in DatasetTypes.BAM_DATASET
+    resources = ds.toExternalFiles()
+    count_records = not ds.isIndexed
+    if count_records:
+        validators = [v for v in validators
+                      if not isinstance(v, ValidateNumRecords)]
+    cache_keys, cached = {}, {}
+    if result_cache is not None and not profile:
+        for path in resources:
+            cache_keys[path], result = _get_cached_resource_result(
+                result_cache, path, is_bam, aligned, contents)
+            if result is not None:
+                log.info("Using cached validation results for %s", path)
+                cached[path] = result._replace(time=0.0)
+    uncached = [path for path in resources if path not in cached]
+    log.info("Validating {n} resources of {f} with {p} processes".format(
+        n=len(uncached), f=file_name, p=nproc))
+    pool = None
+    if len(uncached) > 0:
+        pool = multiprocessing.Pool(min(nproc, len(uncached)))
+    try:
+        _results = {path: pool.apply_async(_validate_resource,
+                                           (path, is_bam, aligned, contents,
+                                            profile))
+                    for path in uncached}
+        if pool is not None:
+            pool.close()
+        errors, metrics = run_validators(
+            context_class=ValidatorErrorContext,
+            path=file_name,
+            reader_class=reader_class,
+            validators=validators,
+            profile=profile)
+        results = [cached[path] if path in cached else _results[path].get()
+                   for path in resources]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    for result in results:
+        if result.path in cache_keys and not result.path in cached:
+            try:
+                result_cache.put(cache_keys[result.path], result._replace(
+                    file_errors=cache.to_cached_errors(result.file_errors),
+                    errors=cache.to_cached_errors(result.errors)))
+            except Exception as e:
+                log.warning("Can't write validation results to cache: %s", e)
+    if count_records:
+        nr_actual = sum(r.n_records for r in results)
+        if ds.numRecords > nr_actual:
+            errors.append(NumRecordsError.from_args(ds, ds.numRecords,
+                                                    nr_actual))
+        else:
+            metrics[ValidateNumRecords.__name__] = 1
+    # the file-level validators report each kind of error once per dataset
+    file_errors = []
+    for result in results:
+        for error in result.file_errors:
+            if error not in file_errors:
+                file_errors.append(error)
+    errors.extend(file_errors)
+    if is_bam:
+        file_validator_names = [ValidateContents.__name__,
+                                ValidateSorting.__name__]
+    else:
+        file_validator_names = [ValidateFastaRaw.__name__]
+    for name in file_validator_names:
+        if all(name in r.file_passes for r in results):
+            metrics[name] = 1
+    resource_times = []
+    for result in results:
+        log.info("Validated {p} ({n} records) in {t:.2f}s".format(
+            p=result.path, n=result.n_records, t=result.time))
+        resource_times.append((result.path, result.time))
+        errors.extend(result.errors)
+        for key, n in result.metrics.items():
+            if key == PROFILE:
+                add_profile(metrics, n)
+            else:
+                metrics[key] = metrics.get(key, 0) + n
+    _merge_summaries(results, errors, metrics, is_bam, aligned, contents)
+    metrics[Constants.RESOURCE_TIMES] = resource_times
+    return errors, metrics
+
+
 def validate_dataset(
         file_name,
         dataset_type=None,
@@ -589,7 +889,24 @@ def validate_dataset(
         aligned=None,
         validate_index=False,
         strict=False,
-        instrument_mode=False):
+        instrument_mode=False,
+        sample_size=None,
+        sample_fraction=None,
+        sample_seed=None,
+        nproc=1,
+        profile=False,
+        result_cache=None):
+    """
+    Main API entry point for validating dataset XML and the files it
+    references.  With nproc > 1, the resources of an unfiltered dataset are
+    validated in parallel worker processes, one resource per task, and the
+    time spent on each resource is reported in the metrics as
+    Constants.RESOURCE_TIMES.  With profile=True, the time spent in each
+    validator is reported in the metrics (see core.get_profile); for
+    parallel runs the times are summed over the worker processes.  If a
+    result_cache is given, the resources are validated separately in the
+    same way (even with nproc=1) and their results are cached.
+    """
     assert os.path.isfile(os.path.realpath(file_name))
     ds = None
     ReaderClass = getattr(pbcore.io, str(dataset_type), pbcore.io.openDataSet)
@@ -654,6 +971,7 @@ def validate_dataset(
             ValidateFileName(file_name),
             ValidateDatasetTags()
         ])
+    n_dataset = len(validators)
     additional_validation_function = None
     opened_class_name = ds.__class__.__name__
     # XXX not sure this is ideal - what if it opens as a ReferenceSet but we
@@ -683,12 +1001,30 @@ def validate_dataset(
         quick=quick,
         max_errors=max_errors,
         max_records=max_records)
+    sampling = sample_size is not None or sample_fraction is not None
+    if ((nproc > 1 or result_cache is not None) and
+            context_class is ValidatorErrorContext and
+            not sampling and _can_validate_resources_separately(ds)):
+        def MetadataReader_wrapper(*args, **kwds):
+            logging.disable(logging.CRITICAL)
+            try:
+                return _DatasetMetadataReader(ReaderClass, *args, **kwds)
+            finally:
+                logging.disable(logging.NOTSET)
+        return _validate_resources_parallel(
+            ds, file_name, MetadataReader_wrapper, validators[:n_dataset],
+            aligned, contents, nproc, profile=profile,
+            result_cache=result_cache)
     errors, metrics = run_validators(
         context_class=context_class,
         path=file_name,
         reader_class=ReaderClass_wrapper,
         validators=validators,
-        additional_validation_function=additional_validation_function)
+        additional_validation_function=additional_validation_function,
+        sample_size=sample_size,
+        sample_fraction=sample_fraction,
+        sample_seed=sample_seed,
+        profile=profile)
     return errors, metrics
 
 
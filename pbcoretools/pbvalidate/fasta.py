@@ -6,12 +6,16 @@ pbcore.io without raising an exception.
 """
 
 import argparse
+import hashlib
 import logging
+import array
 import gzip
 import re
 import os.path as op
 import sys
 
+import numpy as np
+
 import pbcore.io
 
 from pbcoretools.pbvalidate.core import *
@@ -25,6 +29,91 @@ class Constants:
     ILLEGAL_NUCLEOTIDES = r"([^gatcuryswkmbdhvnGATCURYSWKMBDHVN]+)"
     ILLEGAL_NUC_STRICT = r"([^gatcnGATCN]+)"
     ILLEGAL_IDENTIFIER = r"([\,\:\"]+)"
+    RAW_BLOCK_SIZE = 64 * 1024 * 1024
+    LF = ord("\n")
+    CR = ord("\r")
+    GT = ord(">")
+
+
+# bytes matched by \s, plus all non-ASCII bytes since these may be part of
+# Unicode whitespace; lines starting or ending with any of them are checked
+# with the OUTER_WHITESPACE regex
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[9, 10, 11, 12, 13, 28, 29, 30, 31, 32]] = True
+_WHITESPACE[0x80:] = True
+
+
+def _get_allowed_bytes(pattern):
+    """
+    Return the bytes not matched by a character class pattern, i.e. a
+    256-entry lookup table in the form accepted by bytes.translate.
+    """
+    regex = re.compile(pattern)
+    return bytes(b for b in range(256) if not regex.match(chr(b)))
+
+
+def _has_illegal_bytes(s, allowed):
+    # bytes.translate applies the table in C.  Non-ASCII characters become
+    # bytes >= 0x80, which like the characters themselves are illegal in
+    # sequences but allowed in identifiers
+    return len(s.encode("utf-8", "replace").translate(None, allowed)) > 0
+
+
+_NUCLEOTIDES = _get_allowed_bytes(Constants.ILLEGAL_NUCLEOTIDES)
+_NUC_STRICT = _get_allowed_bytes(Constants.ILLEGAL_NUC_STRICT)
+_IDENTIFIER = _get_allowed_bytes(Constants.ILLEGAL_IDENTIFIER)
+
+
+def _get_fingerprint(s):
+    """
+    Return a non-zero 64-bit fingerprint of a string, from a BLAKE2b digest
+    (unlike hash(), this is the same in every process).
+    """
+    digest = hashlib.blake2b(s.encode("utf-8", "surrogatepass"),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class _FingerprintSet:
+
+    """
+    Set of non-zero 64-bit fingerprints, stored in an open-addressing hash
+    table of unsigned 64-bit integers that is kept at most half full, i.e.
+    8 to 16 bytes per entry instead of about 70 for a set of Python ints.
+    """
+
+    def __init__(self, size=1 << 16):
+        self._slots = array.array("Q", bytes(8 * size))
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def add(self, fingerprint):
+        """Add a fingerprint, and return False if it was already present"""
+        slots = self._slots
+        mask = len(slots) - 1
+        i = fingerprint & mask
+        while True:
+            value = slots[i]
+            if value == fingerprint:
+                return False
+            elif value == 0:
+                break
+            i = (i + 1) & mask
+        slots[i] = fingerprint
+        self._n += 1
+        if 2 * self._n > len(slots):
+            self._resize()
+        return True
+
+    def _resize(self):
+        old_slots = self._slots
+        self._slots = array.array("Q", bytes(16 * len(old_slots)))
+        self._n = 0
+        for value in old_slots:
+            if value != 0:
+                self.add(value)
 
 
 class FastaError (ValidatorError):
@@ -140,10 +229,7 @@ class ValidateFastaIdentifier (ValidateRecord):
     """Check for illegal characters in the FASTA identifier"""
 
     def validate(self, rec):
-        bad_header = re.findall(Constants.ILLEGAL_IDENTIFIER, rec.id)
-        if bad_header:
-            return False
-        return True
+        return not _has_illegal_bytes(rec.id, _IDENTIFIER)
 
     def to_error(self, rec):
         bad_header = re.findall(Constants.ILLEGAL_IDENTIFIER, rec.id)
@@ -165,21 +251,24 @@ class ValidateFastaIdentifierStart (ValidateRecord):
         return IdentifierAsteriskError.from_args(rec, rec.id)
 
 
-class ValidateFastaIdentifierUnique (ValidateRecord):
+class ValidateFastaIdentifierUnique (ValidateRecordAcrossFile):
 
     """Verify that a FASTA identifier is unique within the file"""
 
     def __init__(self):
-        self._known_identifiers = set()
+        # fingerprints rather than the identifiers themselves, to bound the
+        # memory used by files with millions of records
+        self._known_identifiers = _FingerprintSet()
 
-    def validate(self, rec):
-        if rec.id in self._known_identifiers:
-            return False
-        self._known_identifiers.add(rec.id)
-        return True
+    def get_record_summary(self, rec):
+        # the fingerprint is computed by the worker processes, if any
+        return rec.id, _get_fingerprint(rec.id)
 
-    def to_error(self, rec):
-        return DuplicateIdError.from_args(rec, rec.id)
+    def validate_summary(self, summary):
+        return self._known_identifiers.add(summary[1])
+
+    def summary_to_errors(self, summary, rec):
+        return [DuplicateIdError.from_args(rec, summary[0])]
 
 
 class ValidateFastaNucleotides (ValidateRecord):
@@ -192,106 +281,208 @@ class ValidateFastaNucleotides (ValidateRecord):
 
     def __init__(self, strict=False):
         self._use_regex = Constants.ILLEGAL_NUCLEOTIDES
+        self._allowed = _NUCLEOTIDES
         if strict:
             self._use_regex = Constants.ILLEGAL_NUC_STRICT
+            self._allowed = _NUC_STRICT
+        self._last_bad_nuc = (None, None)
 
-    def validate(self, rec):
+    def _find_bad_nucleotides(self, rec):
+        sequence = rec.sequence[:]
+        if not _has_illegal_bytes(sequence, self._allowed):
+            return []
         # already checked for trailing or leading whitespace
-        bad_nuc = re.findall(self._use_regex, rec.sequence[:].strip())
-        return len(bad_nuc) == 0
+        bad_nuc = re.findall(self._use_regex, sequence.strip())
+        if bad_nuc:
+            # keep the result for to_error, so the regex runs only once
+            self._last_bad_nuc = (rec, bad_nuc)
+        return bad_nuc
+
+    def validate(self, rec):
+        return len(self._find_bad_nucleotides(rec)) == 0
 
     def to_error(self, rec):
-        bad_nuc = re.findall(self._use_regex, rec.sequence[:].strip())
+        last_rec, bad_nuc = self._last_bad_nuc
+        self._last_bad_nuc = (None, None)
+        if last_rec is not rec:
+            bad_nuc = re.findall(self._use_regex, rec.sequence[:].strip())
         return BadNucleotideError.from_args(rec, rec.name, str(bad_nuc))
 
 
-# FIXME this can only return a single error, but there may be multiple
-# different problems with the raw format.
 class ValidateFastaRaw (ValidateFile):
 
     """
     Since pbcore.io processes line wrapping automatically and doesn't care
     whether or not it's consistent, this validator will examine the raw file
-    content line by line.
+    content.  The file is read in large blocks of whole lines; line lengths,
+    line endings and the first and last byte of each line are computed with
+    NumPy, so only headers and malformed lines are examined one by one.  As
+    in text mode, a CR that is not followed by LF also ends a line.  All
+    errors found are reported.
     """
 
     def __init__(self):
         self._errors = []
 
-    def validate(self, path):
-        all_seq_line_lengths = set([])
-        single_line_lengths = set([])
-        current_seq_line_lengths = []
-
-        def check_current_sequence_lines(lines, label):
-            if current_seq_line_lengths:
-                if len(current_seq_line_lengths) == 1:  # all one line
-                    return  # if current_seq_line_lengths[0] > 80:
-                    # self._errors.append(
-                    #   NoWrappingError.from_args(path, label))
-                elif (current_seq_line_lengths[-1] >
-                      current_seq_line_lengths[-2] or
-                      len(set(current_seq_line_lengths[:-1])) > 1):
-                    # last line is longer than previous line, or
-                    # multiple wrapping lengths in this sequence
-                    self._errors.append(
-                        SeqWrappingError.from_args(path, label))
-                else:
-                    # consistent wrapping for this sequence at least, save
-                    # length for later
-                    all_seq_line_lengths.add(current_seq_line_lengths[0])
-
+    def _reset(self, path):
+        self._path = path
+        self._errors = []
+        self._line_offset = 0
+        self._is_dos = self._is_unix = self._is_mac = False
+        self._prev_line_was_header = False
+        self._prev_header = None
+        # line lengths of the current sequence: count, first, last two,
+        # and whether any line but the last differs from the first
+        self._n_lines = self._first = self._prev = self._last = 0
+        self._mismatch = False
+
+    def _iter_blocks(self, path):
+        """Yield blocks of the file that end at a line break (except the last)"""
         def _open(file_name):
             if file_name.endswith(".gz"):
-                return gzip.open(file_name, mode="rt")
+                return gzip.open(file_name, mode="rb")
             else:
-                return open(file_name, mode="rt")
-        is_dos = is_unix = False
+                return open(file_name, mode="rb")
         with _open(path) as f:
-            prev_line_was_header = False
-            prev_header = None
-            for i, line in enumerate(f):
-                if line.endswith("\n"):
-                    if line.endswith("\r\n"):
-                        is_dos = True
-                    else:
-                        is_unix = True
-                line = line.rstrip('\n').rstrip('\r')
-                if line.strip() == "":
-                    self._errors.append(EmptyLineError.from_args(path, i + 1))
-                elif re.search(Constants.OUTER_WHITESPACE, line):
-                    prev_line_was_header = False
-                    self._errors.append(
-                        WhitespaceError.from_args(path, i + 1, line))
-                elif line.startswith(">"):
-                    if prev_line_was_header:
-                        self._errors.append(
-                            MissingSequenceError.from_args(path, prev_header))
-                    prev_line_was_header = True
-                    check_current_sequence_lines(current_seq_line_lengths,
-                                                 label=prev_header)
-                    if ">" in line[1:]:
-                        self._errors.append(ExtraGTError.from_args(path, line))
-                    current_seq_line_lengths = []
-                    prev_header = line[1:].strip()
-                else:
-                    prev_line_was_header = False
-                    current_seq_line_lengths.append(len(line))
-            if prev_line_was_header:
+            tail = b""
+            while True:
+                data = f.read(Constants.RAW_BLOCK_SIZE)
+                if not data:
+                    break
+                if tail:
+                    data = tail + data
+                k = data.rfind(b"\n") + 1
+                tail = data[k:]
+                if k > 0:
+                    yield data[:k] if tail else data
+            if tail:
+                yield tail
+
+    def _add_sequence_line(self, length):
+        self._prev_line_was_header = False
+        if self._n_lines == 0:
+            self._first = length
+        elif self._last != self._first:
+            self._mismatch = True
+        self._prev, self._last = self._last, length
+        self._n_lines += 1
+
+    def _add_sequence_lines(self, lengths):
+        if len(lengths) <= 2:
+            for length in lengths.tolist():
+                self._add_sequence_line(length)
+            return
+        self._prev_line_was_header = False
+        if self._n_lines == 0:
+            self._first = int(lengths[0])
+        elif self._last != self._first:
+            self._mismatch = True
+        if np.any(lengths[:-1] != self._first):
+            self._mismatch = True
+        self._prev, self._last = int(lengths[-2]), int(lengths[-1])
+        self._n_lines += len(lengths)
+
+    def _check_sequence_lines(self):
+        # a single line is fine; otherwise the last line may be shorter than
+        # the others, which must all have the same length
+        if self._n_lines > 1 and (self._last > self._prev or self._mismatch):
+            self._errors.append(
+                SeqWrappingError.from_args(self._path, self._prev_header))
+        self._n_lines = 0
+        self._mismatch = False
+
+    def _check_line(self, line_number, line):
+        path = self._path
+        if line.strip() == "":
+            self._errors.append(EmptyLineError.from_args(path, line_number))
+        elif re.search(Constants.OUTER_WHITESPACE, line):
+            self._prev_line_was_header = False
+            self._errors.append(
+                WhitespaceError.from_args(path, line_number, line))
+        elif line.startswith(">"):
+            if self._prev_line_was_header:
                 self._errors.append(
-                    MissingSequenceError.from_args(path, prev_header))
-        check_current_sequence_lines(current_seq_line_lengths,
-                                     label=prev_header)
+                    MissingSequenceError.from_args(path, self._prev_header))
+            self._prev_line_was_header = True
+            self._check_sequence_lines()
+            if ">" in line[1:]:
+                self._errors.append(ExtraGTError.from_args(path, line))
+            self._prev_header = line[1:].strip()
+        else:
+            self._add_sequence_line(len(line))
+
+    def _scan_block(self, data):
+        arr = np.frombuffer(data, dtype=np.uint8)
+        is_break = arr == Constants.LF
+        crs = np.flatnonzero(arr == Constants.CR)
+        if len(crs) > 0:
+            # old Mac line endings (blocks never end between CR and LF)
+            after = np.minimum(crs + 1, len(arr) - 1)
+            lone_crs = crs[(crs + 1 == len(arr)) |
+                           (arr[after] != Constants.LF)]
+            if len(lone_crs) > 0:
+                self._is_mac = True
+                is_break[lone_crs] = True
+        ends = np.flatnonzero(is_break)
+        is_lf = arr[ends] == Constants.LF
+        if len(arr) > 0 and not is_break[-1]:
+            # last line of a file without a final line break
+            ends = np.append(ends, len(arr))
+            is_lf = np.append(is_lf, False)
+        starts = np.empty_like(ends)
+        starts[:1] = 0
+        starts[1:] = ends[:-1] + 1
+        is_cr = (is_lf & (ends > starts) &
+                 (arr[np.maximum(ends - 1, 0)] == Constants.CR))
+        self._is_dos |= bool(np.any(is_cr))
+        self._is_unix |= bool(np.any(is_lf & ~is_cr))
+        content_ends = ends - is_cr
+        lengths = content_ends - starts
+        nonempty = lengths > 0
+        if len(arr) > 0 and arr.max() >= 0x80:
+            # count characters rather than bytes, as in text mode, by not
+            # counting UTF-8 continuation bytes
+            n_cont = np.zeros(len(arr) + 1, dtype=np.int64)
+            np.cumsum((arr & 0xC0) == 0x80, out=n_cont[1:])
+            lengths = lengths - (n_cont[content_ends] - n_cont[starts])
+        first = np.zeros(len(ends), dtype=np.uint8)
+        last = np.zeros(len(ends), dtype=np.uint8)
+        first[nonempty] = arr[starts[nonempty]]
+        last[nonempty] = arr[content_ends[nonempty] - 1]
+        malformed = ~nonempty | _WHITESPACE[first] | _WHITESPACE[last]
+        special = np.flatnonzero(malformed | (first == Constants.GT))
+        k_prev = -1
+        for k in special.tolist():
+            if k > k_prev + 1:
+                self._add_sequence_lines(lengths[k_prev + 1:k])
+            line = data[starts[k]:content_ends[k]].decode("utf-8", "replace")
+            self._check_line(self._line_offset + k + 1, line)
+            k_prev = k
+        if len(ends) > k_prev + 1:
+            self._add_sequence_lines(lengths[k_prev + 1:])
+        self._line_offset += len(ends)
+
+    def validate(self, path):
+        self._reset(path)
+        for data in self._iter_blocks(path):
+            self._scan_block(data)
+        if self._prev_line_was_header:
+            self._errors.append(
+                MissingSequenceError.from_args(path, self._prev_header))
+        self._check_sequence_lines()
         # XXX disabled as this is no longer relevant
         # if len(all_seq_line_lengths) > 1:
         #    self._errors.append(GlobalWrappingError.from_args(path))
-        if is_dos and is_unix:
+        if self._is_dos + self._is_unix + self._is_mac > 1:
             self._errors.append(LineEndingsError.from_args(path))
         return len(self._errors) == 0
 
     def to_error(self, path):
         return self._errors[0]
 
+    def to_errors(self, path):
+        return list(self._errors)
+
 
 def get_format_specific_args(parser):
     pass
@@ -329,9 +520,19 @@ def validate_fasta(
         quick=False,
         max_errors=None,
         validate_index=False,
-        out=sys.stdout):
+        out=sys.stdout,
+        nproc=1,
+        sample_size=None,
+        sample_fraction=None,
+        sample_seed=None,
+        profile=False):
     """
-    Main API entry point for validating Fasta files.
+    Main API entry point for validating Fasta files.  With nproc > 1 and a
+    .fai index, the records are validated in parallel worker processes; with
+    sample_size or sample_fraction, only a random sample of the records is
+    validated (this requires a .fai index).  With profile=True, the time
+    spent in each validator is reported in the metrics (see
+    core.get_profile).
 
     Example:
 
@@ -344,9 +545,18 @@ def validate_fasta(
         0
     """
     validators = get_validators(strict, validate_index=validate_index)
+    reader_class = pbcore.io.FastaReader
+    sampling = sample_size is not None or sample_fraction is not None
+    if (nproc > 1 or sampling) and op.isfile(file_name + ".fai"):
+        reader_class = pbcore.io.IndexedFastaReader
     errors, metrics = run_validators(
         context_class=get_context_class(quick, max_errors),
         path=file_name,
-        reader_class=pbcore.io.FastaReader,
-        validators=validators)
+        reader_class=reader_class,
+        validators=validators,
+        nproc=nproc,
+        sample_size=sample_size,
+        sample_fraction=sample_fraction,
+        sample_seed=sample_seed,
+        profile=profile)
     return errors, metrics
@@ -25,7 +25,9 @@ from pbcommand.models import FileTypes
 from pbcommand.utils import setup_log
 
 from pbcoretools.utils import get_base_parser
+from .core import get_sample_coverage
 from . import bam
+from . import cache
 from . import fasta
 from . import dataset
 from . import utils
@@ -49,6 +51,40 @@ def get_parser():
                         type=int,
                         help="Exit after MAX_RECORDS have been inspected " +
                              "(DEFAULT: check entire file)")
+    sample = parser.add_mutually_exclusive_group()
+    sample.add_argument("--sample", dest="sample_size", action="store",
+                        type=int, default=None,
+                        help="Validate a random sample of SAMPLE_SIZE " +
+                             "records spread across the whole file; " +
+                             "requires a .pbi or .fai index")
+    sample.add_argument("--sample-fraction", dest="sample_fraction",
+                        action="store", type=float, default=None,
+                        help="Validate a random sample of this fraction " +
+                             "of the records")
+    parser.add_argument("--sample-seed", dest="sample_seed", action="store",
+                        type=int, default=None,
+                        help="Random seed for --sample/--sample-fraction")
+    parser.add_argument("--cache-dir", dest="cache_dir", action="store",
+                        default=None,
+                        help="Reuse the results of earlier runs on " +
+                             "unchanged files, cached in this directory, " +
+                             "which must belong to the current user " +
+                             "(DEFAULT: $%s if set, otherwise no caching)" %
+                             cache.Constants.CACHE_DIR_ENV)
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+                        help="Always validate, even if a cache directory " +
+                             "is set")
+    parser.add_argument("--cache-size", dest="cache_size", action="store",
+                        type=int,
+                        default=cache.Constants.MAX_SIZE // (1024 * 1024),
+                        help="Maximum size of the cache in MB; the least " +
+                             "recently used results are removed first " +
+                             "(DEFAULT: %(default)s)")
+    parser.add_argument("--nproc", dest="nproc", action="store", type=int,
+                        default=1,
+                        help="Number of processes for validating records " +
+                             "of indexed BAM or FASTA files, or the " +
+                             "resources of a dataset (DEFAULT: 1)")
     parser.add_argument("--type", dest="file_type", action="store",
                         choices=["BAM", "Fasta"] + dataset.DatasetTypes.ALL,
                         help="Use the specified file type instead of guessing")
@@ -62,6 +98,11 @@ def get_parser():
                         default=None, help="Xunit test results for Jenkins")
     parser.add_argument("--alarms", dest="alarms_out", action="store",
                         default=None, help="alarms.json for errors")
+    parser.add_argument("--json-report", dest="json_report", action="store",
+                        default=None,
+                        help="Write a JSON report with error counts and " +
+                             "samples, and the time spent in each " +
+                             "validator (disables the result cache)")
     g1 = parser.add_argument_group('bam', "BAM options")
     g2 = parser.add_argument_group('fasta', "Fasta options")
     bam.get_format_specific_args(g1)
@@ -85,16 +126,37 @@ class run_validator:
         if args.quiet:
             out = StringIO()
         self.t_start = time.time()
+        profile = args.json_report is not None
+        cache_dir = None
+        if args.use_cache:
+            cache_dir = cache.get_cache_dir(args.cache_dir)
+        sampling = (args.sample_size is not None or
+                    args.sample_fraction is not None)
+        # cached results would not have meaningful timings
+        result_cache = None
+        if (cache_dir is not None and not profile and
+                not (sampling and args.sample_seed is None)):
+            result_cache = cache.ValidationCache(cache_dir,
+                                                 args.cache_size * 1024 * 1024)
+        sample_options = dict(sample_size=args.sample_size,
+                              sample_fraction=args.sample_fraction,
+                              sample_seed=args.sample_seed)
         if (args.file_type == "Fasta" or
                 (args.file_type is None and ext in FASTA_EXTENSIONS)):
-            self.errors, self.metrics = fasta.validate_fasta(
+            validate_func = fasta.validate_fasta
+            options = dict(
                 file_name=args.file,
                 strict=args.strict,
                 validate_index=args.validate_index,
-                quick=args.quick)
+                quick=args.quick,
+                nproc=args.nproc,
+                profile=profile,
+                **sample_options)
+            input_files = [args.file, args.file + ".fai"]
         elif (args.file_type == "BAM" or
               (args.file_type is None and ext in [".bam"])):
-            self.errors, self.metrics = bam.validate_bam(
+            validate_func = bam.validate_bam
+            options = dict(
                 file_name=args.file,
                 reference=args.reference,
                 aligned=args.aligned,
@@ -102,10 +164,17 @@ class run_validator:
                 quick=args.quick,
                 max_errors=args.max_errors,
                 max_records=args.max_records,
-                validate_index=args.validate_index)
+                validate_index=args.validate_index,
+                nproc=args.nproc,
+                profile=profile,
+                **sample_options)
+            input_files = [args.file, args.file + ".pbi"]
+            if args.reference is not None:
+                input_files.extend([args.reference, args.reference + ".fai"])
         elif (args.file_type in ["AlignmentSet", "ReferenceSet", "SubreadSet"] or
               ext in [".xml"]):
-            self.errors, self.metrics = dataset.validate_dataset(
+            validate_func = dataset.validate_dataset
+            options = dict(
                 file_name=args.file,
                 dataset_type=args.file_type,
                 reference=args.reference,
@@ -116,14 +185,37 @@ class run_validator:
                 contents=args.contents,
                 validate_index=True,
                 strict=args.strict,
-                instrument_mode=args.instrument_mode)
+                instrument_mode=args.instrument_mode,
+                nproc=args.nproc,
+                profile=profile,
+                result_cache=result_cache,
+                **sample_options)
+            input_files = None
+            if result_cache is not None:
+                input_files = cache.get_dataset_files(args.file,
+                                                      args.reference)
         else:
             raise NotImplementedError("No validator found for '%s'." % ext)
+        if result_cache is not None:
+            self.errors, self.metrics = cache.run_cached(
+                validate_func, input_files, options, result_cache)
+        else:
+            self.errors, self.metrics = validate_func(**options)
         self.t_end = time.time()
         if not args.quiet:
             utils.show_validation_errors(self.errors, out=out)
+            coverage = get_sample_coverage(self.metrics)
+            if coverage is not None:
+                utils.show_sample_coverage(coverage, len(self.errors),
+                                           out=out)
         if args.alarms_out:
             utils.dump_alarms_json(self.errors, args.alarms_out)
+        if args.json_report is not None:
+            utils.dump_json_report(
+                args.json_report, self.file_name, self.errors, self.metrics,
+                self.time,
+                resource_times=self.metrics.get(
+                    dataset.Constants.RESOURCE_TIMES))
         if args.xunit_out is not None:
             doc = self.to_xml()
             with open(args.xunit_out, "w") as xml_out:
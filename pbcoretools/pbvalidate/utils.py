@@ -4,6 +4,9 @@ import logging
 import json
 import sys
 
+from .core import (get_profile, get_sample_coverage, SAMPLED_RECORDS,
+                   TOTAL_RECORDS)
+
 log = logging.getLogger(__name__)
 
 
@@ -49,6 +52,22 @@ def show_validation_errors(errors, out=sys.stdout, verbose=False):
         print(msg, file=out)
 
 
+def show_sample_coverage(coverage, n_errors, out=sys.stdout):
+    """
+    Display the fraction of records checked in sampling mode.  If no errors
+    were found, also show the upper bound (at 95% confidence) on the
+    fraction of invalid records in the whole file.
+    """
+    n_sampled, n_total = coverage
+    pct = 100.0 * n_sampled / n_total if n_total > 0 else 100.0
+    print("Validated a sample of %d of %d records (%.2f%%)" % (
+        n_sampled, n_total, pct), file=out)
+    if n_errors == 0 and 0 < n_sampled < n_total:
+        bound = 1 - 0.05 ** (1.0 / n_sampled)
+        print("  at most %.3g%% of all records are invalid (95%% confidence)" %
+              (100 * bound), file=out)
+
+
 def dump_alarms_json(errors, alarms_out):
     if len(errors) == 0:
         log.info("Not writing %s because no errors were found", alarms_out)
@@ -65,6 +84,84 @@ def dump_alarms_json(errors, alarms_out):
     return True
 
 
+def _get_validator_entries(metrics, profile, n_records):
+    times = profile["ValidatorTimes"] if profile is not None else {}
+    names = set(times)
+    names.update(k for k, v in metrics.items()
+                 if isinstance(v, int) and k not in [SAMPLED_RECORDS,
+                                                      TOTAL_RECORDS])
+    entries = []
+    for name in names:
+        seconds = times.get(name)
+        per_record = None
+        if seconds is not None and n_records:
+            per_record = seconds / n_records
+        entries.append({"name": name,
+                        "passed": metrics.get(name, 0),
+                        "seconds": seconds,
+                        "seconds_per_record": per_record})
+    # most expensive first
+    entries.sort(key=lambda e: (-(e["seconds"] or 0), e["name"]))
+    return entries
+
+
+def get_json_report(file_name, errors, metrics, wall_time,
+                    resource_times=None, max_samples=5):
+    """
+    Build a machine-readable summary of one pbvalidate run: error counts and
+    up to max_samples example messages per error class, and the number of
+    passing checks per validator class.  For runs with profile=True, also
+    the time spent in each validator, in the file-level and record-level
+    phases, and the number of records validated per second of wall time.
+    """
+    profile = get_profile(metrics)
+    n_records = profile["Records"] if profile is not None else None
+    report = {
+        "file": file_name,
+        "wall_time": wall_time,
+        "n_errors": len(errors),
+        "records": n_records,
+        "records_per_second": None,
+        "phases": None,
+        "validators": _get_validator_entries(metrics, profile, n_records),
+        "errors": [],
+    }
+    if profile is not None:
+        report["phases"] = {"file": profile["FileTime"],
+                            "record": profile["RecordTime"]}
+        if wall_time > 0:
+            report["records_per_second"] = n_records / wall_time
+    samples = {}
+    for error in errors:
+        name = error.__class__.__name__
+        if name not in samples:
+            samples[name] = {"type": name, "count": 0, "samples": []}
+            report["errors"].append(samples[name])
+        entry = samples[name]
+        entry["count"] += 1
+        if len(entry["samples"]) < max_samples:
+            object_ref = error.object_ref
+            entry["samples"].append({
+                "message": str(error),
+                "object": str(object_ref) if object_ref is not None else None
+            })
+    coverage = get_sample_coverage(metrics)
+    if coverage is not None:
+        report["sample"] = {"sampled": coverage[0], "total": coverage[1]}
+    if resource_times is not None:
+        report["resources"] = [{"path": path, "seconds": seconds}
+                               for path, seconds in resource_times]
+    return report
+
+
+def dump_json_report(json_out, *args, **kwds):
+    """Write the report from get_json_report(*args, **kwds) to json_out"""
+    report = get_json_report(*args, **kwds)
+    with open(json_out, "w") as out:
+        json.dump(report, out, indent=2)
+    return report
+
+
 def generate_multiple_file_junit_report(results, xml_out, skipped_files=()):
     """
     Produce JUnit-compatible output for multiple pbvalidate results (used in
@@ -3,6 +3,7 @@
 Simple gather tool for non-dataset file types
 """
 
+import functools
 import logging
 import os.path as op
 import sys
@@ -22,7 +23,10 @@ from pbcoretools.chunking.gather import (
     gather_vcf,
     gather_zip,
     gather_fofn,
+    gather_tgz,
     gather_bed,
+    gather_bed_sorted,
+    gather_csv_sorted,
     gather_datastore,
     gather_report)
 
@@ -41,17 +45,28 @@ def run_args(args):
         log.info("Wrote %s", args.output_file)
         return 0
 
-    fasta_gather = gather_fasta_contigset if args.join_contigs else gather_fasta
+    bed_gather = gather_bed_sorted if args.sorted else gather_bed
+    csv_gather = gather_csv
+    if args.sort_columns:
+        csv_gather = functools.partial(gather_csv_sorted,
+                                       sort_columns=args.sort_columns.split(","))
+    fasta_gather = gather_fasta
+    if args.join_contigs:
+        fasta_gather = gather_fasta_contigset
+    elif args.index_contigs:
+        fasta_gather = functools.partial(gather_fasta_contigset,
+                                         join_contigs=False)
     fastq_gather = gather_fastq_contigset if args.join_contigs else gather_fastq
     MODES = {
         ".gff": gather_gff,
         ".vcf": gather_vcf,
-        ".bed": gather_bed,
-        ".csv": gather_csv,
+        ".bed": bed_gather,
+        ".csv": csv_gather,
         ".fasta": fasta_gather,
         ".fastq": fastq_gather,
         ".json": gather_json,
         ".zip": gather_zip,
+        ".tgz": functools.partial(gather_tgz, nproc=args.nproc),
         '.fofn': gather_fofn
     }
     base, ext = op.splitext(args.output_file)
@@ -72,7 +87,23 @@ def _get_parser():
     p.add_argument("chunked_files", nargs="+", help="Chunked input files")
     p.add_argument("--join-contigs", action="store_true", default=False,
                    help="Merge split contigs")
+    p.add_argument("--index-contigs", action="store_true", default=False,
+                   help="Concatenate FASTA chunks by raw copy and write a "
+                        "merged .fai index and ContigSet XML for the output, "
+                        "without joining split contigs (ignored with "
+                        "--join-contigs)")
     p.add_argument("--dataset", help="Dataset XML for populating metadata")
+    p.add_argument("-j", "--nproc", dest="nproc", type=int, default=1,
+                   help="Number of threads to use for compressing .tgz output")
+    p.add_argument("--sorted", action="store_true", default=False,
+                   help="Merge coordinate-sorted BED chunks (by chrom, start, "
+                        "end) instead of concatenating them; chromosomes are "
+                        "ordered as they first appear in the chunks (ties in "
+                        "natural order), and unsorted chunks are an error")
+    p.add_argument("--sort-columns", action="store", default=None,
+                   help="Comma-separated CSV columns by which the chunks are "
+                        "already sorted; the output will be merged by these "
+                        "columns instead of concatenated")
     return p
 
 
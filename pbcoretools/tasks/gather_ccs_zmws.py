@@ -3,6 +3,7 @@ Gather gzipped JSON per-ZMW metrics from CCS
 """
 
 from collections import namedtuple
+import array
 import logging
 import gzip
 import json
@@ -11,10 +12,14 @@ import re
 import os.path as op
 import sys
 
+import numpy as np
+
 from pbcommand.cli import (pacbio_args_runner,
                            get_default_argparser_with_base_opts)
 from pbcommand.utils import setup_log
 
+from pbcoretools.utils import JsonStreamReader
+
 log = logging.getLogger(__name__)
 __version__ = "0.1"
 
@@ -51,23 +56,138 @@ class ZmwInfoEncoder(JSONEncoder):
         return JSONEncoder.default(self, obj)
 
 
-def gather_chunks(chunks, output_file):
-    ccs_zmws = []
-    for file_name in chunks:
-        with gzip.open(file_name, mode="rt") as gz_in:
-            d = json.loads(gz_in.read(), object_hook=_to_zmw_info_hook)
-            ccs_zmws.extend(d["zmws"])
+def _iter_json_zmws(file_name):
+    with gzip.open(file_name, mode="rt") as gz_in:
+        reader = JsonStreamReader(gz_in, object_hook=_to_zmw_info_hook)
+        for key in reader.iter_object():
+            if key != "zmws":
+                reader.read_value()
+                continue
+            for zmw in reader.iter_array():
+                yield zmw
+
+
+def _gather_chunks_json(chunks, output_file):
+    """
+    Stream the per-ZMW records from each chunk into the output file, so that
+    only one record at a time is held in memory.
+    """
+    encoder = ZmwInfoEncoder()
     with gzip.open(output_file, mode="wt") as gz_out:
-        gz_out.write(json.dumps({"zmws": ccs_zmws}, cls=ZmwInfoEncoder))
+        gz_out.write('{"zmws": [')
+        sep = ""
+        for file_name in chunks:
+            for zmw in _iter_json_zmws(file_name):
+                gz_out.write(sep + encoder.encode(zmw))
+                sep = ", "
+        gz_out.write("]}")
     return 0
 
 
+class ZmwColumns:
+    """
+    Columnar accumulator for per-ZMW metrics, stored as compact typed arrays
+    with the status strings encoded as indices into a list of names.
+    """
+    TYPECODES = [
+        ("insert_size", "q"),
+        ("polymerase_length", "q"),
+        ("predicted_accuracy", "d"),
+        ("num_full_passes", "q"),
+    ]
+    DTYPES = {
+        "insert_size": np.int32,
+        "polymerase_length": np.int32,
+        "predicted_accuracy": np.float32,
+        "num_full_passes": np.int32,
+        "status": np.uint8,
+    }
+    MAX_STATUS_NAMES = 256
+
+    def __init__(self):
+        self.columns = {name: array.array(code)
+                        for name, code in self.TYPECODES}
+        self.status = array.array("B")
+        self.status_names = []
+        self._status_codes = {}
+
+    def _status_code(self, status):
+        if not status in self._status_codes:
+            if len(self.status_names) == self.MAX_STATUS_NAMES:
+                raise ValueError(
+                    "Too many distinct ZMW status names (more than {n})".format(
+                        n=self.MAX_STATUS_NAMES))
+            self._status_codes[status] = len(self.status_names)
+            self.status_names.append(status)
+        return self._status_codes[status]
+
+    def add_zmw(self, zmw):
+        d = zmw.as_dict()
+        for name, _ in self.TYPECODES:
+            self.columns[name].append(d[name])
+        self.status.append(self._status_code(d["status"]))
+
+    def add_npz(self, file_name):
+        # the arrays are appended as raw bytes, without creating Python
+        # objects for the individual values
+        with np.load(file_name) as npz:
+            for name, code in self.TYPECODES:
+                self.columns[name].frombytes(
+                    npz[name].astype(np.dtype(code)).tobytes())
+            codes = np.array([self._status_code(str(s))
+                              for s in npz["status_names"]], dtype=np.uint8)
+            if len(codes) > 0:
+                self.status.frombytes(codes[npz["status"]].tobytes())
+
+    def save(self, file_name):
+        arrays = {name: np.asarray(values, dtype=self.DTYPES[name])
+                  for name, values in self.columns.items()}
+        arrays["status"] = np.asarray(self.status, dtype=np.uint8)
+        arrays["status_names"] = np.array(self.status_names, dtype=str)
+        np.savez(file_name, **arrays)
+
+
+def _gather_chunks_npz(chunks, output_file):
+    """
+    Gather per-ZMW metrics from JSON or .npz chunks into an uncompressed .npz
+    archive with one array per field; see load_zmw_columns.
+    """
+    columns = ZmwColumns()
+    for file_name in chunks:
+        if file_name.endswith(".npz"):
+            columns.add_npz(file_name)
+        else:
+            for zmw in _iter_json_zmws(file_name):
+                if not isinstance(zmw, ZmwInfo):
+                    raise ValueError(
+                        "Incomplete ZMW record in {f}".format(f=file_name))
+                columns.add_zmw(zmw)
+    columns.save(output_file)
+    return 0
+
+
+def load_zmw_columns(file_name):
+    """
+    Open a gathered .npz file, returning a mapping of field name to array;
+    arrays are only read when they are accessed.  The 'status' column holds
+    indices into 'status_names'.
+    """
+    return np.load(file_name)
+
+
+def gather_chunks(chunks, output_file):
+    if output_file.endswith(".npz"):
+        return _gather_chunks_npz(chunks, output_file)
+    return _gather_chunks_json(chunks, output_file)
+
+
 def _get_parser():
     p = get_default_argparser_with_base_opts(
         version=__version__,
         description=__doc__,
         default_level="INFO")
-    p.add_argument("merged", help="Name of merged json.gz")
+    p.add_argument("merged",
+                   help="Name of merged json.gz, or .npz for columnar output")
     p.add_argument("chunks", nargs="+", help="Chunk outputs")
     return p
 
@@ -19,6 +19,7 @@ from pbcore.io import ConsensusAlignmentSet, TranscriptAlignmentSet, TranscriptS
 
 from pbcoretools.file_utils import get_prefixes
 from pbcoretools.datastore_utils import dataset_to_datastore
+from pbcoretools.pbi_utils import reindex_pbis
 from pbcoretools.utils import get_base_parser
 
 
@@ -73,8 +74,12 @@ def consolidate_transcripts(ds_in, prefix):
                     for record in reader:
                         record.query_name = prefix + record.query_name
                         writer.write(record)
-        # create pbi and bai index files for new_resource_file
-        subprocess.check_call(["pbindex", new_resource_file])
+        # create pbi index file for new_resource_file, reusing the input
+        # indices if possible since only the read names have changed
+        pbi_files = [fn + ".pbi" for fn in external_files]
+        if not reindex_pbis(pbi_files, new_resource_file,
+                            new_resource_file + ".pbi"):
+            subprocess.check_call(["pbindex", new_resource_file])
         ds_in = TranscriptSet(new_resource_file)  # override ds_in
     return _consolidate_transcripts_f
 
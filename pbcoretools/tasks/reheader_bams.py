@@ -16,6 +16,7 @@ from pbcommand.utils import setup_log
 from pbcore.io import openDataSet
 
 from pbcoretools import file_utils
+from pbcoretools.pbi_utils import replace_bam_header, PbiError
 from pbcoretools.utils import get_base_parser
 
 log = logging.getLogger(__name__)
@@ -48,14 +49,23 @@ def reheader_bam(bam_file_in,
                 rg["LB"] = library_name
         if not was_changed:
             return False
-        log.debug("Writing modified header and records to %s", bam_file_out)
-        with pysam.AlignmentFile(bam_file_out,  # pylint: disable=no-member
-                                 "wb",
-                                 header=header) as bam_out:
-            for rec in bam_in:
-                bam_out.write(rec)
+    have_pbi = False
+    try:
+        log.debug("Writing modified header to %s", bam_file_out)
+        have_pbi = replace_bam_header(bam_file_in, bam_file_out, header)
+    except PbiError as e:
+        log.warning("Can't copy BAM records directly: %s", e)
+        with pysam.AlignmentFile(bam_file_in, "rb", check_sq=False) as bam_in:  # pylint: disable=no-member
+            log.debug("Writing modified header and records to %s",
+                      bam_file_out)
+            with pysam.AlignmentFile(bam_file_out,  # pylint: disable=no-member
+                                     "wb",
+                                     header=header) as bam_out:
+                for rec in bam_in:
+                    bam_out.write(rec)
+    subprocess.check_call(["samtools", "index", bam_file_out])
+    if not have_pbi:
         log.debug("Running pbindex")
-        subprocess.check_call(["samtools", "index", bam_file_out])
         subprocess.check_call(["pbindex", bam_file_out])
     return True
 
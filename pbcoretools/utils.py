@@ -4,6 +4,8 @@ These are easy to test and have zero side-effects.
 They should depend on nothing put Python standard library modules.
 """
 
+import json
+
 
 def split_filtStr(filtStr):
     """
@@ -36,3 +38,115 @@ def get_base_parser(description, log_level="INFO"):
         version=__VERSION__,
         description=description,
         default_level=log_level)
+
+
+class JsonStreamReader:
+    """
+    Incremental reader for a large JSON document from a text file handle,
+    decoding one object member or array item at a time so that memory use
+    is bounded by the size of the largest individual value.
+
+    ...doctest:
+        >>> import io
+        >>> r = JsonStreamReader(io.StringIO('{"a": 1, "b": [2, {"c": 3}]}'))
+        >>> [(k, r.read_value()) for k in r.iter_object()]
+        [('a', 1), ('b', [2, {'c': 3}])]
+        >>> r = JsonStreamReader(io.StringIO(' {"zmws": [1, 23, 456]} '),
+        ...                      bufsize=2)
+        >>> [list(r.iter_array()) for k in r.iter_object()]
+        [[1, 23, 456]]
+    """
+    WHITESPACE = " \t\n\r"
+    # characters that may end a number or literal in valid JSON
+    DELIMITERS = ",]}" + WHITESPACE
+
+    def __init__(self, handle, object_hook=None, bufsize=1024 * 1024):
+        self._handle = handle
+        self._decoder = json.JSONDecoder(object_hook=object_hook)
+        self._bufsize = bufsize
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        data = self._handle.read(self._bufsize)
+        if not data:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf):
+                c = self._buf[self._pos]
+                if c not in self.WHITESPACE:
+                    return c
+                self._pos += 1
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def _expect(self, c):
+        if self._peek() != c:
+            raise ValueError("Expected '{c}' at '{s}'".format(
+                c=c, s=self._buf[self._pos:self._pos + 20]))
+        self._pos += 1
+
+    def read_value(self):
+        """
+        Decode the next complete JSON value.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a number or literal is only complete if a delimiter follows;
+            # otherwise it may continue in the next block (e.g. '0.' or '1e')
+            if (self._buf[self._pos] not in '{["' and
+                    (end == len(self._buf) or
+                     self._buf[end] not in self.DELIMITERS) and
+                    self._fill()):
+                continue
+            self._pos = end
+            return value
+
+    def _iter_container(self, begin, end):
+        self._expect(begin)
+        if self._peek() == end:
+            self._pos += 1
+            return
+        while True:
+            yield
+            c = self._peek()
+            self._pos += 1
+            if c == end:
+                return
+            elif c != ",":
+                raise ValueError("Expected ',' or '{e}', found '{c}'".format(
+                    e=end, c=c))
+
+    def iter_object(self):
+        """
+        Iterate over the keys of the JSON object at the current position.
+        After each key the caller must consume the value, by calling either
+        read_value() or iter_array().
+        """
+        for _ in self._iter_container("{", "}"):
+            key = self.read_value()
+            self._expect(":")
+            yield key
+
+    def iter_array(self):
+        """
+        Iterate over the decoded items of the JSON array at the current
+        position.
+        """
+        for _ in self._iter_container("[", "]"):
+            yield self.read_value()
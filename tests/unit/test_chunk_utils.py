@@ -1,6 +1,8 @@
 import tempfile
 import sys
 
+import numpy as np
+
 from pbcore.io.FastaIO import FastaRecord, FastaWriter
 from pbcore.io import FastqWriter, ContigSet
 
@@ -9,6 +11,8 @@ from pbcoretools.chunking.chunk_utils import (write_pbcore_records,
                                               to_chunked_fasta_files,
                                               to_chunked_fastq_files,
                                               guess_optimal_max_nchunks_for_consensus)
+from pbcoretools.chunking.split_index import SplitIndex, ZMW_DTYPE
+import pbcoretools.chunking.chunk_utils as chunk_utils
 
 import mock
 
@@ -56,3 +60,72 @@ class TestChunkUtils:
         assert guess_optimal_max_nchunks_for_consensus(400000000) == 83
         assert guess_optimal_max_nchunks_for_consensus(sys.maxsize) == 96
         assert guess_optimal_max_nchunks_for_consensus(400000000, 24) == 24
+
+
+def _make_split_index():
+    rows = [
+        # movie, hole, nrecords, nbases, bcForward, bcReverse
+        (0, 1, 2, 20, 0, 0),
+        (0, 5, 1, 5, 0, 0),
+        (0, 9, 3, 9, 1, 1),
+        (1, 2, 1, 100, 1, 1),
+        (1, 4, 2, 2, 2, 2),
+    ]
+    table = np.zeros(len(rows), dtype=ZMW_DTYPE)
+    for i, (movie, hole, n, b, f, r) in enumerate(rows):
+        table[i]["movie"] = movie
+        table[i]["holeNumber"] = hole
+        table[i]["nrecords"] = n
+        table[i]["nbases"] = b
+        table[i]["bcForward"] = f
+        table[i]["bcReverse"] = r
+    table["cumRecords"] = np.cumsum(table["nrecords"])
+    table["cumBases"] = np.cumsum(table["nbases"])
+    return SplitIndex(table, ["m0", "m1"])
+
+
+class TestSplitIndex:
+
+    def test_zmw_chunks(self):
+        idx = _make_split_index()
+        assert idx.nrecords == 9
+        assert idx.nbases == 136
+        chunks = idx.zmw_chunks(2)
+        assert chunks == [
+            ([("m0", 1, 5)], 3, 25),
+            ([("m0", 9, 9), ("m1", 2, 4)], 6, 111)
+        ]
+        chunks = idx.zmw_chunks(10)
+        assert len(chunks) == 5
+        assert sum(c[1] for c in chunks) == 9
+        chunks = idx.zmw_chunks(2, balance="bases")
+        assert chunks == [
+            ([("m0", 1, 9), ("m1", 2, 2)], 7, 134),
+            ([("m1", 4, 4)], 2, 2)
+        ]
+
+    def test_barcode_chunks(self):
+        idx = _make_split_index()
+        assert idx.barcode_groups() == {
+            (0, 0): (3, 25),
+            (1, 1): (4, 109),
+            (2, 2): (2, 2)
+        }
+        chunks = idx.barcode_chunks(2)
+        assert chunks == [
+            ([(1, 1)], 4, 109),
+            ([(0, 0), (2, 2)], 5, 27)
+        ]
+
+    def test_split_barcodes_with_index_filters(self, monkeypatch):
+        idx = _make_split_index()
+        monkeypatch.setattr(chunk_utils.SplitIndex, "from_dataset",
+                            staticmethod(lambda dset, cache_dir: idx))
+        monkeypatch.setattr(chunk_utils, "_make_index_chunk",
+                            lambda dset, filters, n, nbases: filters)
+        chunks = chunk_utils.split_barcodes_with_index(None, 2, "/tmp")
+        # the same format as pbcore's DataSet.split(barcodes=True)
+        assert chunks == [
+            [dict(bc=[('=', "[1, 1]")])],
+            [dict(bc=[('=', "[0, 0]")]), dict(bc=[('=', "[2, 2]")])]
+        ]
@@ -4,14 +4,19 @@ import tempfile
 import tarfile
 import shutil
 import uuid
+import io
 import json
 import csv
 import os
 import logging
 
+import pytest
+
+from pbcore.io import ContigSet, FastaWriter
 from pbcommand.models.report import Report
 from pbcommand.pb_io.report import load_report_from_json
 
+from pbcoretools.utils import JsonStreamReader
 import pbcoretools.chunking.gather as G
 
 from base import get_temp_file, get_temp_dir
@@ -63,6 +68,135 @@ class TestCsvGather:
 
         assert nrecords == 157
 
+    def test_gather_csv_sorted(self):
+        t = get_temp_file(suffix="-records-1.csv")
+        with open(t, "w") as f:
+            f.write("id,alpha\n1,a\n5,b\n20,c\n")
+        t2 = get_temp_file(suffix="-records-2.csv")
+        with open(t2, "w") as f:
+            f.write("id,alpha\n")
+        t3 = get_temp_file(suffix="-records-3.csv")
+        with open(t3, "w") as f:
+            f.write("id,alpha\n3,d\n10,e")
+        tg = get_temp_file(suffix="records-gather.csv")
+        G.gather_csv_sorted([t, t2, t3], tg, ["id"])
+        with open(tg) as f:
+            lines = f.read().splitlines()
+        assert lines == ["id,alpha", "1,a", "3,d", "5,b", "10,e", "20,c"]
+        with open(t2, "w") as f:
+            f.write("id,alpha\n4,f\n2,g\n")
+        with pytest.raises(ValueError):
+            G.gather_csv_sorted([t, t2, t3], tg, ["id"])
+
+
+class TestBedGather:
+
+    def test_gather_bed_sorted(self):
+        bed_files = []
+        for records in [["chr1\t10\t20", "chr2\t5\t6"],
+                        ["chr1\t1\t5", "chr1\t15\t16", "chr3\t0\t1"]]:
+            bed_file = get_temp_file(suffix=".bed")
+            with open(bed_file, "w") as f:
+                f.write("#chr\tstart\tend\n")
+                f.write("\n".join(records) + "\n")
+            bed_files.append(bed_file)
+        bed_out = get_temp_file(suffix="-gathered.bed")
+        G.gather_bed_sorted(bed_files, bed_out)
+        with open(bed_out) as f:
+            lines = f.read().splitlines()
+        assert lines == ["#chr\tstart\tend", "chr1\t1\t5", "chr1\t10\t20",
+                         "chr1\t15\t16", "chr2\t5\t6", "chr3\t0\t1"]
+
+    def _write_bed_files(self, chunks):
+        bed_files = []
+        for records in chunks:
+            bed_file = get_temp_file(suffix=".bed")
+            with open(bed_file, "w") as f:
+                f.write("\n".join(records) + "\n")
+            bed_files.append(bed_file)
+        return bed_files
+
+    def test_gather_bed_sorted_reference_order(self):
+        bed_files = self._write_bed_files([
+            ["chr1\t5\t6", "chr2\t1\t2", "chr10\t3\t4"],
+            ["chr2\t0\t1", "chr9\t1\t2", "chr10\t1\t2"]])
+        bed_out = get_temp_file(suffix="-gathered.bed")
+        G.gather_bed_sorted(bed_files, bed_out)
+        with open(bed_out) as f:
+            chroms = [l.split("\t")[0] for l in f.read().splitlines()]
+        assert chroms == ["chr1", "chr2", "chr2", "chr9", "chr10", "chr10"]
+
+    def test_gather_bed_sorted_single_pass(self, monkeypatch):
+        bed_files = self._write_bed_files([
+            ["chrB\t5\t6", "chrA\t1\t2"],
+            ["chrB\t0\t1", "chrB\t7\t8", "chrA\t0\t1"]])
+        n_reads = []
+        _iter_txt_records = G._iter_txt_records
+
+        def _counting_iter(input_file):
+            n_reads.append(input_file)
+            return _iter_txt_records(input_file)
+        monkeypatch.setattr(G, "_iter_txt_records", _counting_iter)
+        bed_out = get_temp_file(suffix="-gathered.bed")
+        G.gather_bed_sorted(bed_files, bed_out)
+        assert sorted(n_reads) == sorted(bed_files)
+        with open(bed_out) as f:
+            lines = f.read().splitlines()
+        assert lines == ["chrB\t0\t1", "chrB\t5\t6", "chrB\t7\t8",
+                         "chrA\t0\t1", "chrA\t1\t2"]
+
+    def test_gather_bed_sorted_unsorted_input(self):
+        bed_out = get_temp_file(suffix="-gathered.bed")
+        for chunks in [[["chr1\t5\t6", "chr1\t1\t2"]],
+                       [["chr1\t1\t2", "chr2\t1\t2", "chr1\t3\t4"]],
+                       [["chr1\t1\t2", "chr2\t1\t2"],
+                        ["chr2\t1\t2", "chr1\t1\t2"]]]:
+            with pytest.raises(ValueError):
+                G.gather_bed_sorted(self._write_bed_files(chunks), bed_out)
+
+    def test_gather_bed(self):
+        bed_files = self._write_bed_files([
+            ["#chr\tstart\tend", "chr1\t1\t2 ", "", "#comment"],
+            ["#chr\tstart\tend", "chr2\t1\t2", "  ", "#other", "chr2\t3\t4"]])
+        bed_out = get_temp_file(suffix="-gathered.bed")
+        G.gather_bed(bed_files, bed_out)
+        with open(bed_out) as f:
+            lines = f.read().splitlines()
+        # only the header is parsed, the rest of each file is copied as is
+        assert lines == ["#chr\tstart\tend", "chr1\t1\t2 ", "", "#comment",
+                         "chr2\t1\t2", "  ", "#other", "chr2\t3\t4"]
+
+
+class TestFastxGather:
+
+    def _write_chunks(self, chunks, suffix):
+        file_names = []
+        for chunk in chunks:
+            file_name = get_temp_file(suffix=suffix)
+            with open(file_name, "w") as f:
+                f.write(chunk)
+            file_names.append(file_name)
+        return file_names
+
+    def test_gather_fasta_raw(self):
+        fasta_files = self._write_chunks(
+            [">r1\nACGT\nAC\n>r2\nGG", "", ">r3\nTT\n"], ".fasta")
+        fasta_out = get_temp_file(suffix="-gathered.fasta")
+        G.gather_fasta(fasta_files, fasta_out, count_records=True)
+        with open(fasta_out) as f:
+            assert f.read() == ">r1\nACGT\nAC\n>r2\nGG\n>r3\nTT\n"
+
+    def test_gather_fastq_raw(self):
+        fastq_files = self._write_chunks(
+            ["@r1\nAC\n+\n@@\n", "@r2\nG\n+\n!\n"], ".fastq")
+        fastq_out = get_temp_file(suffix="-gathered.fastq")
+        G.gather_fastq(fastq_files, fastq_out)
+        with open(fastq_out) as f:
+            assert f.read() == "@r1\nAC\n+\n@@\n@r2\nG\n+\n!\n"
+        fasta_files = self._write_chunks([">r1\nAC\n"], ".fasta")
+        with pytest.raises(ValueError):
+            G.gather_fastq(fasta_files, fastq_out)
+
 
 def _write_stats_to_json(stats, output_json):
     with open(output_json, 'w') as w:
@@ -89,6 +223,101 @@ class TestJsonGather:
         assert stats['pb_n_zmws'] == 200
 
 
+class TestContigSetGather:
+
+    def _write_contigset(self, records):
+        fasta_file = get_temp_file(suffix=".fasta")
+        with FastaWriter(fasta_file) as fasta_out:
+            for header, seq in records:
+                fasta_out.writeRecord(header, seq)
+        ds_file = get_temp_file(suffix=".contigset.xml")
+        ContigSet(fasta_file, generateIndices=True).write(ds_file)
+        return ds_file
+
+    def test_gather_contigset_no_join(self):
+        ds_files = [
+            self._write_contigset([("contig1", "ACGT" * 30),
+                                   ("contig2", "GGCC")]),
+            self._write_contigset([("contig3", "TTTT" * 25)])
+        ]
+        empty_ds = get_temp_file(suffix=".contigset.xml")
+        ContigSet().write(empty_ds)
+        assert G._contigset_is_empty(empty_ds)
+        assert not G._contigset_is_empty(ds_files[0])
+        ds_out = get_temp_file(suffix=".contigset.xml")
+        G.gather_contigset(ds_files + [empty_ds], ds_out, join_contigs=False)
+        with ContigSet(ds_out) as ds:
+            assert len(ds.toExternalFiles()) == 1
+            assert [rec.id for rec in ds] == ["contig1", "contig2", "contig3"]
+            assert ds.get_contig("contig3").sequence == "TTTT" * 25
+
+    def test_gather_contigset_unsplit_raw_copy(self, monkeypatch):
+        ds_files = [
+            self._write_contigset([("contig1", "ACGT" * 30)]),
+            self._write_contigset([("contig2", "TTTT" * 25)])
+        ]
+        fasta_files = [G._get_dataset_resource_files(fn)[0] for fn in ds_files]
+        assert not G._has_split_contigs(fasta_files)
+        split_fasta = get_temp_file(suffix=".fasta")
+        with FastaWriter(split_fasta) as fasta_out:
+            fasta_out.writeRecord("contig1_0_100|arrow", "ACGT" * 25)
+        assert G._has_split_contigs(fasta_files + [split_fasta])
+
+        def _consolidate(*args, **kwds):
+            raise AssertionError("contigs should not be loaded")
+        monkeypatch.setattr(ContigSet, "consolidate", _consolidate)
+        ds_out = get_temp_file(suffix=".contigset.xml")
+        G.gather_contigset(ds_files, ds_out)
+        with ContigSet(ds_out) as ds:
+            assert [rec.id for rec in ds] == ["contig1", "contig2"]
+
+    def test_gather_fasta_contigset_single_input(self):
+        ds_file = self._write_contigset([("contig1", "ACGT" * 30)])
+        fasta_file = G._get_dataset_resource_files(ds_file)[0]
+        fasta_out = get_temp_file(suffix=".fasta")
+        G.gather_fasta_contigset([fasta_file], fasta_out, join_contigs=False)
+        assert os.path.isfile(fasta_out + ".fai")
+        with ContigSet(os.path.splitext(fasta_out)[0] + ".contigset.xml") as ds:
+            assert [rec.id for rec in ds] == ["contig1"]
+
+
+class TestDictJsonGather:
+
+    def _write_chunks(self, chunks):
+        file_names = []
+        for chunk in chunks:
+            file_name = get_temp_file(suffix=".json")
+            with open(file_name, "w") as f:
+                f.write(json.dumps(chunk))
+            file_names.append(file_name)
+        return file_names
+
+    def test_gather_json(self):
+        json_files = self._write_chunks([{"a": [1, 2], "b": {"x": 1}}, {},
+                                         {"c": 3.5}])
+        json_out = get_temp_file(suffix="-gathered.json")
+        G.gather_json(json_files, json_out)
+        with open(json_out) as f:
+            assert json.load(f) == {"a": [1, 2], "b": {"x": 1}, "c": 3.5}
+        json_files = self._write_chunks([{"a": 1}, {"a": 2}])
+        with pytest.raises(AssertionError):
+            G.gather_json(json_files, json_out)
+
+    def test_json_stream_reader_small_buffer(self):
+        d = {"a": [0.125, 1e-07, -2.5e+10, 12, True, None], "b": "x",
+             "c": 3.75}
+        for bufsize in range(1, 12):
+            reader = JsonStreamReader(io.StringIO(json.dumps(d)),
+                                      bufsize=bufsize)
+            result = {}
+            for key in reader.iter_object():
+                if key == "a":
+                    result[key] = list(reader.iter_array())
+                else:
+                    result[key] = reader.read_value()
+            assert result == d, bufsize
+
+
 def _mkjson():
     uuid_ = str(uuid.uuid4())
     json_file = "{u}.json".format(u=uuid_)
@@ -129,6 +358,31 @@ class TestTgzGather:
             os.chdir(base_dir)
             shutil.rmtree(tmp_dir)
 
+    def test_gather_tgz_parallel(self, monkeypatch):
+        monkeypatch.setattr(G.Constants, "GZIP_MEMBER_SIZE", 2048)
+        tmp_dir = tempfile.mkdtemp()
+        base_dir = os.getcwd()
+        try:
+            os.chdir(tmp_dir)
+            tgz_files = [
+                create_tarball(get_temp_file(suffix="-1.tgz"), n=20),
+                create_tarball(get_temp_file(suffix="-2.tgz"), n=30)
+            ]
+            tgz_out = get_temp_file(suffix="-0.tgz")
+            G.gather_tgz(tgz_files, tgz_out, nproc=3)
+            expected = []
+            for tgz_file in tgz_files:
+                with tarfile.open(tgz_file, mode="r:gz") as tgz_in:
+                    expected.extend(tgz_in.getnames())
+            with tarfile.open(tgz_out, mode="r:gz") as gathered:
+                assert gathered.getnames() == expected
+                for member in gathered.getmembers():
+                    d = json.loads(gathered.extractfile(member.name).read())
+                    assert member.name.startswith(d["uuid"])
+        finally:
+            os.chdir(base_dir)
+            shutil.rmtree(tmp_dir)
+
 
 def create_zip(file_name, n=2):
     with ZipFile(file_name, "w") as zip_out:
@@ -1,14 +1,62 @@
 
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import functools
+import threading
+import io
 import os.path as op
 import os
 
-from pbcoretools.cloud_utils import get_zmw_bgzf_borders, get_bam_offsets, split_bam, extract_bam_chunk, combine_with_header, write_bam_byte_ranges
+import pytest
 
+from pbcoretools.cloud_utils import get_zmw_bgzf_borders, get_zmw_bgzf_border_arrays, get_bam_chunks, get_bam_offsets, split_bam, extract_bam_chunk, combine_with_header, write_bam_byte_ranges, fetch_ranged_reads, fetch_dataset_reads, HttpRangeTransport
+
+import pbcoretools.cloud_utils as cloud_utils
 from pbcommand.testkit import PbIntegrationBase
 from pbcore.io import openDataSet, BamReader, IndexedBamReader, PacBioBamIndex
 import pbtestdata
 
 
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Minimal handler for single-range GET requests.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with open(self.translate_path(self.path), "rb") as f:
+            data = f.read()
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            start, end = byte_range.split("=")[1].split("-")
+            data = data[int(start):int(end) + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class NoRangeRequestHandler(RangeRequestHandler):
+    """
+    Handler that ignores the Range header and always sends the whole file.
+    """
+
+    def do_GET(self):
+        del self.headers["Range"]
+        super().do_GET()
+
+
+def _serve_directory(directory, handler_class):
+    handler = functools.partial(handler_class, directory=directory)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
 class TestCloudUtils(PbIntegrationBase):
     DS1 = pbtestdata.get_file("subreads-xml")
     DS2 = pbtestdata.get_file("subreads-sequel")
@@ -19,7 +67,7 @@ class TestCloudUtils(PbIntegrationBase):
 
     def _remove_all(self):
         for file_name in os.listdir(os.getcwd()):
-            if file_name.startswith("reads.chunk") and file_name.endswith(".bam"):
+            if file_name.startswith("reads.chunk") and file_name.endswith((".bam", ".bam.pbi")):
                 os.remove(op.join(os.getcwd(), file_name))
 
     def test_split_bam(self):
@@ -38,6 +86,21 @@ class TestCloudUtils(PbIntegrationBase):
             assert records_in == records_out
             self._remove_all()
 
+    def test_split_bam_nproc(self):
+        bam_file1 = self._get_bam_path(self.DS1)
+        nchunks = split_bam(bam_file1, 3, nproc=3)
+        assert nchunks == 3
+        bam_in = IndexedBamReader(bam_file1)
+        records_in = [(rec.qName, rec.holeNumber) for rec in bam_in]
+        records_out = []
+        for i in range(nchunks):
+            bam_out = IndexedBamReader("reads.chunk%d.bam" % i)
+            records = [(rec.qName, rec.holeNumber) for rec in bam_out]
+            assert list(bam_out.pbi.holeNumber) == [r[1] for r in records]
+            records_out.extend(records)
+        assert records_in == records_out
+        self._remove_all()
+
     def test_get_zmw_bgzf_borders(self):
         bam_file = self._get_bam_path(self.DS1)
         pbi_file = bam_file + ".pbi"
@@ -50,6 +113,19 @@ class TestCloudUtils(PbIntegrationBase):
         offsets = get_zmw_bgzf_borders(pbi)
         assert offsets == [(0, 5177614, 455)]
 
+    def test_get_zmw_bgzf_border_arrays(self):
+        bam_file = self._get_bam_path(self.DS1)
+        pbi = PacBioBamIndex(bam_file + ".pbi")
+        borders = get_zmw_bgzf_border_arrays(pbi)
+        assert list(borders.rows) == [0, 16, 48]
+        assert list(borders.holeNumbers) == [1650, 7247, 30983]
+        assert list(borders.offsets) == [396, 26575, 77209]
+        assert list(borders.nrecords) == [16, 32, len(pbi) - 48]
+        assert sum(borders.nzmws) == len(set(pbi.holeNumber))
+        chunks = get_bam_chunks(bam_file, 2)
+        assert list(chunks.offsets) == [396, 77209]
+        assert list(chunks.nrecords) == [48, len(pbi) - 48]
+
     def test_get_bam_offsets(self):
         bam_file = self._get_bam_path(self.DS1)
         offsets = get_bam_offsets(bam_file, 4)
@@ -84,8 +160,103 @@ class TestCloudUtils(PbIntegrationBase):
             records_out.extend([rec.qName for rec in bam_out])
         assert records_in == records_out
 
+    def test_extract_bam_chunk(self):
+        bam_file = self._get_bam_path(self.DS1)
+        bam_size = op.getsize(bam_file)
+        byte_ranges = [(396, 26575), (26575, 77209), (77209, bam_size)]
+        with open(bam_file, "rb") as bam_in:
+            for i, (start, end) in enumerate(byte_ranges):
+                extract_bam_chunk(bam_in, "extracted.chunk%d.bam" % i, 396,
+                                  start, end - start)
+        records_in = [rec.qName for rec in IndexedBamReader(bam_file)]
+        records_out = []
+        for i in range(3):
+            bam_out = BamReader("extracted.chunk%d.bam" % i)
+            records_out.extend([rec.qName for rec in bam_out])
+        assert records_in == records_out
+
+    def test_extract_bam_chunk_header_cached(self):
+        class CountingFile(io.FileIO):
+            n_header_reads = 0
+
+            def read(self, size=-1):
+                if self.tell() == 0:
+                    self.n_header_reads += 1
+                return super().read(size)
+
+        bam_file = self._get_bam_path(self.DS1)
+        bam_size = op.getsize(bam_file)
+        byte_ranges = [(396, 26575), (26575, 77209), (77209, bam_size)]
+        cloud_utils._header_cache.clear()
+        with CountingFile(bam_file, "rb") as bam_in:
+            for i, (start, end) in enumerate(byte_ranges):
+                extract_bam_chunk(bam_in, "extracted.chunk%d.bam" % i, 396,
+                                  start, end - start)
+            assert bam_in.n_header_reads == 1
+
     def test_write_bam_byte_ranges(self):
         bam_file = self._get_bam_path(self.DS1)
         write_bam_byte_ranges(bam_file, 3)
         with open("chunks.tsv", "rt") as tsv_in:
             assert tsv_in.read() == "start\tend\n396\t26574\n26575\t77208\n77209\t204543"
+
+    def test_write_bam_byte_ranges_balance_bytes(self):
+        bam_file = self._get_bam_path(self.DS1)
+        assert get_bam_offsets(bam_file, 3, balance="bytes") == [396, 77209]
+        write_bam_byte_ranges(bam_file, 3, balance="bytes")
+        with open("chunks.tsv", "rt") as tsv_in:
+            assert tsv_in.read() == "start\tend\n396\t77208\n77209\t204543"
+
+    def _check_fetched_reads(self, bam_file, bam_out, zmws):
+        bam_in = IndexedBamReader(bam_file)
+        records_in = [rec.qName for rec in bam_in if rec.holeNumber in zmws]
+        bam_out = IndexedBamReader(bam_out)
+        assert [rec.qName for rec in bam_out] == records_in
+        assert set(bam_out.pbi.holeNumber) == zmws
+
+    def test_fetch_ranged_reads_local(self):
+        bam_file = self._get_bam_path(self.DS1)
+        zmws = {1650, 30983}
+        for max_gap in [0, 65536]:
+            n = fetch_ranged_reads(bam_file, "fetched.bam", zmws=zmws,
+                                   max_gap=max_gap)
+            assert n > 0
+            self._check_fetched_reads(bam_file, "fetched.bam", zmws)
+
+    def test_fetch_ranged_reads_http(self):
+        bam_file = self._get_bam_path(self.DS1)
+        server = _serve_directory(op.dirname(bam_file), RangeRequestHandler)
+        try:
+            url = "http://127.0.0.1:{p}/{f}".format(
+                p=server.server_address[1], f=op.basename(bam_file))
+            zmws = {7247}
+            fetch_ranged_reads(url, "fetched.bam", zmws=zmws, nproc=2)
+            self._check_fetched_reads(bam_file, "fetched.bam", zmws)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_http_transport_range_ignored(self):
+        bam_file = self._get_bam_path(self.DS1)
+        server = _serve_directory(op.dirname(bam_file), NoRangeRequestHandler)
+        try:
+            transport = HttpRangeTransport("http://127.0.0.1:{p}/{f}".format(
+                p=server.server_address[1], f=op.basename(bam_file)))
+            size = transport.get_size()
+            with pytest.raises(IOError):
+                transport.read_range(396, 26575)
+            assert len(transport.read_range(0, size)) == size
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_fetch_dataset_reads(self):
+        zmws = {1650, 30983}
+        ds_out = fetch_dataset_reads(self.DS1, "fetched.subreadset.xml",
+                                     zmws=zmws)
+        with openDataSet(self.DS1) as ds_in:
+            with openDataSet(ds_out) as ds:
+                assert ds.name == ds_in.name
+                assert ds.uuid != ds_in.uuid
+                assert set(ds.index.holeNumber) == zmws
+                assert ds.numRecords == len(ds.index)
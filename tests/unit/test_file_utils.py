@@ -41,7 +41,8 @@ from pbcoretools.file_utils import (
     force_set_all_well_sample_names,
     force_set_all_bio_sample_names,
     sanitize_dataset_tags,
-    collect_all_dataset_paths)
+    collect_all_dataset_paths,
+    merge_datasets)
 
 
 def _validate_dataset_xml(file_name):
@@ -166,6 +167,29 @@ class TestFileUtils:
         paths = [op.basename(f) for f in paths]
         assert paths == expected_paths
 
+    def test_merge_datasets(self):
+        ds_files = [pbtestdata.get_file("subreads-sequel"),
+                    pbtestdata.get_file("subreads-xml"),
+                    pbtestdata.get_file("barcoded-subreadset")]
+        expected = SubreadSet(*ds_files)
+        for nproc in [1, 2]:
+            ds = merge_datasets(ds_files, nproc=nproc)
+            assert ds.toExternalFiles() == expected.toExternalFiles()
+            assert ds.numRecords == expected.numRecords
+            assert ds.totalLength == expected.totalLength
+        # overlapping resources
+        ds = merge_datasets(ds_files + ds_files[0:1])
+        assert ds.numRecords == expected.numRecords
+        # the counts come from the indices, not the (stale) input XML
+        ds = SubreadSet(ds_files[0], skipCounts=True)
+        ds.metadata.numRecords = 0
+        ds.metadata.totalLength = 0
+        stale_file = tempfile.NamedTemporaryFile(suffix=".subreadset.xml").name
+        ds.write(stale_file)
+        ds = merge_datasets([stale_file] + ds_files[1:])
+        assert ds.numRecords == expected.numRecords
+        assert ds.totalLength == expected.totalLength
+
 
 class TestSplitLAA:
     """
@@ -612,3 +612,21 @@ class TestDataSet:
         run_and_validate(["--zmws"], [52, 22, 42, 21])
         #run_and_validate(["--auto"], [8, 12, 54, 63])
         run_and_validate(["--zmws", "--keepReadGroups"], [8, 12, 54, 63])
+
+    def test_dataset_split_index_dir(self):
+        ifn = pbtestdata.get_file("subreads-sequel")
+        index_dir = tempfile.mkdtemp(suffix="split-index")
+
+        def _split(args):
+            outdir = tempfile.mkdtemp(suffix="dataset-unittest")
+            self._check_cmd(" ".join(["dataset", "split", "--zmws",
+                                      "--chunks", "3", "--outdir", outdir] +
+                                     args + [ifn]))
+            return [openDataSet(op.join(outdir, fn))
+                    for fn in sorted(os.listdir(outdir))]
+        expected = _split([])
+        for i in range(2):
+            dss = _split(["--split-index-dir", index_dir])
+            assert len(dss) == 3
+            assert sum(len(ds) for ds in dss) == sum(len(ds) for ds in expected)
+            assert len(os.listdir(index_dir)) == 2
@@ -0,0 +1,154 @@
+import tempfile
+import shutil
+import os.path as op
+
+import pytest
+
+from pbcore.io import (openDataSet, IndexedBamReader, PacBioBamIndex,
+                       SubreadSet)
+import pbtestdata
+
+import pysam
+
+from pbcoretools.pbi_utils import (read_pbi, write_pbi, merge_pbis,
+                                   concatenate_bams, get_bam_header_size,
+                                   replace_bam_header, reindex_pbis,
+                                   get_record_offsets,
+                                   read_pbi_header, get_pbi_total_length,
+                                   PbiError)
+import pbcoretools.chunking.gather as G
+
+from base import get_temp_file
+
+
+def _get_bam_path(ds_path):
+    with openDataSet(ds_path) as ds:
+        return ds.resourceReaders()[0].filename
+
+
+class TestPbiUtils:
+    BAM1 = _get_bam_path(pbtestdata.get_file("subreads-sequel"))
+    BAM2 = _get_bam_path(pbtestdata.get_file("barcoded-subreadset"))
+
+    def test_read_write_pbi(self):
+        pbi = read_pbi(self.BAM1 + ".pbi")
+        pbi_out = get_temp_file(suffix=".pbi")
+        write_pbi(pbi, pbi_out)
+        pbi1 = PacBioBamIndex(self.BAM1 + ".pbi")
+        pbi2 = PacBioBamIndex(pbi_out)
+        assert len(pbi2) == len(pbi1)
+        assert list(pbi2.holeNumber) == list(pbi1.holeNumber)
+        assert list(pbi2.virtualFileOffset) == list(pbi1.virtualFileOffset)
+
+    def test_read_pbi_header(self):
+        for bam_file in [self.BAM1, self.BAM2]:
+            pbi = read_pbi(bam_file + ".pbi")
+            version, flags, n_reads = read_pbi_header(bam_file + ".pbi")
+            assert (version, flags, n_reads) == (pbi.version, pbi.flags,
+                                                 len(pbi))
+            n_reads, total_length = get_pbi_total_length(bam_file + ".pbi")
+            assert n_reads == len(pbi)
+            assert total_length == int(sum(pbi.qEnd - pbi.qStart))
+        with pytest.raises(PbiError):
+            read_pbi_header(self.BAM1)
+
+    def test_merge_pbis(self):
+        pbi = read_pbi(self.BAM2 + ".pbi")
+        merged = merge_pbis([pbi, pbi], [0, 1000])
+        assert len(merged) == 2 * len(pbi)
+        assert merged.hasBarcodeInfo
+        n = len(pbi)
+        assert list(merged.virtualFileOffset[n:] - merged.virtualFileOffset[:n]) == [1000 << 16] * n
+        merged = merge_pbis([read_pbi(self.BAM1 + ".pbi"), pbi], [0, 0])
+        assert not merged.hasBarcodeInfo
+
+    def test_concatenate_bams(self):
+        tmp_dir = tempfile.mkdtemp()
+        bam_files = []
+        for i in range(3):
+            bam_file = op.join(tmp_dir, "chunk{i}.subreads.bam".format(i=i))
+            shutil.copyfile(self.BAM1, bam_file)
+            shutil.copyfile(self.BAM1 + ".pbi", bam_file + ".pbi")
+            bam_files.append(bam_file)
+        bam_out = op.join(tmp_dir, "merged.subreads.bam")
+        concatenate_bams(bam_files, bam_out)
+        assert get_bam_header_size(bam_out) == get_bam_header_size(self.BAM1)
+        with IndexedBamReader(self.BAM1) as bam_in:
+            qnames = [rec.qName for rec in bam_in]
+        with IndexedBamReader(bam_out) as bam_in:
+            assert [rec.qName for rec in bam_in] == qnames * 3
+            assert len(bam_in) == len(qnames) * 3
+            assert bam_in[len(qnames)].qName == qnames[0]
+        with pytest.raises(PbiError):
+            concatenate_bams([self.BAM1, self.BAM2], bam_out)
+
+    def test_replace_bam_header(self):
+        with pysam.AlignmentFile(self.BAM1, "rb", check_sq=False) as bam_in:
+            header = bam_in.header.to_dict()
+        for rg in header["RG"]:
+            rg["SM"] = "x" * 100000
+        bam_out = get_temp_file(suffix=".subreads.bam")
+        assert replace_bam_header(self.BAM1, bam_out, header)
+        with IndexedBamReader(self.BAM1) as bam_in:
+            qnames = [rec.qName for rec in bam_in]
+        with IndexedBamReader(bam_out) as bam_in:
+            assert bam_in.readGroupTable[0].SampleName == "x" * 100000
+            assert [rec.qName for rec in bam_in] == qnames
+            assert bam_in[len(qnames) - 1].qName == qnames[-1]
+
+    def test_reindex_pbis(self):
+        bam_out = get_temp_file(suffix=".subreads.bam")
+        with pysam.AlignmentFile(self.BAM1, "rb", check_sq=False) as bam_in:
+            with pysam.AlignmentFile(bam_out, "wb", header=bam_in.header) as writer:
+                for rec in bam_in:
+                    rec.query_name = "prefix_" + rec.query_name
+                    writer.write(rec)
+        assert reindex_pbis([self.BAM1 + ".pbi"], bam_out, bam_out + ".pbi")
+        n_records = len(read_pbi(self.BAM1 + ".pbi"))
+        with IndexedBamReader(bam_out) as bam_in:
+            assert bam_in[n_records - 1].qName.startswith("prefix_")
+        assert not reindex_pbis([self.BAM1 + ".pbi"] * 2, bam_out,
+                                bam_out + ".pbi")
+
+    def test_get_record_offsets_block_boundary(self):
+        # records large enough that the writer has to flush a block before
+        # many of them, so its tell() points to the end of the previous block
+        header = {"HD": {"VN": "1.5", "SO": "unknown"}}
+        bam_file = get_temp_file(suffix=".bam")
+        writer_offsets = []
+        with pysam.AlignmentFile(bam_file, "wb", header=header) as writer:
+            for i in range(20):
+                rec = pysam.AlignedSegment()
+                rec.query_name = "read{i}".format(i=i)
+                rec.flag = 4
+                rec.query_sequence = "ACGT" * 5000
+                writer_offsets.append(writer.tell())
+                writer.write(rec)
+        offsets = get_record_offsets(bam_file)
+        assert len(offsets) == 20
+        n_flushed = 0
+        for offset, writer_offset in zip(offsets, writer_offsets):
+            if offset != writer_offset:
+                assert offset & 0xffff == 0
+                assert offset >> 16 > writer_offset >> 16
+                n_flushed += 1
+        assert n_flushed > 0
+        with pysam.AlignmentFile(bam_file, "rb", check_sq=False) as bam_in:
+            for i, offset in enumerate(offsets):
+                bam_in.seek(int(offset))
+                assert next(bam_in).query_name == "read{i}".format(i=i)
+
+    def test_gather_subreadset_consolidate(self):
+        ds_files = []
+        for i in range(2):
+            ds = SubreadSet(pbtestdata.get_file("subreads-sequel"))
+            ds_file = get_temp_file(suffix=".subreadset.xml")
+            ds.write(ds_file)
+            ds_files.append(ds_file)
+        ds_out = get_temp_file(suffix=".subreadset.xml")
+        G.gather_subreadset(ds_files, ds_out, consolidate=True)
+        with SubreadSet(ds_out) as ds:
+            assert len(ds.externalResources) == 1
+            assert op.isfile(ds.externalResources[0].pbi)
+            with SubreadSet(ds_files[0]) as ds_in:
+                assert ds.numRecords == 2 * ds_in.numRecords
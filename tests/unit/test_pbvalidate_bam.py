@@ -341,3 +341,102 @@ class TestPbvalidateBam:
             e, c = bam.validate_bam(BAM, aligned=False)
             assert len(e) == 0
             assert len(w) == 7
+
+    def test_read_mapped_flag_unmapped(self, monkeypatch):
+        class Pbi:
+            tId = [0, 0]
+            tStart = [10, 20]
+            hasMappingInfo = True
+
+            def __len__(self):
+                return 2
+
+        class Reader:
+            isMapped = True
+
+        class Aln:
+            bam = Reader
+
+            def __init__(self, flag):
+                self.qName = "movie1/5/0_10"
+
+                class peer:
+                    pos = 10
+                    rname = 0
+                self.peer = peer
+                self.peer.flag = flag
+
+        monkeypatch.setattr(bam, "_get_pbi", lambda reader: Pbi())
+        v = bam.ValidateReadMapped()
+        # FLAG 0x4 is not in the .pbi, so no record may be skipped
+        assert v.get_prescreen_mask(Reader()) is None
+        assert v.validate(Aln(0))
+        aln = Aln(4)
+        assert not v.validate(aln)
+        assert [type(e).__name__ for e in v.to_errors(aln)] == [
+            "AlignmentUnmappedError"]
+        Reader.isMapped = False
+        assert list(v.get_prescreen_mask(Reader())) == [False, False]
+
+    def test_read_length_prescreen(self, monkeypatch):
+        class Pbi:
+            qId = [1, 2, 2, 1, 2]
+            qStart = [0, 0, 10, 0, -1]
+            qEnd = [100, 50, 5, 80, 20]
+
+            def __len__(self):
+                return 5
+
+        class Reader:
+            class readGroupTable:
+                ID = [1, 2]
+                ReadType = ["SUBREAD", "CCS"]
+
+        monkeypatch.setattr(bam, "_get_pbi", lambda reader: Pbi())
+        v = bam.ValidateReadLength()
+        mask = v.get_prescreen_mask(Reader())
+        assert list(mask) == [True, False, True, True, True]
+        monkeypatch.setattr(bam, "_get_pbi", lambda reader: None)
+        assert v.get_prescreen_mask(Reader()) is None
+
+    def test_read_unique_bounded_memory(self, monkeypatch):
+        class Aln:
+            def __init__(self, hole, aStart, aEnd):
+                self.qId, self.HoleNumber, self.qStart, self.qEnd = 1, hole, 0, 10
+                self.qName = "movie1/%d/0_10" % hole
+                self.aStart, self.aEnd = aStart, aEnd
+
+        class Pbi:
+            qId = [1] * 6
+            holeNumber = [5, 6, 5, 7, 5, 6]
+            qStart = [0] * 6
+            qEnd = [10] * 6
+
+            def __len__(self):
+                return 6
+
+        alns = [Aln(5, 0, 5), Aln(6, 0, 10), Aln(5, 3, 8), Aln(7, 0, 10),
+                Aln(5, 6, 10), Aln(6, 2, 4)]
+        monkeypatch.setattr(bam, "_get_pbi", lambda reader: Pbi())
+        v = bam.ValidateReadUnique()
+        mask = v.get_prescreen_mask(None)
+        assert list(mask) == [True, True, True, False, True, True]
+        errors = []
+        for aln, check in zip(alns, mask):
+            if check and not v.validate(aln):
+                errors.extend(v.to_errors(aln))
+        assert [type(e).__name__ for e in errors] == ["AlignmentNotUniqueError"] * 2
+        assert [e.object_ref for e in errors] == [alns[2], alns[5]]
+        assert v._aRanges == {} and v._n_remaining == {}
+
+        class Reader:
+            class peer:
+                header = {"HD": {"SO": "queryname"}}
+        alns.sort(key=lambda aln: aln.qName)
+        monkeypatch.setattr(bam, "_get_pbi", lambda reader: None)
+        v = bam.ValidateReadUnique()
+        assert v.get_prescreen_mask(Reader()) is None
+        errors = [e for aln in alns if not v.validate(aln)
+                  for e in v.to_errors(aln)]
+        assert len(errors) == 2
+        assert list(v._aRanges) == ["movie1/7/0_10"]
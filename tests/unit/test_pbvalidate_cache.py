@@ -0,0 +1,146 @@
+import tempfile
+import os.path as op
+import os
+
+import pytest
+
+from pbcoretools.pbvalidate.core import ValidatorError
+from pbcoretools.pbvalidate.cache import (ValidationCache, run_cached,
+                                          get_file_fingerprint,
+                                          get_cache_dir, get_dataset_files,
+                                          Constants)
+
+LOCAL_DATA_DIR = op.join(op.dirname(op.dirname(__file__)), "data")
+
+
+class Record:
+
+    def __init__(self, name):
+        self.name = name
+        self.handle = lambda: None  # not picklable
+
+    def __str__(self):
+        return self.name
+
+
+class CountingValidator:
+
+    def __init__(self):
+        self.n_calls = 0
+
+    def __call__(self, file_name, strict=False, nproc=1):
+        self.n_calls += 1
+        with open(file_name) as f:
+            n_bad = f.read().count("bad")
+        errors = [ValidatorError("bad record", Record("rec%d" % i))
+                  for i in range(n_bad)]
+        return errors, {"CountingValidator": n_bad}
+
+
+def _write(file_name, content):
+    with open(file_name, "w") as f:
+        f.write(content)
+
+
+class TestValidationCache:
+
+    def test_run_cached(self):
+        cache = ValidationCache(tempfile.mkdtemp())
+        file_name = tempfile.NamedTemporaryFile(suffix=".txt").name
+        _write(file_name, "good bad bad")
+        validate = CountingValidator()
+        validate.__name__ = "validate"
+
+        def _run(**options):
+            options.setdefault("file_name", file_name)
+            return run_cached(validate, [file_name, file_name + ".idx"],
+                              options, cache)
+        errors, metrics = _run()
+        assert validate.n_calls == 1
+        errors_c, metrics_c = _run(nproc=4)
+        assert validate.n_calls == 1
+        assert metrics_c == metrics == {"CountingValidator": 2}
+        assert [str(e) for e in errors_c] == [str(e) for e in errors]
+        assert [str(e.object_ref) for e in errors_c] == ["rec0", "rec1"]
+        _run(strict=True)
+        assert validate.n_calls == 2
+        _write(file_name + ".idx", "")
+        _run()
+        assert validate.n_calls == 3
+        _write(file_name, "good bad bad bad")
+        errors, metrics = _run()
+        assert validate.n_calls == 4
+        assert len(errors) == 3
+        os.remove(file_name + ".idx")
+        os.remove(file_name)
+
+    def test_cache_opt_in(self, monkeypatch):
+        monkeypatch.delenv(Constants.CACHE_DIR_ENV, raising=False)
+        assert get_cache_dir() is None
+        assert get_cache_dir("/tmp/pbvalidate") == "/tmp/pbvalidate"
+        monkeypatch.setenv(Constants.CACHE_DIR_ENV, "/tmp/pbvalidate2")
+        assert get_cache_dir() == "/tmp/pbvalidate2"
+        assert get_cache_dir("/tmp/pbvalidate") == "/tmp/pbvalidate"
+        file_name = tempfile.NamedTemporaryFile(suffix=".txt").name
+        _write(file_name, "good bad")
+        validate = CountingValidator()
+        validate.__name__ = "validate"
+        for _ in range(2):
+            run_cached(validate, [file_name], {"file_name": file_name}, None)
+        assert validate.n_calls == 2
+        os.remove(file_name)
+
+    def test_get_dataset_files(self):
+        ds_file = op.join(LOCAL_DATA_DIR, "tst_1.alignmentset.xml")
+        reference = op.join(LOCAL_DATA_DIR, "tst1.fasta")
+        file_names = get_dataset_files(ds_file, reference)
+        assert file_names[0] == ds_file
+        assert op.join(LOCAL_DATA_DIR, "tst_1_subreads.bam.pbi") in file_names
+        assert file_names[-2:] == [reference, reference + ".fai"]
+
+    def test_evict(self):
+        cache = ValidationCache(tempfile.mkdtemp())
+        errors = [ValidatorError("x" * 100)]
+        for i in range(20):
+            cache.put("key%d" % i, (errors, {}))
+            os.utime(cache._get_path("key%d" % i), ns=(i * 10**9, i * 10**9))
+        assert len(os.listdir(cache.cache_dir)) == 20
+        cache.get("key0")
+        cache.max_size = 1000
+        cache.evict()
+        entries = os.listdir(cache.cache_dir)
+        assert 0 < len(entries) < 20
+        assert "key0.pkl" in entries
+        assert "key19.pkl" in entries
+        assert "key1.pkl" not in entries
+        assert sum(os.path.getsize(os.path.join(cache.cache_dir, e))
+                   for e in entries) <= 1000
+
+    def test_untrusted_cache_dir(self):
+        cache = ValidationCache(tempfile.mkdtemp())
+        errors = [ValidatorError("x")]
+        cache.put("key", (errors, {}))
+        assert cache.get("key") is not None
+        os.chmod(cache.cache_dir, 0o777)
+        assert cache.get("key") is None
+        with pytest.raises(IOError):
+            cache.put("key2", (errors, {}))
+        os.chmod(cache.cache_dir, 0o700)
+        os.chmod(cache._get_path("key"), 0o666)
+        assert cache.get("key") is None
+        new_dir = op.join(cache.cache_dir, "new")
+        ValidationCache(new_dir).put("key", (errors, {}))
+        assert os.stat(new_dir).st_mode & 0o777 == 0o700
+
+    def test_get_file_fingerprint(self):
+        file_name = tempfile.NamedTemporaryFile(suffix=".txt").name
+        assert get_file_fingerprint(file_name)[1:] == (None,)
+        _write(file_name, "ACGT")
+        fp1 = get_file_fingerprint(file_name)
+        st = os.stat(file_name)
+        _write(file_name, "ACGG")
+        os.utime(file_name, ns=(st.st_atime_ns, st.st_mtime_ns))
+        fp2 = get_file_fingerprint(file_name)
+        assert fp1[:3] == fp2[:3]
+        assert fp1 != fp2
+        os.remove(file_name)
@@ -3,14 +3,23 @@ import tempfile
 import os
 import sys
 
+import numpy as np
+
 from pbcore.io import ReaderBase
 
 from pbcoretools.pbvalidate.core import (run_validators,
+                                         get_profile,
+                                         get_sample_coverage,
+                                         get_sample_indices,
+                                         ValidatorError,
                                          ValidatorErrorContext,
                                          ValidatorContextFirstError,
                                          ValidatorContextMaxErrors,
+                                         ValidatorContextMaxRecords,
                                          ValidateFile,
-                                         ValidateRecord)
+                                         ValidateRecord,
+                                         ValidateRecordAcrossFile,
+                                         ValidationPlan)
 
 log = logging.getLogger(__name__)
 
@@ -46,6 +55,62 @@ class TextFileReader(ReaderBase):
             yield i.rstrip()
 
 
+class ValidateTxtRecordUnique(ValidateRecordAcrossFile):
+
+    def __init__(self):
+        self._seen = set()
+
+    def get_record_summary(self, record):
+        return record
+
+    def validate_summary(self, record):
+        if record in self._seen:
+            return False
+        self._seen.add(record)
+        return True
+
+    def summary_to_errors(self, record, object_ref):
+        return [ValidatorError("Duplicate record %s" % record, object_ref)]
+
+
+class ValidateTxtBirdRecordPrescreen(ValidateRecord):
+
+    """Fails every record it sees, but only sees records containing 'bird'"""
+
+    def validate(self, record):
+        return False
+
+    def to_error(self, record):
+        return ValidatorError("Bird record %s" % record, record)
+
+    def get_prescreen_mask(self, reader):
+        return np.array(["bird" in line for line in reader], dtype=bool)
+
+
+class IndexedTextFileReader:
+
+    """Random-access reader that can be re-opened in worker processes"""
+
+    def __init__(self, path):
+        with open(path) as f:
+            self._lines = [line.rstrip() for line in f]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __getitem__(self, i):
+        return self._lines[i]
+
+    def __iter__(self):
+        return iter(self._lines)
+
+
 def _get_tmp(fn):
     return tempfile.NamedTemporaryFile(suffix="."+fn).name
 
@@ -122,3 +187,169 @@ class TestValidatorsContext:
         os.remove(file_path)
         # TODO figure out how to check for log error output showing traceback
         # of exception raised by failed validator
+
+    def test_parallel_records(self):
+        file_path = _get_tmp("file.txt")
+        contents = ["cat dog %d" % i for i in range(50)]
+        contents[7] = "fish"
+        contents[31] = "cat"
+        contents.extend(["cat dog 3", "bird", "cat dog 7"])
+        _write_example_file(contents, file_path)
+
+        def _run(context_class, nproc):
+            validators = [ValidateTxtCatRecord(), ValidateTxtDogRecord(),
+                          ValidateTxtFile(), ValidateTxtRecordUnique()]
+            return run_validators(context_class, file_path,
+                                  IndexedTextFileReader, validators,
+                                  nproc=nproc)
+        try:
+            for context_class in [ValidatorErrorContext, _to_max_errors(3)]:
+                errors, metrics = _run(context_class, 1)
+                errors_p, metrics_p = _run(context_class, 3)
+                assert [str(e) for e in errors_p] == [str(e) for e in errors]
+                assert metrics_p == metrics
+            errors, metrics = _run(ValidatorErrorContext, 3)
+            assert len(errors) == 6
+            assert metrics["ValidateTxtRecordUnique"] == 52
+        finally:
+            os.remove(file_path)
+
+    def test_prescreen_mask(self):
+        file_path = _get_tmp("file.txt")
+        _write_example_file(["cat dog", "bird", "cat", "dog bird"], file_path)
+        try:
+            for nproc in [1, 2]:
+                errors, metrics = run_validators(
+                    ValidatorErrorContext, file_path, IndexedTextFileReader,
+                    [ValidateTxtBirdRecordPrescreen()], nproc=nproc)
+                assert [str(e) for e in errors] == ["Bird record bird",
+                                                    "Bird record dog bird"]
+                assert metrics == {"ValidateTxtBirdRecordPrescreen": 2}
+        finally:
+            os.remove(file_path)
+
+    def test_validation_plan_counters(self, monkeypatch):
+        monkeypatch.setattr(ValidationPlan, "BATCH_SIZE", 3)
+
+        class PerRecordMetricsContext(ValidatorErrorContext):
+
+            def add_validate_metric(self, metric):
+                self.refs = getattr(self, "refs", []) + [metric.object_ref]
+                super().add_validate_metric(metric)
+
+        file_path = _get_tmp("file.txt")
+        contents = ["cat dog %d" % i for i in range(10)]
+        contents[4] = "fish"
+        contents[8] = "cat"
+        _write_example_file(contents, file_path)
+        try:
+            for context_class in [ValidatorErrorContext, _to_max_errors(2)]:
+                results = []
+                for ctx_class in [context_class, PerRecordMetricsContext]:
+                    validators = [ValidateTxtCatRecord(), ValidateTxtFile(),
+                                  ValidateTxtDogRecord(), ValidateBad()]
+                    results.append(run_validators(ctx_class, file_path,
+                                                  TextFileReader, validators))
+                (errors, metrics), (errors_r, metrics_r) = results
+                if context_class is ValidatorErrorContext:
+                    assert [str(e) for e in errors] == [str(e) for e in errors_r]
+                    assert metrics == metrics_r
+                    assert len(errors) == 13
+                    assert metrics == {"ValidateTxtFile": 1,
+                                       "ValidateTxtCatRecord": 9,
+                                       "ValidateTxtDogRecord": 8}
+                else:
+                    assert len(errors) == 2
+                    assert metrics == {"ValidateTxtFile": 1,
+                                       "ValidateTxtCatRecord": 2,
+                                       "ValidateTxtDogRecord": 2}
+        finally:
+            os.remove(file_path)
+
+    def test_batch_size_limited_by_context(self):
+        class CountingReader(TextFileReader):
+            n_read = 0
+
+            def __iter__(self):
+                for record in super().__iter__():
+                    CountingReader.n_read += 1
+                    yield record
+
+        file_path = _get_tmp("file.txt")
+        contents = ["cat dog %d" % i for i in range(50)]
+        contents[2] = "fish"
+        _write_example_file(contents, file_path)
+        try:
+            # the error for "fish" is not a RecordValidatorError, so that
+            # record does not count towards the limit of 5
+            for context_class, n_read in [(_to_max_records(5), 6),
+                                          (_to_max_errors(1), 3),
+                                          (ValidatorErrorContext, 50)]:
+                CountingReader.n_read = 0
+                run_validators(context_class, file_path, CountingReader,
+                               [ValidateTxtCatRecord()])
+                assert CountingReader.n_read == n_read
+        finally:
+            os.remove(file_path)
+
+    def test_sample_records(self):
+        indices = get_sample_indices(100, sample_size=10, seed=42)
+        assert list(indices // 10) == list(range(10))
+        assert len(get_sample_indices(100, sample_fraction=0.25)) == 25
+        assert list(get_sample_indices(5, sample_size=10)) == list(range(5))
+        file_path = _get_tmp("file.txt")
+        contents = ["cat dog %d" % i for i in range(100)]
+        for i in range(0, 100, 2):
+            contents[i] = "fish"
+        _write_example_file(contents, file_path)
+        try:
+            errors, metrics = run_validators(
+                ValidatorErrorContext, file_path, IndexedTextFileReader,
+                [ValidateTxtCatRecord(), ValidateTxtFile()],
+                sample_size=20, sample_seed=1)
+            assert get_sample_coverage(metrics) == (20, 100)
+            assert len(errors) + metrics["ValidateTxtCatRecord"] == 20
+            assert 0 < len(errors) < 20
+            errors, metrics = run_validators(
+                _to_max_errors(1), file_path, IndexedTextFileReader,
+                [ValidateTxtCatRecord()], sample_fraction=0.5, sample_seed=1)
+            n_sampled, n_total = get_sample_coverage(metrics)
+            assert n_sampled < 50 and n_total == 100
+            errors, metrics = run_validators(
+                ValidatorErrorContext, file_path, IndexedTextFileReader,
+                [ValidateTxtCatRecord()])
+            assert get_sample_coverage(metrics) is None
+            assert len(errors) == 50
+        finally:
+            os.remove(file_path)
+
+    def test_profile(self):
+        file_path = _get_tmp("file.txt")
+        contents = ["cat dog %d" % i for i in range(20)]
+        contents[3] = "fish"
+        _write_example_file(contents, file_path)
+        try:
+            for nproc in [1, 2]:
+                validators = [ValidateTxtCatRecord(), ValidateTxtFile(),
+                              ValidateTxtRecordUnique()]
+                errors, metrics = run_validators(
+                    ValidatorErrorContext, file_path, IndexedTextFileReader,
+                    validators, nproc=nproc, profile=True)
+                profile = get_profile(metrics)
+                assert len(errors) == 1
+                assert metrics["ValidateTxtCatRecord"] == 19
+                assert profile["Records"] == 20
+                assert profile["FileTime"] >= 0 and profile["RecordTime"] > 0
+                assert sorted(profile["ValidatorTimes"]) == [
+                    "ValidateTxtCatRecord", "ValidateTxtFile",
+                    "ValidateTxtRecordUnique"]
+            errors, metrics = run_validators(
+                ValidatorErrorContext, file_path, IndexedTextFileReader,
+                [ValidateTxtCatRecord()], sample_size=5, profile=True)
+            assert get_profile(metrics)["Records"] == 5
+            errors, metrics = run_validators(
+                ValidatorErrorContext, file_path, IndexedTextFileReader,
+                [ValidateTxtCatRecord()])
+            assert get_profile(metrics) is None
+        finally:
+            os.remove(file_path)
@@ -1,3 +1,4 @@
+import multiprocessing
 import subprocess
 import tempfile
 import os.path as op
@@ -9,6 +10,7 @@ import pbcore.data.datasets as data
 import pbcore.io
 
 from pbcoretools.pbvalidate.dataset import *
+from pbcoretools.pbvalidate.cache import ValidationCache
 
 import pbtestdata
 
@@ -145,3 +147,46 @@ class TestCase:
         self._base_test_validate_instrument_data("ccs-sequel",
                                                  ".consensusreadset.xml",
                                                  set_uuid)
+
+    def _write_copies_dataset(self):
+        xml = pbtestdata.get_file("subreads-sequel")
+        bam_file = pbcore.io.openDataSet(xml).toExternalFiles()[0]
+        tmp_dir = tempfile.mkdtemp()
+        bam_files = []
+        for i in range(2):
+            bam_tmp = op.join(tmp_dir, "copy%d.subreads.bam" % i)
+            for ext in ["", ".pbi"]:
+                with open(bam_file + ext, "rb") as f_in:
+                    with open(bam_tmp + ext, "wb") as f_out:
+                        f_out.write(f_in.read())
+            bam_files.append(bam_tmp)
+        xml_tmp = op.join(tmp_dir, "copies.subreadset.xml")
+        pbcore.io.SubreadSet(*bam_files).write(xml_tmp)
+        return xml_tmp, bam_files
+
+    def test_validate_resources_parallel(self):
+        xml_tmp, bam_files = self._write_copies_dataset()
+        e1, c1 = validate_dataset(xml_tmp)
+        e2, c2 = validate_dataset(xml_tmp, nproc=2)
+        # the second copy duplicates every read of the first
+        assert "AlignmentNotUniqueError" in {type(err).__name__ for err in e1}
+        assert sorted(str(err) for err in e2) == sorted(str(err) for err in e1)
+        times = c2.pop(Constants.RESOURCE_TIMES)
+        assert [path for path, t in times] == bam_files
+        assert c2 == c1
+
+    def test_validate_resources_cached(self, monkeypatch):
+        xml_tmp, bam_files = self._write_copies_dataset()
+        result_cache = ValidationCache(tempfile.mkdtemp())
+        e1, c1 = validate_dataset(xml_tmp, result_cache=result_cache)
+
+        def _pool(*args, **kwds):
+            raise AssertionError("the resources should not be revalidated")
+        monkeypatch.setattr(multiprocessing, "Pool", _pool)
+        e2, c2 = validate_dataset(xml_tmp, result_cache=result_cache)
+        assert "AlignmentNotUniqueError" in {type(err).__name__ for err in e2}
+        assert sorted(str(err) for err in e2) == sorted(str(err) for err in e1)
+        assert c2.pop(Constants.RESOURCE_TIMES) == [(path, 0.0)
+                                                    for path in bam_files]
+        c1.pop(Constants.RESOURCE_TIMES)
+        assert c2 == c1
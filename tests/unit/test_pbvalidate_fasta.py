@@ -1,4 +1,5 @@
 import subprocess
+import re
 import tempfile
 import shutil
 import os.path as op
@@ -165,19 +166,16 @@ class TestCase:
     # pure formatting errors (independent of parser)
     def test_whitespace(self):
         e, c = validate_file("test_3.fa")
-        # FIXME there are actually two errors corresponding to different lines
-        # in the file, but the current structure of the code only allows us
-        # to catch one of these
-        assert len(e) == 1
-        assert isinstance(e[0], WhitespaceError)
+        assert len(e) == 2
+        assert all(isinstance(e_, WhitespaceError) for e_ in e)
 
     def test_wrapping(self):
         e, c = validate_file("test_4.fa")
         assert len(e) == 0
         #assert isinstance(e[0], NoWrappingError)
         e, c = validate_file("test_5.fa")
-        assert len(e) == 1
-        assert isinstance(e[0], SeqWrappingError)
+        assert len(e) == 2
+        assert all(isinstance(e_, SeqWrappingError) for e_ in e)
         #e, c = validate_file("test_6.fa")
         #assert len(e) == 1
         #assert isinstance(e[0], GlobalWrappingError)
@@ -195,6 +193,45 @@ class TestCase:
         e, c = validate_file("test_9.fa", strict=False)
         assert len(e) == 0
 
+    def test_lookup_tables(self):
+        """The byte lookup tables must agree with the original regexes"""
+        class Record:
+            def __init__(self, s):
+                self.sequence = self.id = self.name = s
+        for strict, pattern in [(False, Constants.ILLEGAL_NUCLEOTIDES),
+                                (True, Constants.ILLEGAL_NUC_STRICT)]:
+            v = ValidateFastaNucleotides(strict=strict)
+            for s in ["acgtn", "ACGTRYN", "ACG-T", "AC.GT", "ACGTu",
+                      " ACGT\t", "AC GT", "ACG\u00e9T", ""]:
+                rec = Record(s)
+                bad_nuc = re.findall(pattern, s.strip())
+                assert v.validate(rec) == (len(bad_nuc) == 0)
+                if bad_nuc:
+                    assert str(bad_nuc) in str(v.to_error(rec))
+        v = ValidateFastaIdentifier()
+        for s in ["chr1", "chr1,2", 'chr"1"', "chr:1", "chr\u00e9", ""]:
+            assert v.validate(Record(s)) == (
+                not re.findall(Constants.ILLEGAL_IDENTIFIER, s))
+
+    def test_identifier_unique(self):
+        class Record:
+            def __init__(self, s):
+                self.id = s
+        # independent of the process (and PYTHONHASHSEED)
+        assert fasta._get_fingerprint("chr1") == 6899636747270975892
+        fingerprints = fasta._FingerprintSet(size=4)
+        ids = ["chr%d" % i for i in range(1000)]
+        assert all(fingerprints.add(fasta._get_fingerprint(s)) for s in ids)
+        assert len(fingerprints) == 1000
+        assert not any(fingerprints.add(fasta._get_fingerprint(s))
+                       for s in ids)
+        v = ValidateFastaIdentifierUnique()
+        recs = [Record(s) for s in ["chr1", "chr2", "chr1", "chr3", "chr2"]]
+        assert [v.validate(rec) for rec in recs] == [
+            True, True, False, True, False]
+        errors = v.to_errors(recs[2])
+        assert len(errors) == 1 and isinstance(errors[0], DuplicateIdError)
+
     def test_extra_gt(self):
         e, c = validate_file("test_10.fa")
         assert len(e) == 1
@@ -242,6 +279,43 @@ class TestCase:
         e, m = validate_file(file_name)
         assert len(e) == 0
 
+    def test_mixed_line_endings(self):
+        file_name = op.join(op.dirname(op.dirname(__file__)), "data",
+                            "bc_bad_returns.fasta")
+        e, m = validate_file(file_name)
+        assert len(e) == 1
+        assert isinstance(e[0], LineEndingsError)
+
+    def test_lone_cr(self):
+        def _get_errors(content):
+            with open("test_cr.fa", "w", newline="") as f:
+                f.write(content)
+            v = fasta.ValidateFastaRaw()
+            v.validate("test_cr.fa")
+            return [type(e).__name__ for e in v.to_errors("test_cr.fa")]
+        # a CR not followed by LF ends a line, as in text mode
+        assert _get_errors(">chr1\rGATTACA\rGATT\r") == []
+        assert _get_errors(">chr1\rGATT\rGATTACA\r") == ["SeqWrappingError"]
+        assert _get_errors(">chr1\r\rGATTACA\r") == ["EmptyLineError"]
+        assert _get_errors(">chr1\rGATTACA\n>chr2\nGATTACA\n") == [
+            "LineEndingsError"]
+        # non-ASCII whitespace, and line lengths in characters
+        assert _get_errors(">chr1\nGATTACA\u00a0\n") == ["WhitespaceError"]
+        assert _get_errors(">chr1\nG\u00e9TTACA\nGATTACA\nGAT\n") == []
+
+    def test_raw_block_size(self, monkeypatch):
+        """Errors must not depend on where the raw file is split into blocks"""
+        def _get_errors(file_name):
+            v = fasta.ValidateFastaRaw()
+            v.validate(file_name)
+            return [str(e) for e in v.to_errors(file_name)]
+        file_names = ["test_%d.fa" % i
+                      for i in range(1, len(test_sequences) + 1)]
+        expected = [_get_errors(file_name) for file_name in file_names]
+        for block_size in [1, 2, 7, 64]:
+            monkeypatch.setattr(fasta.Constants, "RAW_BLOCK_SIZE", block_size)
+            assert [_get_errors(fn) for fn in file_names] == expected
+
     def test_fsa_extension(self):
         shutil.copyfile("test_1.fa", "test_1.fsa")
         rc = subprocess.call(["pbvalidate", "test_1.fsa"])
@@ -1,10 +1,13 @@
 import xml.dom.minidom
+import json
 import tempfile
 import os.path as op
 import os
 
 import pbcoretools.pbvalidate.utils
 import pbcoretools.pbvalidate.main
+from pbcoretools.pbvalidate.core import (ValidatorError, PROFILE,
+                                         SAMPLED_RECORDS, TOTAL_RECORDS)
 
 DATA_DIR = op.join(op.dirname(op.dirname(__file__)), "data")
 
@@ -42,3 +45,36 @@ class MiscTests:
         dom = result.to_xml()
         failures = dom.getElementsByTagName("failure")
         assert len(failures) == 14
+
+    def test_json_report(self):
+        errors = [ValidatorError("bad record %d" % i, "record %d" % i)
+                  for i in range(8)]
+        metrics = {
+            "ValidateCheap": 100,
+            "ValidateExpensive": 92,
+            SAMPLED_RECORDS: 100,
+            TOTAL_RECORDS: 1000,
+            PROFILE: {"FileTime": 0.5, "RecordTime": 1.5, "Records": 100,
+                      "ValidatorTimes": {"ValidateCheap": 0.1,
+                                         "ValidateExpensive": 1.0,
+                                         "ValidateFile": 0.4}},
+        }
+        tmp_out = tempfile.NamedTemporaryFile(suffix=".json").name
+        pbcoretools.pbvalidate.utils.dump_json_report(
+            tmp_out, "file.bam", errors, metrics, 2.0)
+        with open(tmp_out) as f:
+            report = json.load(f)
+        os.remove(tmp_out)
+        assert report["n_errors"] == 8
+        assert report["records_per_second"] == 50
+        assert report["phases"] == {"file": 0.5, "record": 1.5}
+        assert report["sample"] == {"sampled": 100, "total": 1000}
+        assert [v["name"] for v in report["validators"]] == [
+            "ValidateExpensive", "ValidateFile", "ValidateCheap"]
+        assert report["validators"][0]["passed"] == 92
+        assert report["validators"][0]["seconds_per_record"] == 0.01
+        assert len(report["errors"]) == 1
+        assert report["errors"][0]["count"] == 8
+        assert len(report["errors"][0]["samples"]) == 5
+        assert report["errors"][0]["samples"][0] == {
+            "message": "bad record 0", "object": "record 0"}
@@ -2,13 +2,16 @@ from zipfile import ZipFile
 import tempfile
 import textwrap
 import json
+import os
 import os.path as op
+import tarfile
 import pytest
 
-from pbcore.io import FastaReader, FastaWriter, FastqReader, FastqWriter
+from pbcore.io import (FastaReader, FastaWriter, FastqReader, FastqWriter,
+                       ContigSet)
 from pbcommand.testkit import PbIntegrationBase
 
-from test_chunking_gather import create_zip
+from test_chunking_gather import create_zip, create_tarball
 
 
 class GatherTextRecordsBase:
@@ -193,6 +196,18 @@ class TestGatherToolFastaJoinContigs(TestGatherToolFasta):
             assert len(combined_seq) == len(records[0].sequence)
 
 
+class TestGatherToolFastaIndexContigs(TestGatherToolFasta):
+    EXTRA_ARGS = ["--index-contigs"]
+
+    def _validate_result(self, gathered_file):
+        super()._validate_result(gathered_file)
+        assert op.isfile(gathered_file + ".fai")
+        contigset_file = op.splitext(gathered_file)[0] + ".contigset.xml"
+        with ContigSet(contigset_file) as ds:
+            assert [rec.id for rec in ds] == [
+                header + "|arrow" for header, _ in self.CHUNK_CONTIGS]
+
+
 class TestGatherToolFastqJoinContigs(TestGatherToolFastaJoinContigs):
     EXTENSION = ".fastq"
     READER = FastqReader
@@ -226,6 +241,25 @@ class TestGatherToolZip(PbIntegrationBase):
         assert len(uuids) == 4
 
 
+class TestGatherToolTgz(PbIntegrationBase):
+
+    def test_run_tool_and_validate(self):
+        tmp_dir = tempfile.mkdtemp()
+        base_dir = os.getcwd()
+        try:
+            os.chdir(tmp_dir)
+            inputs = [create_tarball("chunk{i}.tgz".format(i=i), n=3)
+                      for i in range(2)]
+        finally:
+            os.chdir(base_dir)
+        inputs = [op.join(tmp_dir, fn) for fn in inputs]
+        tmp_out = tempfile.NamedTemporaryFile(suffix=".tgz").name
+        args = ["pbtools-gather", tmp_out] + inputs + ["--nproc", "2"]
+        self._check_call(args)
+        with tarfile.open(tmp_out, mode="r:gz") as gathered:
+            assert len(gathered.getnames()) == 6
+
+
 @pytest.mark.internal_data
 def test_gather_datastore_json():
     import subprocess
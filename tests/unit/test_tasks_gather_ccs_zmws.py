@@ -6,7 +6,11 @@ import json
 
 from pbcommand.testkit.core import PbIntegrationBase
 
-from pbcoretools.tasks.gather_ccs_zmws import gather_chunks, FIELDS
+from pbcoretools.tasks.gather_ccs_zmws import (gather_chunks,
+                                               ZmwColumns,
+                                               ZmwInfo,
+                                               load_zmw_columns,
+                                               FIELDS)
 
 
 class TestGatherCcsZmws(PbIntegrationBase, unittest.TestCase):
@@ -43,3 +47,33 @@ class TestGatherCcsZmws(PbIntegrationBase, unittest.TestCase):
         ] + self.INFILES
         self._check_call(args)
         self._validate_output(ofn)
+
+    def test_gather_npz(self):
+        chunks = []
+        for i, status in enumerate(["SUCCESS", "POOR_SNR"]):
+            d = {"zmws": [{"insert_size": 100 + i,
+                           "polymerase_length": 200,
+                           "predicted_accuracy": 0.99,
+                           "num_full_passes": i,
+                           "status": status}]}
+            fn = tempfile.NamedTemporaryFile(suffix=".json.gz").name
+            with gzip.open(fn, mode="wt") as gz_out:
+                gz_out.write(json.dumps(d))
+            chunks.append(fn)
+        npz1 = tempfile.NamedTemporaryFile(suffix=".npz").name
+        gather_chunks(chunks, npz1)
+        npz2 = tempfile.NamedTemporaryFile(suffix=".npz").name
+        gather_chunks([chunks[1], npz1], npz2)
+        with load_zmw_columns(npz2) as zmws:
+            assert list(zmws["insert_size"]) == [101, 100, 101]
+            assert list(zmws["num_full_passes"]) == [1, 0, 1]
+            status = [zmws["status_names"][i] for i in zmws["status"]]
+            assert status == ["POOR_SNR", "SUCCESS", "POOR_SNR"]
+
+
+    def test_too_many_status_names(self):
+        zmws = ZmwColumns()
+        for i in range(ZmwColumns.MAX_STATUS_NAMES):
+            zmws.add_zmw(ZmwInfo(100, 200, 0.99, 1, "STATUS_{i}".format(i=i)))
+        with self.assertRaises(ValueError):
+            zmws.add_zmw(ZmwInfo(100, 200, 0.99, 1, "ONE_TOO_MANY"))